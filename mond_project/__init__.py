@@ -4,6 +4,14 @@ from ._version import __version__, __version_info__
 version = __version__
 
 from . import calculate
-from .calculate import *
 from . import data_utils
-from .data_utils import *
+from ._lazy import attach
+
+# Everything exported by the subpackages (and their modules) is available
+# here too, but nothing is imported from them until it is first used
+_exports = {}
+for _subpackage in [calculate, data_utils]:
+    for _name in list(_subpackage._exports) + list(_subpackage._submodules):
+        _exports[_name] = _subpackage.__name__.split(".")[-1]
+_exports.update(load_pipeline_config="pipeline", run_pipeline="pipeline")
+attach(__name__, globals(), _exports, ["benchmarks", "pipeline"])
@@ -0,0 +1,50 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import importlib
+import sys
+
+
+def attach(package, namespace, exports, submodules=()):
+    """Make the exports and submodules of a package be imported the first
+    time they are used, rather than when the package is imported, so that
+    importing the package doesn't import any heavy dependencies of modules
+    that aren't used. Python versions without module level ``__getattr__``
+    (before 3.7) import everything at once instead
+
+    Parameters
+    ----------
+    :param package: The name of the package, i.e. ``__name__``
+    :type package: str
+    :param namespace: The namespace of the package, i.e. ``globals()``
+    :type namespace: dict
+    :param exports: The name of the submodule (relative to the package)
+    holding each exported name
+    :type exports: dict
+    :param submodules: The names of submodules to import when used as
+    attributes of the package. Default ()
+    :type submodules: list of str, optional
+    """
+    submodules = frozenset(submodules)
+
+    def __getattr__(name):
+        if name in exports:
+            value = getattr(importlib.import_module(
+                ".{}".format(exports[name]), package), name)
+        elif name in submodules:
+            value = importlib.import_module(".{}".format(name), package)
+        else:
+            raise AttributeError("module {!r} has no attribute {!r}".format(
+                package, name))
+        namespace[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(namespace) | set(exports) | submodules)
+
+    namespace["__all__"] = [str(name) for name in sorted(exports)]
+    if sys.version_info < (3, 7):
+        for name in sorted(submodules) + sorted(exports):
+            __getattr__(str(name))
+    else:
+        namespace["__getattr__"] = __getattr__
+        namespace["__dir__"] = __dir__
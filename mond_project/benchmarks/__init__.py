@@ -0,0 +1,20 @@
+from .._version import __version__, __version_info__
+version = __version__
+
+from .._lazy import attach
+
+# The module holding each export, which is imported on first use
+_exports = {
+    "MockIllustrisAPI"     :"mock_api",
+    "synthetic_cutout"     :"synthetic",
+    "synthetic_halo"       :"synthetic",
+    "write_synthetic_halos":"synthetic",
+    "compare_benchmarks"   :"suite",
+    "measure"              :"suite",
+    "measure_import"       :"suite",
+    "reference_gbar"       :"suite",
+    "reference_gobs"       :"suite",
+    "reference_particles"  :"suite",
+    "run_benchmarks"       :"suite"}
+_submodules = ("mock_api", "suite", "synthetic")
+attach(__name__, globals(), _exports, _submodules)
@@ -0,0 +1,6 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import sys
+from .suite import main
+
+sys.exit(main())
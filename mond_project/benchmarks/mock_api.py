@@ -0,0 +1,406 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import hashlib
+import json
+import re
+import threading
+import time
+from future.moves.http.server import BaseHTTPRequestHandler, HTTPServer
+from future.moves.socketserver import ThreadingMixIn
+from future.moves.urllib.parse import parse_qsl, urlencode, urlparse
+import numpy as np
+from ..data_utils import data_read_utils
+from .synthetic import synthetic_cutout
+
+# Paths served below the root of the API, relative to the root. As in the
+# Illustris API, the trailing slash of documents is optional
+_routes = [
+    ("root", re.compile(r"^$")),
+    ("simulation", re.compile(r"^(?P<sim>[^/]+)/?$")),
+    ("snapshots", re.compile(r"^(?P<sim>[^/]+)/snapshots/?$")),
+    ("snapshot", re.compile(r"^(?P<sim>[^/]+)/snapshots/(?P<snap>[^/]+)/?$")),
+    ("subhalos", re.compile(
+        r"^(?P<sim>[^/]+)/snapshots/(?P<snap>[^/]+)/subhalos/?$")),
+    ("subhalo", re.compile(
+        r"^(?P<sim>[^/]+)/snapshots/(?P<snap>[^/]+)/subhalos/(?P<id>\d+)/?$")),
+    ("cutout", re.compile(
+        r"^(?P<sim>[^/]+)/snapshots/(?P<snap>[^/]+)/subhalos/(?P<id>\d+)/"
+        r"cutout\.hdf5$"))]
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """A private class to be used behind the scenes for serving each request
+    in its own thread
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _NotFound(Exception):
+    """A private exception to be used behind the scenes for requests of
+    anything the server doesn't have
+    """
+    pass
+
+
+class MockIllustrisAPI(object):
+    """A local stand-in for the Illustris API, serving the simulation,
+    snapshot, subhalo, and paginated subhalo listing documents and cutouts of
+    synthetic subhalos from :func:`synthetic.synthetic_cutout`. Latency,
+    limited bandwidth, and errors can be added to every request, to measure
+    and test the ingest of :func:`data_read_utils.save_halos` reproducibly
+    and without a network connection. The server runs in a background
+    thread, and every document and cutout is the same for the same
+    parameters
+
+    Parameters
+    ----------
+    :param n_subhalos: The number of subhalos in each snapshot. Default 20
+    :type n_subhalos: int, optional
+    :param n_part: The number of star and gas particles in each cutout.
+    Default 1000
+    :type n_part: int, optional
+    :param gas_frac: The fraction of the particles that are gas. Default 0.5
+    :type gas_frac: float, optional
+    :param snapshots: The redshift of each snapshot, keyed by snapshot
+    number. Default {135: 0.0}
+    :type snapshots: dict, optional
+    :param simulations: The names of the simulations. Default
+    ('Illustris-1', 'Illustris-2', 'Illustris-3')
+    :type simulations: list of str, optional
+    :param latency: The time to wait before answering each request, in
+    seconds, or the minimum and maximum of a uniformly drawn wait. Default 0
+    :type latency: float or tuple of float, optional
+    :param bandwidth: The rate at which response bodies are sent, in bytes
+    per second, or None for no limit. Default None
+    :type bandwidth: float, optional
+    :param error_rate: The probability that a request fails with
+    :param:`error_status` instead of being answered. Default 0
+    :type error_rate: float, optional
+    :param error_status: The HTTP status of injected errors. Default 503
+    :type error_status: int, optional
+    :param seed: The seed for the subhalos and the injected errors. Default 0
+    :type seed: int, optional
+    :param host: The address to listen on. Default '127.0.0.1'
+    :type host: str, optional
+    :param port: The port to listen on, or 0 for any free port. Default 0
+    :type port: int, optional
+
+    Examples
+    --------
+    Saving subhalos from the stand-in server with 50 ms of latency:
+
+    >>> with MockIllustrisAPI(latency=0.05) as api:  # doctest: +SKIP
+    ...     configure_api(api.base_url)
+    ...     save_halos(1, save_loc, z=0, max_halos=10)
+    >>> configure_api()  # doctest: +SKIP
+    """
+    def __init__(self, n_subhalos=20, n_part=1000, gas_frac=0.5,
+                 snapshots=None, simulations=("Illustris-1", "Illustris-2",
+                                              "Illustris-3"),
+                 latency=0.0, bandwidth=None, error_rate=0.0,
+                 error_status=503, seed=0, host="127.0.0.1", port=0):
+        self.n_subhalos = int(n_subhalos)
+        self.n_part = int(n_part)
+        self.gas_frac = gas_frac
+        self.snapshots = dict(snapshots or {135:0.0})
+        self.simulations = list(simulations)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = int(error_status)
+        self.seed = seed
+        self._host = host
+        self._port = port
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._rng = np.random.RandomState(seed)
+        self._cutouts = {}
+        self._stats = {}
+
+    @property
+    def base_url(self):
+        """The root URL of the API, once the server is started"""
+        if self._server is None:
+            raise IOError("Mock API server is not running")
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/api/".format(host, port)
+
+    def start(self):
+        """Start serving in a background thread
+
+        Returns
+        -------
+        :return api: This server
+        :rtype api: :class:`MockIllustrisAPI`
+        """
+        if self._server is not None:
+            return self
+        api = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                api._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer((self._host, self._port),
+                                            _Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server and wait for its thread to finish"""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """Get the numbers of requests answered by the server
+
+        Returns
+        -------
+        :return stats: The number of requests ('requests'), injected errors
+        ('errors'), and bytes of response bodies sent ('bytes'), in total and
+        for each kind of document ('root', 'simulation', 'snapshots',
+        'snapshot', 'subhalos', 'subhalo', and 'cutout')
+        :rtype stats: dict
+        """
+        with self._lock:
+            stats = dict((kind, dict(kind_stats)) for (kind, kind_stats) in
+                         self._stats.items())
+        stats["total"] = dict((key, sum(kind_stats[key] for kind_stats in
+                                        stats.values())) for key in
+                              ["requests", "errors", "bytes"])
+        return stats
+
+    def reset_stats(self):
+        """Reset the numbers of requests answered by the server"""
+        with self._lock:
+            self._stats.clear()
+
+    def _count(self, kind, key, n=1):
+        """Add to one of the statistics of a kind of document"""
+        with self._lock:
+            kind_stats = self._stats.setdefault(kind, {"requests":0,
+                                                       "errors":0, "bytes":0})
+            kind_stats[key] += n
+
+    def _sim_url(self, sim):
+        return "{}{}/".format(self.base_url, sim)
+
+    def _snap_url(self, sim, snapnum):
+        return "{}snapshots/{}/".format(self._sim_url(sim), snapnum)
+
+    def _sub_url(self, sim, snapnum, id):
+        return "{}subhalos/{}/".format(self._snap_url(sim, snapnum), id)
+
+    def _find_snapshot(self, snap):
+        """Get the snapshot number from either its number or 'z=<redshift>'
+        """
+        if snap.startswith("z="):
+            z = float(snap[2:])
+            for (snapnum, redshift) in self.snapshots.items():
+                if np.isclose(redshift, z):
+                    return snapnum
+        elif snap.isdigit() and int(snap) in self.snapshots:
+            return int(snap)
+        raise _NotFound()
+
+    def subhalo(self, sim, snapnum, id):
+        """Get the document for a subhalo. About one in five subhalos have no
+        gas or no stars, so that selections remove some subhalos
+
+        Parameters
+        ----------
+        :param sim: The name of the simulation
+        :type sim: str
+        :param snapnum: The snapshot number
+        :type snapnum: int
+        :param id: The subhalo ID
+        :type id: int
+
+        Returns
+        -------
+        :return sub: The subhalo document
+        :rtype sub: dict
+        """
+        rng = np.random.RandomState([self.seed, snapnum, id])
+        sub = dict(("{}_{}".format(kind, ax), rng.uniform(0, 1.e4)) for kind
+                   in ["pos", "vel"] for ax in "xyz")
+        sub.update(id=id, snap=snapnum,
+                   mass_stars=0.0 if id % 10 == 3 else rng.uniform(0.1, 10.0),
+                   mass_gas=0.0 if id % 10 == 7 else rng.uniform(0.1, 10.0),
+                   url=self._sub_url(sim, snapnum, id),
+                   cutouts={"subhalo":"{}cutout.hdf5".format(
+                       self._sub_url(sim, snapnum, id))})
+        return sub
+
+    def cutout(self, sim, snapnum, id):
+        """Get the cutout of a subhalo, drawing its particles the first time
+
+        Parameters
+        ----------
+        :param sim: The name of the simulation
+        :type sim: str
+        :param snapnum: The snapshot number
+        :type snapnum: int
+        :param id: The subhalo ID
+        :type id: int
+
+        Returns
+        -------
+        :return cutout: The contents of the HDF5 cutout
+        :rtype cutout: bytes
+        """
+        key = (sim, snapnum, id)
+        with self._lock:
+            cutout = self._cutouts.get(key)
+        if cutout is None:
+            a = 1.0 / (1.0 + self.snapshots[snapnum])
+            seed = (self.seed + 7919 * self.simulations.index(sim) +
+                    104729 * snapnum + id) % 2**31
+            cutout = synthetic_cutout(
+                self.n_part, self.gas_frac, seed=seed, a=a,
+                sub=self.subhalo(sim, snapnum, id))[0].getvalue()
+            with self._lock:
+                self._cutouts[key] = cutout
+        return cutout
+
+    def _listing(self, sim, snapnum, params, path):
+        """Get a page of the subhalos passing the filters in the query"""
+        limit = int(params.pop("limit", 100))
+        offset = int(params.pop("offset", 0))
+        params.pop("order_by", None)
+        selection = dict((key, float(val)) for (key, val) in params.items())
+        ids = [i for i in range(self.n_subhalos) if
+               data_read_utils._is_selected(self.subhalo(sim, snapnum, i),
+                                            selection)]
+        page_ids = ids[offset:offset + limit]
+        next_url = None
+        if offset + limit < len(ids):
+            next_params = dict(params, limit=limit, offset=offset + limit)
+            next_url = "{}{}?{}".format(
+                self.base_url[:-len(urlparse(self.base_url).path)], path,
+                urlencode(sorted(next_params.items())))
+        return {"count":len(ids), "next":next_url, "previous":None,
+                "results":[{"id":i, "url":self._sub_url(sim, snapnum, i)} for
+                           i in page_ids]}
+
+    def _document(self, kind, match, params, path):
+        """Get the JSON document or cutout for a request"""
+        sim = match.groupdict().get("sim")
+        if kind == "root":
+            return {"simulations":[{"name":name, "num_snapshots":len(
+                self.snapshots), "url":self._sim_url(name)} for name in
+                                   self.simulations]}
+        if sim not in self.simulations:
+            raise _NotFound()
+        if kind == "simulation":
+            return {"name":sim, "num_snapshots":len(self.snapshots),
+                    "snapshots":"{}snapshots/".format(self._sim_url(sim))}
+        if kind == "snapshots":
+            return [{"number":snapnum, "redshift":redshift,
+                     "url":self._snap_url(sim, snapnum)} for
+                    (snapnum, redshift) in sorted(self.snapshots.items())]
+        snapnum = self._find_snapshot(match.group("snap"))
+        if kind == "snapshot":
+            return {"number":snapnum, "redshift":self.snapshots[snapnum],
+                    "num_subhalos":self.n_subhalos,
+                    "subhalos":"{}subhalos/".format(self._snap_url(sim,
+                                                                   snapnum))}
+        if kind == "subhalos":
+            return self._listing(sim, snapnum, params, path)
+        id = int(match.group("id"))
+        if id >= self.n_subhalos:
+            raise _NotFound()
+        if kind == "subhalo":
+            return self.subhalo(sim, snapnum, id)
+        return self.cutout(sim, snapnum, id)
+
+    def _wait(self):
+        """Wait for the latency of a request"""
+        latency = self.latency
+        if np.ndim(latency) > 0:
+            with self._lock:
+                latency = self._rng.uniform(latency[0], latency[1])
+        if latency > 0:
+            time.sleep(latency)
+
+    def _send(self, handler, status, body, headers):
+        """Send a response, limiting the rate at which the body is sent"""
+        handler.send_response(status)
+        for (name, val) in headers:
+            handler.send_header(name, val)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if not self.bandwidth:
+            handler.wfile.write(body)
+            return
+        chunk_size = max(int(self.bandwidth / 100), 1)
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            handler.wfile.write(chunk)
+            time.sleep(len(chunk) / self.bandwidth)
+
+    def _handle(self, handler):
+        """Answer a single request"""
+        url = urlparse(handler.path)
+        root = urlparse(self.base_url).path
+        rel_path = url.path[len(root):] if url.path.startswith(root) else None
+        kind = match = None
+        for (route, pattern) in _routes:
+            match = pattern.match(rel_path) if rel_path is not None else None
+            if match:
+                kind = route
+                break
+        self._wait()
+        self._count(kind or "unknown", "requests")
+        with self._lock:
+            fail = self.error_rate > 0 and self._rng.uniform() < self.error_rate
+        if fail:
+            self._count(kind or "unknown", "errors")
+            body = json.dumps({"detail":"Injected error"}).encode("utf-8")
+            self._send(handler, self.error_status, body, [
+                ("Content-Type", "application/json"), ("Retry-After", "0")])
+            return
+        try:
+            if kind is None:
+                raise _NotFound()
+            doc = self._document(kind, match, dict(parse_qsl(url.query)),
+                                 url.path)
+        except _NotFound:
+            body = json.dumps({"detail":"Not found."}).encode("utf-8")
+            self._send(handler, 404, body,
+                       [("Content-Type", "application/json")])
+            return
+        if kind == "cutout":
+            headers = [("Content-Type", "application/octet-stream"),
+                       ("Content-Disposition", "attachment; filename="
+                        "cutout_{}.hdf5".format(match.group("id")))]
+            body = doc
+        else:
+            body = json.dumps(doc, sort_keys=True).encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if handler.headers.get("If-None-Match") == etag:
+                self._send(handler, 304, b"", [("ETag", etag)])
+                return
+            headers = [("Content-Type", "application/json"), ("ETag", etag)]
+        self._count(kind, "bytes", len(body))
+        self._send(handler, 200, body, headers)
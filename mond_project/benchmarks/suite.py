@@ -0,0 +1,497 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+import pandas as pd
+from ..calculate import calc_accel
+from ..calculate.halo_cache import clear_halo_cache, load_halo
+from ..data_utils import data_read_utils
+from .synthetic import synthetic_cutout, write_synthetic_halos
+try:
+    import tracemalloc
+except ImportError:
+    # Memory can't be traced before Python 3.4, so the peak memory of each
+    # benchmark is NaN
+    tracemalloc = None
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Columns of the benchmark results
+result_columns = ["benchmark", "n_halos", "n_part", "n_bins", "seconds",
+                  "peak_mib", "max_rel_err", "ok"]
+
+# Columns identifying a single benchmark, for comparing runs
+key_columns = ["benchmark", "n_halos", "n_part", "n_bins"]
+
+# Imports to time in a new interpreter, with the heavy modules that each
+# should not import
+import_benchmarks = [
+    ("import_package", "mond_project",
+     ["numpy", "pandas", "h5py", "requests", "configobj"]),
+    ("import_calc", "mond_project.calculate.calc_accel",
+     ["h5py", "requests", "configobj"])]
+
+# Script run to time an import, printing the time, the peak memory if
+# traced, and the modules imported
+_import_script = """
+import json, sys, time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+trace = {trace} and tracemalloc is not None
+if trace:
+    tracemalloc.start()
+clock = getattr(time, "perf_counter", time.time)
+start = clock()
+import {module}
+seconds = clock() - start
+peak = tracemalloc.get_traced_memory()[1] if trace else float("nan")
+print(json.dumps([seconds, peak, sorted(sys.modules)]))
+"""
+
+
+def reference_gobs(df, r_low, r_upp):
+    """The original calculation of the observed acceleration in
+    :func:`calc_accel.calc_gobs`, averaging :math:`v^2 / r` over the particles
+    selected for each bin separately
+
+    Parameters
+    ----------
+    :param df: The particles of a single subhalo
+    :type df: pandas DataFrame
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array-like float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array-like float
+
+    Returns
+    -------
+    :return gobs: The observed acceleration in each bin, or NaN for bins with
+    no particles
+    :rtype gobs: 1D array float
+    """
+    r = np.asarray(df["r"], dtype=float)
+    v = np.asarray(df["v"], dtype=float)
+    gobs = np.full(len(r_low), np.nan)
+    for i, (rli, rui) in enumerate(zip(r_low, r_upp)):
+        in_bin = (r >= rli) & (r < rui)
+        if in_bin.any():
+            gobs[i] = np.mean(v[in_bin]**2 / r[in_bin])
+    return gobs
+
+
+def reference_gbar(df, r_low, r_upp):
+    """The original calculation of the baryonic acceleration in
+    :func:`calc_accel.calc_gbar`, using the mass enclosed within the lower
+    edge of each bin and averaging :math:`1 / r^2` over the bin
+
+    Parameters
+    ----------
+    :param df: The particles of a single subhalo
+    :type df: pandas DataFrame
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array-like float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array-like float
+
+    Returns
+    -------
+    :return gbar: The baryonic acceleration in each bin, or NaN for bins with
+    no particles
+    :rtype gbar: 1D array float
+    """
+    r = np.asarray(df["r"], dtype=float)
+    m = np.asarray(df["M"], dtype=float)
+    gbar = np.full(len(r_low), np.nan)
+    for i, (rli, rui) in enumerate(zip(r_low, r_upp)):
+        in_bin = (r >= rli) & (r < rui)
+        if in_bin.any():
+            gbar[i] = np.mean(calc_accel.grav_constant * m[r < rli].sum() /
+                              r[in_bin]**2)
+    return gbar
+
+
+def reference_particles(f, sub, a):
+    """The original transform of a cutout in
+    :func:`data_read_utils.save_halos`, done separately for each axis of the
+    gas and star particles
+
+    Parameters
+    ----------
+    :param f: The cutout file
+    :type f: :class:`h5py.File`
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param a: The scale factor of the snapshot
+    :type a: float
+
+    Returns
+    -------
+    :return data: The radius ('r'), mass ('M'), and speed ('v') of each
+    particle
+    :rtype data: dict
+    """
+    h = data_read_utils.get_hubble_param()
+    data = {"r":[], "M":[], "v":[]}
+    for group in ["PartType0", "PartType4"]:
+        pos = np.asarray(f[group]["Coordinates"], dtype=float)
+        vel = np.asarray(f[group]["Velocities"], dtype=float) * np.sqrt(a)
+        dr = [pos[:, j] - sub["pos_" + ax] for (j, ax) in enumerate("xyz")]
+        dv = [vel[:, j] - sub["vel_" + ax] for (j, ax) in enumerate("xyz")]
+        data["r"].append(np.sqrt(dr[0]**2 + dr[1]**2 + dr[2]**2) * a / h)
+        data["v"].append(np.sqrt(dv[0]**2 + dv[1]**2 + dv[2]**2))
+        data["M"].append(np.asarray(f[group]["Masses"], dtype=float) *
+                         (10**10 / h))
+    return dict((col, np.concatenate(arrs)) for (col, arrs) in data.items())
+
+
+def _max_rel_err(obs, exp):
+    """A private function to be used behind the scenes for the largest
+    relative difference between two sets of results, which is infinite if
+    they are NaN in different places
+    """
+    obs = np.asarray(obs, dtype=float)
+    exp = np.asarray(exp, dtype=float)
+    if not np.array_equal(np.isnan(obs), np.isnan(exp)):
+        return np.inf
+    finite = ~np.isnan(exp)
+    if not finite.any():
+        return 0.0
+    return float(np.max(np.abs(obs[finite] - exp[finite]) /
+                        np.maximum(np.abs(exp[finite]), np.finfo(float).tiny)))
+
+
+def measure(func, repeat=3):
+    """Measure the time taken and the peak memory allocated by a function.
+    The time is the fastest of :param:`repeat` calls, and the memory is
+    traced in a separate call so that tracing doesn't slow the timed calls
+
+    Parameters
+    ----------
+    :param func: The function to call with no arguments
+    :type func: callable
+    :param repeat: The number of timed calls. Default 3
+    :type repeat: int, optional
+
+    Returns
+    -------
+    :return result: The result of the last call
+    :rtype result: any
+    :return seconds: The fastest time taken by a call, in seconds
+    :rtype seconds: float
+    :return peak_bytes: The peak memory allocated during a call, in bytes,
+    or NaN if memory can't be traced
+    :rtype peak_bytes: int or float
+    """
+    seconds = np.inf
+    for _ in range(max(int(repeat), 1)):
+        start = _clock()
+        func()
+        seconds = min(seconds, _clock() - start)
+    if tracemalloc is None:
+        return func(), seconds, np.nan
+    was_tracing = tracemalloc.is_tracing()
+    if hasattr(tracemalloc, "reset_peak"):
+        if not was_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    else:
+        # Before Python 3.9 the peak can only be reset by tracing afresh
+        if was_tracing:
+            tracemalloc.stop()
+        tracemalloc.start()
+    try:
+        result = func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    return result, seconds, peak_bytes
+
+
+def measure_import(module, repeat=3, avoid=()):
+    """Measure the time taken and the peak memory allocated by importing a
+    module in a new interpreter, as for a short-lived worker process. The
+    time is the fastest of :param:`repeat` imports, and the memory is traced
+    in a separate import
+
+    Parameters
+    ----------
+    :param module: The name of the module to import
+    :type module: str
+    :param repeat: The number of timed imports. Default 3
+    :type repeat: int, optional
+    :param avoid: The names of modules that the import should not import.
+    Default ()
+    :type avoid: list of str, optional
+
+    Returns
+    -------
+    :return imported: The modules in :param:`avoid` that were imported
+    :rtype imported: list of str
+    :return seconds: The fastest time taken by an import, in seconds
+    :rtype seconds: float
+    :return peak_bytes: The peak memory allocated during an import, in
+    bytes, or NaN if memory can't be traced
+    :rtype peak_bytes: int or float
+    """
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [path for path in [env.get("PYTHONPATH")] if path])
+
+    def _run(trace):
+        output = subprocess.check_output(
+            [sys.executable, "-c", _import_script.format(module=module,
+                                                         trace=trace)],
+            env=env)
+        return json.loads(output.decode("utf-8").splitlines()[-1])
+
+    seconds = min(_run(False)[0] for _ in range(max(int(repeat), 1)))
+    _, peak_bytes, modules = _run(True)
+    return sorted(set(avoid) & set(modules)), seconds, peak_bytes
+
+
+def _cold(func):
+    """A private function to be used behind the scenes for running a
+    calculation with an empty halo cache, so that every call reads the
+    subhalos from disk
+    """
+    def _run():
+        clear_halo_cache()
+        return func()
+    return _run
+
+
+def run_benchmarks(n_halos=(10, 100), n_part=(1000, 10000), n_bins=(10, 100),
+                   repeat=3, gas_frac=0.5, n_check=3, rtol=1.e-8, seed=0,
+                   save_loc=None):
+    """Run the benchmarks of the calc functions and the ingest transform on
+    synthetic subhalos, for every combination of the numbers of subhalos,
+    particles per subhalo, and radial bins. The results of each benchmark are
+    checked against the original implementations for the first
+    :param:`n_check` subhalos
+
+    Parameters
+    ----------
+    :param n_halos: The numbers of subhalos. Default (10, 100)
+    :type n_halos: int or list of int, optional
+    :param n_part: The numbers of particles per subhalo. Default (1000, 10000)
+    :type n_part: int or list of int, optional
+    :param n_bins: The numbers of radial bins, spread between 0.5 and 100 kpc.
+    Default (10, 100)
+    :type n_bins: int or list of int, optional
+    :param repeat: The number of timed calls of each benchmark, of which the
+    fastest is kept. Default 3
+    :type repeat: int, optional
+    :param gas_frac: The fraction of the particles that are gas. Default 0.5
+    :type gas_frac: float, optional
+    :param n_check: The number of subhalos to check against the original
+    implementations. Default 3
+    :type n_check: int, optional
+    :param rtol: The largest relative difference from the original
+    implementations for a benchmark to pass. Default 1e-8
+    :type rtol: float, optional
+    :param seed: The seed for the synthetic subhalos. Default 0
+    :type seed: int, optional
+    :param save_loc: The directory in which to write the synthetic subhalos,
+    or None to use a temporary directory that is removed afterwards. Default
+    None
+    :type save_loc: str, optional
+
+    Returns
+    -------
+    :return results: One row per benchmark, with the name of the benchmark
+    ('benchmark'), the numbers of subhalos, particles, and bins ('n_halos',
+    'n_part', and 'n_bins'), the fastest time in seconds ('seconds'), the peak
+    memory allocated in MiB ('peak_mib'), the largest relative difference from
+    the original implementation ('max_rel_err'), and whether that is within
+    :param:`rtol` ('ok'). The import benchmarks of :data:`import_benchmarks`
+    come first, with no subhalos, particles, or bins, and their 'max_rel_err'
+    is the number of heavy modules imported that should have been avoided
+    :rtype results: pandas DataFrame
+    """
+    n_halos = np.atleast_1d(n_halos).astype(int)
+    n_part = np.atleast_1d(n_part).astype(int)
+    n_bins = np.atleast_1d(n_bins).astype(int)
+    tmp_dir = tempfile.mkdtemp(prefix="mond_bench_", dir=save_loc)
+    rows = []
+
+    def _add(benchmark, n_h, n_p, n_b, seconds, peak_bytes, err):
+        rows.append({"benchmark":benchmark, "n_halos":n_h, "n_part":n_p,
+                     "n_bins":n_b, "seconds":seconds,
+                     "peak_mib":peak_bytes / 2.**20, "max_rel_err":err,
+                     "ok":bool(err <= rtol)})
+
+    for (name, module, avoid) in import_benchmarks:
+        imported, seconds, peak = measure_import(module, repeat, avoid)
+        _add(name, 0, 0, 0, seconds, peak, float(len(imported)))
+
+    try:
+        for n_p in n_part:
+            a = 0.5
+            cutout, sub = synthetic_cutout(n_p, gas_frac, seed, a=a)
+
+            def _transform():
+                cutout.seek(0)
+                with h5py.File(cutout, "r") as f:
+                    return data_read_utils._particle_table(f, sub, a)
+
+            data, seconds, peak = measure(_transform, repeat)
+            cutout.seek(0)
+            with h5py.File(cutout, "r") as f:
+                ref = reference_particles(f, sub, a)
+            _add("ingest_transform", 1, n_p, 0, seconds, peak,
+                 max(_max_rel_err(data[col], ref[col]) for col in ref))
+
+            for n_h in n_halos:
+                list_file = write_synthetic_halos(
+                    tempfile.mkdtemp(dir=tmp_dir), n_h, n_p, gas_frac, seed)
+                check_ids = np.arange(min(n_check, n_h))
+                halos = [load_halo(calc_accel._get_halo_sources(
+                    list_file, [i])[1][0]["path"]) for i in check_ids]
+                for n_b in n_bins:
+                    edges = np.linspace(0.5, 100.0, n_b + 1)
+                    r = 0.5 * (edges[:-1] + edges[1:])
+                    delta_r = np.diff(edges)
+                    r_low, r_upp = edges[:-1], edges[1:]
+                    for (name, func, refs) in [
+                            ("calc_gobs", lambda: calc_accel.calc_gobs(
+                                r, delta_r, list_file),
+                             [reference_gobs]),
+                            ("calc_gbar", lambda: calc_accel.calc_gbar(
+                                r, delta_r, list_file),
+                             [reference_gbar]),
+                            ("calc_gobs_profile",
+                             lambda: calc_accel.calc_gobs_profile(
+                                 edges, list_file),
+                             [reference_gobs]),
+                            ("calc_rar", lambda: calc_accel.calc_rar(
+                                r, delta_r, list_file),
+                             [reference_gobs, reference_gbar])]:
+                        result, seconds, peak = measure(_cold(func), repeat)
+                        if name == "calc_rar":
+                            result = [result.pivot(index="r", columns="ID",
+                                                   values=accel) for accel
+                                      in ["gobs", "gbar"]]
+                        else:
+                            result = [result]
+                        err = max(_max_rel_err(res[i].values, ref(
+                            df, r_low, r_upp)) for (res, ref) in
+                                  zip(result, refs) for (i, df) in
+                                  zip(check_ids, halos))
+                        _add(name, n_h, n_p, n_b, seconds, peak, err)
+    finally:
+        clear_halo_cache()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return pd.DataFrame(rows, columns=result_columns)
+
+
+def compare_benchmarks(results, baseline, max_slowdown=1.5):
+    """Compare benchmark results with those of an earlier run, to find
+    benchmarks which have become slower
+
+    Parameters
+    ----------
+    :param results: The new results, as from :func:`run_benchmarks`
+    :type results: pandas DataFrame
+    :param baseline: The earlier results
+    :type baseline: pandas DataFrame
+    :param max_slowdown: The largest ratio of the new time to the earlier
+    time that is not a regression. Default 1.5
+    :type max_slowdown: float, optional
+
+    Returns
+    -------
+    :return comparison: One row for each benchmark in both runs, with the
+    columns of :data:`key_columns`, the earlier ('baseline_seconds') and new
+    ('seconds') times, their ratio ('slowdown'), and whether the slowdown is
+    more than :param:`max_slowdown` ('regression')
+    :rtype comparison: pandas DataFrame
+    """
+    comparison = pd.merge(
+        baseline[key_columns + ["seconds"]].rename(
+            columns={"seconds":"baseline_seconds"}),
+        results[key_columns + ["seconds"]], on=key_columns)
+    comparison["slowdown"] = (comparison["seconds"] /
+                              comparison["baseline_seconds"])
+    comparison["regression"] = comparison["slowdown"] > max_slowdown
+    return comparison
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line, printing the results and
+    optionally saving them or comparing them with an earlier run. The exit
+    status is 1 if any benchmark disagrees with the original implementation
+    or is slower than the earlier run by more than the allowed factor, so the
+    benchmarks can be used to gate changes
+
+    Parameters
+    ----------
+    :param argv: The command line arguments, or None to use
+    :data:`sys.argv`. Default None
+    :type argv: list of str, optional
+
+    Returns
+    -------
+    :return status: The exit status
+    :rtype status: int
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m mond_project.benchmarks",
+        description="Benchmark the calc functions and ingest transform on "
+                    "synthetic subhalos")
+    parser.add_argument("--n-halos", type=int, nargs="+", default=[10, 100],
+                        help="Numbers of subhalos")
+    parser.add_argument("--n-part", type=int, nargs="+", default=[1000, 10000],
+                        help="Numbers of particles per subhalo")
+    parser.add_argument("--n-bins", type=int, nargs="+", default=[10, 100],
+                        help="Numbers of radial bins")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed calls of each benchmark")
+    parser.add_argument("--gas-frac", type=float, default=0.5,
+                        help="Fraction of particles that are gas")
+    parser.add_argument("--rtol", type=float, default=1.e-8,
+                        help="Largest relative difference from the original "
+                             "implementations")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic subhalos")
+    parser.add_argument("--output", help="CSV file in which to save the "
+                                         "results")
+    parser.add_argument("--baseline", help="CSV file of earlier results to "
+                                           "compare with")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="Largest ratio of new to earlier time that is "
+                             "not a regression")
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.n_halos, args.n_part, args.n_bins,
+                             args.repeat, args.gas_frac, rtol=args.rtol,
+                             seed=args.seed)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+    status = 0
+    if not results["ok"].all():
+        print("Results differ from the original implementations",
+              file=sys.stderr)
+        status = 1
+    if args.baseline:
+        comparison = compare_benchmarks(results, pd.read_csv(args.baseline),
+                                        args.max_slowdown)
+        regressions = comparison[comparison["regression"]]
+        if len(regressions) > 0:
+            print("Benchmarks slower than the baseline:", file=sys.stderr)
+            print(regressions.to_string(index=False), file=sys.stderr)
+            status = 1
+    return status
@@ -0,0 +1,265 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import io
+import os
+import h5py
+import numpy as np
+import pandas as pd
+from ..calculate.calc_accel import grav_constant
+from ..data_utils import data_read_utils
+from ..data_utils.halo_store import decode_types, type_codes
+
+
+def _nfw_mu(x):
+    """A private function to be used behind the scenes for the dimensionless
+    mass of an NFW profile within :math:`x = r / r_s`
+    """
+    return np.log1p(x) - x / (1.0 + x)
+
+
+def _draw_nfw(rng, n, r_s, c):
+    """A private function to be used behind the scenes for drawing radii
+    from an NFW profile truncated at :math:`c \\cdot r_s`, by interpolating
+    the inverse of the enclosed mass
+    """
+    x = np.logspace(-5, np.log10(c), 2048)
+    cdf = _nfw_mu(x) / _nfw_mu(c)
+    return r_s * np.interp(rng.uniform(cdf[0], 1.0, n), cdf, x)
+
+
+def _draw_disk(rng, n, r_d, z_d):
+    """A private function to be used behind the scenes for drawing radii
+    from an exponential disk with scale length :param:`r_d` and a
+    :math:`\\mathrm{sech}^2` vertical profile with scale height :param:`z_d`
+    """
+    r_cyl = rng.gamma(2.0, r_d, n)
+    z = z_d * np.arctanh(rng.uniform(-1.0, 1.0, n) * (1.0 - 1.e-12))
+    return np.sqrt(r_cyl**2 + z**2)
+
+
+def synthetic_halo(n_part, gas_frac=0.5, seed=None, m_stars=5.e10,
+                   m_gas=1.e10, r_d=3.0, z_d=0.3, m_halo=1.e12, r_s=20.0,
+                   c=10.0, sigma_frac=0.1, float32=False):
+    """Draw the particles of a synthetic galaxy, with stars in an
+    exponential disk and gas following an NFW profile, in a dark matter halo
+    with an NFW profile. The speed of each particle is the circular speed at
+    its radius from all of the mass, with a random dispersion
+
+    Parameters
+    ----------
+    :param n_part: The total number of star and gas particles
+    :type n_part: int
+    :param gas_frac: The fraction of the particles that are gas. Default 0.5
+    :type gas_frac: float, optional
+    :param seed: The seed for the random draws, or None for a random seed.
+    Default None
+    :type seed: int, optional
+    :param m_stars: The total mass in stars, in :math:`M_\\odot`. Default
+    5e10
+    :type m_stars: float, optional
+    :param m_gas: The total mass in gas, in :math:`M_\\odot`. Default 1e10
+    :type m_gas: float, optional
+    :param r_d: The scale length of the stellar disk, in kpc. Default 3
+    :type r_d: float, optional
+    :param z_d: The scale height of the stellar disk, in kpc. Default 0.3
+    :type z_d: float, optional
+    :param m_halo: The mass of the dark matter halo, in :math:`M_\\odot`.
+    Default 1e12
+    :type m_halo: float, optional
+    :param r_s: The scale radius of the dark matter halo and the gas, in kpc.
+    Default 20
+    :type r_s: float, optional
+    :param c: The concentration of the dark matter halo and the gas, which
+    are truncated at :math:`c \\cdot r_s`. Default 10
+    :type c: float, optional
+    :param sigma_frac: The velocity dispersion in each direction, as a
+    fraction of the circular speed. Default 0.1
+    :type sigma_frac: float, optional
+    :param float32: If True, return the radii, masses, and speeds in single
+    precision, as from :func:`data_read_utils.save_halos` with
+    ``float32=True``. Default False
+    :type float32: bool, optional
+
+    Returns
+    -------
+    :return df: The radius ('r'), mass ('M'), speed ('v'), and type ('type')
+    of each particle, with the gas first as in the tables saved by
+    :func:`data_read_utils.save_halos`
+    :rtype df: pandas DataFrame
+    """
+    if n_part < 0:
+        raise ValueError("Number of particles must be non-negative")
+    if not 0.0 <= gas_frac <= 1.0:
+        raise ValueError("Gas fraction must be between 0 and 1")
+    rng = np.random.RandomState(seed)
+    n_gas = int(round(n_part * gas_frac))
+    n_stars = n_part - n_gas
+    r = np.concatenate([_draw_nfw(rng, n_gas, r_s, c),
+                        _draw_disk(rng, n_stars, r_d, z_d)])
+    m = np.concatenate([np.full(n_gas, m_gas / max(n_gas, 1)),
+                        np.full(n_stars, m_stars / max(n_stars, 1))])
+    m *= rng.uniform(0.5, 1.5, n_part)
+    order = np.argsort(r, kind="mergesort")
+    m_enc = np.empty(n_part)
+    m_enc[order] = np.cumsum(m[order])
+    m_enc += m_halo * _nfw_mu(np.minimum(r / r_s, c)) / _nfw_mu(c)
+    v_circ = np.sqrt(grav_constant * m_enc / r)
+    sigma = sigma_frac * v_circ
+    v = np.sqrt((v_circ + sigma * rng.standard_normal(n_part))**2 +
+                sigma**2 * (rng.standard_normal(n_part)**2 +
+                            rng.standard_normal(n_part)**2))
+    dtype = np.float32 if float32 else np.float64
+    codes = np.repeat(np.array([type_codes["gas"], type_codes["star"]],
+                               dtype=np.int8), [n_gas, n_stars])
+    return pd.DataFrame.from_dict({
+        "r"   :r.astype(dtype),
+        "M"   :m.astype(dtype),
+        "v"   :v.astype(dtype),
+        "type":decode_types(codes)})[["r", "M", "v", "type"]]
+
+
+def synthetic_cutout(n_part, gas_frac=0.5, seed=None, a=1.0, sub=None,
+                     **kwargs):
+    """Make a synthetic cutout of a single subhalo, in the format downloaded
+    from the Illustris API, for measuring the transform of
+    :func:`data_read_utils.save_halos`. The particles are drawn as in
+    :func:`synthetic_halo`, in random directions around the position and
+    velocity of the subhalo
+
+    Parameters
+    ----------
+    :param n_part: The total number of star and gas particles
+    :type n_part: int
+    :param gas_frac: The fraction of the particles that are gas. Default 0.5
+    :type gas_frac: float, optional
+    :param seed: The seed for the random draws, or None for a random seed.
+    Default None
+    :type seed: int, optional
+    :param a: The scale factor of the snapshot. Default 1
+    :type a: float, optional
+    :param sub: The API document for the subhalo, with its position and
+    velocity, or None to draw a random position and velocity. Default None
+    :type sub: dict, optional
+    :param kwargs: Any other parameters for :func:`synthetic_halo`
+
+    Returns
+    -------
+    :return cutout: The cutout, as an HDF5 file in memory
+    :rtype cutout: :class:`io.BytesIO`
+    :return sub: The API document for the subhalo, with its position
+    ('pos_x', 'pos_y', and 'pos_z') and velocity ('vel_x', 'vel_y', and
+    'vel_z')
+    :rtype sub: dict
+    """
+    df = synthetic_halo(n_part, gas_frac, seed, **kwargs)
+    rng = np.random.RandomState(None if seed is None else seed + 1)
+    h = data_read_utils.get_hubble_param()
+    if sub is None:
+        sub = dict(("{}_{}".format(kind, ax), rng.uniform(0, 1.e4)) for kind
+                   in ["pos", "vel"] for ax in "xyz")
+    sub_pos = np.array([sub["pos_x"], sub["pos_y"], sub["pos_z"]])
+    sub_vel = np.array([sub["vel_x"], sub["vel_y"], sub["vel_z"]])
+
+    def _directions(n):
+        xyz = rng.standard_normal((n, 3))
+        return xyz / np.linalg.norm(xyz, axis=1)[:, None]
+
+    cutout = io.BytesIO()
+    with h5py.File(cutout, "w") as f:
+        for part_type in ["gas", "star"]:
+            part = df[df["type"] == part_type]
+            group = f.create_group("PartType{}".format(type_codes[part_type]))
+            group.create_dataset("Coordinates", data=sub_pos + _directions(
+                len(part)) * (part["r"].values * h / a)[:, None])
+            group.create_dataset("Velocities", data=(sub_vel + _directions(
+                len(part)) * part["v"].values[:, None]) / np.sqrt(a))
+            group.create_dataset("Masses", data=part["M"].values * h / 10**10)
+    cutout.seek(0)
+    return cutout, sub
+
+
+def write_synthetic_halos(save_loc, n_halos, n_part, gas_frac=0.5, seed=0,
+                          store=False, sort_radius=False, float32=False,
+                          simulation="Illustris-1", label="z=0.0", **kwargs):
+    """Write synthetic subhalos from :func:`synthetic_halo` to
+    :param:`save_loc` as :func:`data_read_utils.save_halos` would, including
+    the ingest manifest, so that anything which reads saved subhalos can be
+    run without the Illustris API. Each subhalo is converted from a cutout
+    from :func:`synthetic_cutout` and saved by the same functions as in
+    :func:`data_read_utils.save_halos`. Subhalo i is drawn with seed
+    :param:`seed` + i, so the same subhalos are written for the same
+    arguments
+
+    Parameters
+    ----------
+    :param save_loc: The directory in which to save the subhalos, which is
+    created if needed
+    :type save_loc: str
+    :param n_halos: The number of subhalos, which have IDs 0 to
+    :param:`n_halos` - 1
+    :type n_halos: int
+    :param n_part: The number of star and gas particles in each subhalo
+    :type n_part: int
+    :param gas_frac: The fraction of the particles that are gas. Default 0.5
+    :type gas_frac: float, optional
+    :param seed: The seed for the first subhalo. Default 0
+    :type seed: int, optional
+    :param store: If True, save the subhalos in a consolidated store rather
+    than one file each. Default False
+    :type store: bool, optional
+    :param sort_radius: If True, save the particles sorted by radius with
+    the enclosed mass. Default False
+    :type sort_radius: bool, optional
+    :param float32: If True, save the radii, masses, and speeds in single
+    precision. Default False
+    :type float32: bool, optional
+    :param simulation: The simulation name used in the file names. Default
+    'Illustris-1'
+    :type simulation: str, optional
+    :param label: The snapshot label used in the file names. Default 'z=0.0'
+    :type label: str, optional
+    :param kwargs: Any other parameters for :func:`synthetic_halo`
+
+    Returns
+    -------
+    :return list_file: The path to the list file, or to the consolidated
+    store if :param:`store` is True
+    :rtype list_file: str
+    """
+    if not os.path.isdir(save_loc):
+        os.makedirs(save_loc)
+    part_types = data_read_utils.default_part_types
+    options = data_read_utils._ingest_options(sort_radius, part_types, float32)
+    manifest_loc = os.path.join(save_loc, data_read_utils.manifest_name)
+    fname_base = "{}_{}_subhalo{{}}.pickle.gz".format(simulation, label)
+    halo_store = None
+    if store:
+        halo_store = data_read_utils._open_halo_store(
+            save_loc, simulation, label, options, sort_radius, float32)
+    # The subhalos are at rest at the origin, so the particles keep the
+    # radii and speeds they were drawn with
+    sub = dict(("{}_{}".format(kind, ax), 0.0) for kind in ["pos", "vel"]
+               for ax in "xyz")
+    file_list = []
+    r_min = []
+    r_max = []
+    for i in range(n_halos):
+        cutout, _ = synthetic_cutout(n_part, gas_frac, seed + i, sub=sub,
+                                     **kwargs)
+        with h5py.File(cutout, "r") as f:
+            df = pd.DataFrame.from_dict(data_read_utils._particle_table(
+                f, sub, 1.0, part_types, float32))
+        filei, df = data_read_utils._write_halo(i, df, save_loc, fname_base,
+                                                sort_radius, halo_store)
+        record = data_read_utils._done_record(i, filei, df, options,
+                                              part_types)
+        data_read_utils._append_manifest(manifest_loc, record)
+        file_list.append(filei)
+        r_min.append(record["r_min"])
+        r_max.append(record["r_max"])
+    if store:
+        halo_store.close()
+        return halo_store.store_loc
+    return data_read_utils._write_list_file(save_loc, simulation, label,
+                                            file_list, r_min, r_max,
+                                            sort_radius)
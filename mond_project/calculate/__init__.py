@@ -1,4 +1,20 @@
 from .._version import __version__, __version_info__
 version = __version__
 
-from .calc_accel import calc_gbar, calc_gobs
+from .._lazy import attach
+
+# The module holding each export, which is imported on first use
+_exports = {
+    "calc_gbar"          :"calc_accel",
+    "calc_gobs"          :"calc_accel",
+    "calc_gobs_profile"  :"calc_accel",
+    "calc_rar"           :"calc_accel",
+    "clear_halo_cache"   :"halo_cache",
+    "halo_cache_stats"   :"halo_cache",
+    "load_halo"          :"halo_cache",
+    "set_halo_cache_size":"halo_cache",
+    "StackAccumulator"   :"stacking",
+    "stack_halos"        :"stacking",
+    "stack_rar"          :"stacking"}
+_submodules = ("calc_accel", "halo_cache", "stacking")
+attach(__name__, globals(), _exports, _submodules)
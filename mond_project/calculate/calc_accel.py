@@ -1,8 +1,14 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
 import os
+import time
 import numpy as np
 import pandas as pd
+from .halo_cache import load_halo
+from ..data_utils import halo_profiles, halo_store, instrumentation
 
 
 # Gravitational constant in units of km^2 kpc / M_sun s^2
@@ -49,38 +55,31 @@ def _get_subhalo_fbase(file_list):
     return base
 
 
-def calc_gobs(r, delta_r, list_file_loc, subhalo_id=None):
-    """Calculate the observed gravitational acceleration, :math:`g_{obs}(r) =
-    \frac{V_{obs}^2(r)}{r}`
+def _get_bins(r, delta_r):
+    """A private function to be used behind the scenes for getting the edges
+    of the radial bins given the bin centers and sizes
 
     Parameters
     ----------
-    :param r: Radius/radii at which to calculate the acceleration
+    :param r: Radius/radii at the center of the bins
     :type r: scalar or 1D array-like float
-    :param delta_r: Radial bin size(s), for averaging. Accelerations for
-    particles within :math:`r \pm 0.5 \cdot delta\_r` are averaged together
-    for a given radius r. Note that :param:`delta_r` must be scalar if
-    :param:`r` is scalar, can be scalar if using the same width for each bin
-    when :param:`r` is array-like, but must be same size as :param:`r` if not
-    scalar
+    :param delta_r: Radial bin size(s), either scalar or the same size as
+    :param:`r`
     :type delta_r: scalar or 1D array-like float
-    :param list_file_loc: Location of the list file for the simulation and
-    snapshot being used
-    :type list_file_loc: str
-    :param subhalo_id: ID(s) of subhalos within snapshot for which to
-    calculate, or None to calculate for all subhalos. Default None
-    :type subhalo_id: scalar or 1D array-like int, optional
 
     Returns
     -------
-    :return gobs: The observed gravitational acceleration for each halo
-    averaged in each radial bin
-    :rtype gobs: pandas DataFrame
+    :return r: The bin centers
+    :rtype r: 1D array float
+    :return r_low: The lower edge of each bin
+    :rtype r_low: 1D array float
+    :return r_upp: The upper edge of each bin
+    :rtype r_upp: 1D array float
     """
     r = np.atleast_1d(r)
     if r.ndim > 1:
         r = r.flatten()
-    if hasattr(delta_r, "len"):
+    if hasattr(delta_r, "__len__"):
         delta_r = np.atleast_1d(delta_r)
         if delta_r.ndim > 1:
             delta_r = delta_r.flatten()
@@ -89,10 +88,49 @@ def calc_gobs(r, delta_r, list_file_loc, subhalo_id=None):
                 "Non-constant bin sizes must have same length as bin centers")
     r_low = r.copy() - 0.5 * delta_r
     r_upp = r.copy() + 0.5 * delta_r
+    return r, r_low, r_upp
+
+
+def _get_halo_sources(list_file_loc, subhalo_id=None):
+    """A private function to be used behind the scenes for getting the IDs
+    of the requested subhalos and where to read each of them from, given
+    either a list file or a consolidated store
 
-    snap_dir = os.path.dirname(list_file_loc)
-    file_list = np.load(list_file_loc)["arr_0"]
-    saved_ids = _get_subhalo_ids(file_list)
+    Parameters
+    ----------
+    :param list_file_loc: Location of the list file or consolidated store for
+    the simulation and snapshot being used
+    :type list_file_loc: str
+    :param subhalo_id: ID(s) of subhalos within snapshot, or None for all
+    subhalos. Default None
+    :type subhalo_id: scalar or 1D array-like int, optional
+
+    Returns
+    -------
+    :return subhalo_id: The requested subhalo IDs
+    :rtype subhalo_id: 1D array int
+    :return sources: For each subhalo in :param:`subhalo_id`, in the same
+    order, a dict with its ID ('id'), either the path to its file ('path') or
+    the store location ('store'), whether its particles are sorted by radius
+    ('sorted'), and its minimum and maximum particle radius
+    ('r_min' and 'r_max') if known
+    :rtype sources: list of dict
+    """
+    if halo_store.is_store(list_file_loc):
+        store = halo_store.open_store(list_file_loc)
+        saved_ids = store.ids
+        r_min, r_max = store.r_min, store.r_max
+        is_sorted = store.sorted
+    else:
+        snap_dir = os.path.dirname(list_file_loc)
+        list_file = np.load(list_file_loc)
+        file_list = list_file["arr_0"]
+        saved_ids = _get_subhalo_ids(file_list)
+        if "r_min" in list_file:
+            r_min, r_max = list_file["r_min"], list_file["r_max"]
+        else:
+            r_min = r_max = np.full(saved_ids.size, np.nan)
+        is_sorted = "sorted" in list_file and bool(list_file["sorted"])
     if subhalo_id is not None:
         subhalo_id = np.atleast_1d(subhalo_id)
         if subhalo_id.ndim > 1:
@@ -101,19 +139,671 @@ def calc_gobs(r, delta_r, list_file_loc, subhalo_id=None):
             raise ValueError("One or more requested subhalos not found")
     else:
         subhalo_id = saved_ids
-    gobs = pd.DataFrame(index=pd.Index(r, name="r"),
-                        columns=pd.Index(subhalo_id, name="ID"))
-    use_files = file_list[np.isin(saved_ids, subhalo_id)]
-    for id, filei in zip(subhalo_id, use_files):
-        shdf = pd.read_pickle(os.path.join(snap_dir, filei))
-        for ri, rli, rui in zip(r, r_low, r_upp):
-            shdfi = shdf.query("(r >= {}) & (r < {})".format(rli, rui))
-            gobs[id].loc[ri] = ((shdfi["v"]**2)/(shdfi["r"])).mean()
-        print('Finished Halo ' + str(id), end = '\r')
+    order = np.argsort(saved_ids, kind="mergesort")
+    idx = order[np.searchsorted(saved_ids[order], subhalo_id)]
+    sources = [{"id":id, "sorted":is_sorted, "r_min":r_min[i],
+                "r_max":r_max[i]} for (i, id) in zip(idx, subhalo_id)]
+    if halo_store.is_store(list_file_loc):
+        store_loc = os.path.abspath(list_file_loc)
+        for source in sources:
+            source.update(store=store_loc)
+    else:
+        for source, i in zip(sources, idx):
+            source.update(path=os.path.join(snap_dir, file_list[i]))
+    return subhalo_id, sources
+
+
+def _read_halo(source, columns, part_types=None):
+    """A private function to be used behind the scenes for reading the
+    needed columns of a single subhalo, optionally keeping only particles of
+    some types. Types are selected by their integer codes, so the names are
+    only converted once per subhalo (or not at all for a consolidated store)
+
+    Parameters
+    ----------
+    :param source: Where to read the subhalo from, as from
+    :func:`_get_halo_sources`
+    :type source: dict
+    :param columns: The names of the columns to read
+    :type columns: list of str
+    :param part_types: The integer codes of the particle types to keep, or
+    None to keep every particle. Default None
+    :type part_types: 1D array int8, optional
+
+    Returns
+    -------
+    :return data: The array for each requested column
+    :rtype data: dict
+    """
+    read_columns = list(columns)
+    if part_types is not None and "type" not in read_columns:
+        read_columns.append("type")
+    with instrumentation.timed("load"):
+        if "store" in source:
+            data = halo_store.open_store(source["store"]).read(source["id"],
+                                                               read_columns)
+        else:
+            shdf = load_halo(source["path"])
+            data = dict((col, shdf[col].values) for col in read_columns)
+        if part_types is not None:
+            keep = np.isin(halo_store.encode_types(data["type"]), part_types)
+            data = dict((col, np.asarray(data[col])[keep]) for col in columns)
+    instrumentation.note(n_part=len(data["r"]))
+    return data
+
+
+def _check_part_types(part_types):
+    """A private function to be used behind the scenes for converting the
+    particle types to use in a calculation to their integer codes
+
+    Parameters
+    ----------
+    :param part_types: The name(s) of the particle types to use, out of
+    'gas', 'dm', and 'star', or None to use every saved particle
+    :type part_types: str or list of str or None
+
+    Returns
+    -------
+    :return part_types: The integer codes of the particle types, or None for
+    every particle
+    :rtype part_types: 1D array int8 or None
+    """
+    if part_types is None:
+        return None
+    part_types = np.atleast_1d(part_types)
+    if part_types.size == 0:
+        raise ValueError("At least one particle type must be used")
+    return np.unique(halo_store.encode_types(part_types))
+
+
+def _check_bin_edges(bin_edges):
+    """A private function to be used behind the scenes for validating a set
+    of contiguous radial bin edges
+
+    Parameters
+    ----------
+    :param bin_edges: The edges of the radial bins
+    :type bin_edges: 1D array-like float
+
+    Returns
+    -------
+    :return bin_edges: The bin edges as a flattened float array
+    :rtype bin_edges: 1D array float
+    """
+    bin_edges = np.asarray(bin_edges, dtype=float).flatten()
+    if bin_edges.size < 2:
+        raise ValueError("At least two bin edges are needed")
+    if not np.all(np.diff(bin_edges) > 0):
+        raise ValueError("Bin edges must be strictly increasing")
+    return bin_edges
+
+
+def _gobs_binned(r, v, bin_edges):
+    """A private function to be used behind the scenes for calculating the
+    observed acceleration of a single halo in every radial bin in a single
+    pass, by finding the bin of each particle and summing with
+    :func:`numpy.bincount`
+
+    Parameters
+    ----------
+    :param r: Radii of the particles
+    :type r: 1D array-like float
+    :param v: Speeds of the particles, in the same order as :param:`r`
+    :type v: 1D array-like float
+    :param bin_edges: The strictly increasing edges of the radial bins. Bins
+    include their lower edge but not their upper edge
+    :type bin_edges: 1D array float
+
+    Returns
+    -------
+    :return gobs: The observed acceleration averaged in each radial bin, or
+    NaN for bins containing no particles
+    :rtype gobs: 1D array float
+    """
+    r = np.asarray(r, dtype=float)
+    v = np.asarray(v, dtype=float)
+    n_bins = bin_edges.size - 1
+    idx = np.searchsorted(bin_edges, r, side="right") - 1
+    in_bins = (idx >= 0) & (idx < n_bins)
+    idx = idx[in_bins]
+    counts = np.bincount(idx, minlength=n_bins)
+    sums = np.bincount(idx, weights=v[in_bins]**2 / r[in_bins],
+                       minlength=n_bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gobs = sums / counts
+    gobs[counts == 0] = np.nan
     return gobs
 
 
-def calc_gbar(r, delta_r, list_file_loc, subhalo_id=None):
+def _suffix_sums(values):
+    """A private function to be used behind the scenes for getting the sums of
+    all elements at or after each position of an array, with an extra zero at
+    the end. Sums are accumulated from the end so that, for values sorted by
+    increasing radius, the large inner values (such as :math:`1 / r^2`) do
+    not swamp the smaller outer ones when differences are taken
+
+    Parameters
+    ----------
+    :param values: The values to sum
+    :type values: 1D array-like float
+
+    Returns
+    -------
+    :return sums: The suffix sums, such that `sums[i] - sums[j]` is the sum of
+    `values[i:j]`
+    :rtype sums: 1D array float, of size `values.size + 1`
+    """
+    values = np.asarray(values, dtype=float)
+    sums = np.zeros(values.size + 1)
+    sums[:-1] = np.cumsum(values[::-1])[::-1]
+    return sums
+
+
+def _suffix_sums_2d(values):
+    """A private function to be used behind the scenes for getting the suffix
+    sums along each row of a 2D array, as :func:`_suffix_sums` does for a
+    single array
+
+    Parameters
+    ----------
+    :param values: The values to sum, with one row per halo
+    :type values: 2D array-like float
+
+    Returns
+    -------
+    :return sums: The suffix sums of each row, with an extra column of zeros
+    :rtype sums: 2D array float
+    """
+    values = np.asarray(values, dtype=float)
+    sums = np.zeros((values.shape[0], values.shape[1] + 1))
+    sums[:, :-1] = np.cumsum(values[:, ::-1], axis=1)[:, ::-1]
+    return sums
+
+
+def _bin_indices(r_sorted, r_low, r_upp):
+    """A private function to be used behind the scenes for finding the range
+    of sorted particles in each radial bin
+
+    Parameters
+    ----------
+    :param r_sorted: Radii of the particles, sorted in increasing order
+    :type r_sorted: 1D array-like float
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array-like float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array-like float
+
+    Returns
+    -------
+    :return i_low: Index of the first particle in each bin
+    :rtype i_low: 1D array int
+    :return i_upp: Index after the last particle in each bin
+    :rtype i_upp: 1D array int
+    :return start: Index of the first particle in any bin
+    :rtype start: int
+    :return stop: Index after the last particle in any bin
+    :rtype stop: int
+    """
+    i_low = np.searchsorted(r_sorted, r_low, side="left")
+    i_upp = np.searchsorted(r_sorted, r_upp, side="left")
+    return i_low, i_upp, i_low.min(), max(i_upp.max(), i_low.max())
+
+
+def _gobs_sorted(r_sorted, v_sorted, r_low, r_upp):
+    """A private function to be used behind the scenes for calculating the
+    observed acceleration of a single halo in every radial bin at once, using
+    binary searches on the sorted radii and suffix sums of :math:`v^2 / r`.
+    Only the particles between the first and last bins are used. Unlike
+    :func:`_gobs_binned`, the bins may overlap or leave gaps
+
+    Parameters
+    ----------
+    :param r_sorted: Radii of the particles, sorted in increasing order
+    :type r_sorted: 1D array-like float
+    :param v_sorted: Speeds of the particles, in the same order as
+    :param:`r_sorted`
+    :type v_sorted: 1D array-like float
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array-like float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array-like float
+
+    Returns
+    -------
+    :return gobs: The observed acceleration averaged in each radial bin, or
+    NaN for bins containing no particles
+    :rtype gobs: 1D array float
+    """
+    i_low, i_upp, start, stop = _bin_indices(r_sorted, r_low, r_upp)
+    r_use = np.asarray(r_sorted[start:stop], dtype=float)
+    v_use = np.asarray(v_sorted[start:stop], dtype=float)
+    gobs_sums = _suffix_sums(v_use**2 / r_use)
+    n_in_bin = i_upp - i_low
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gobs = (gobs_sums[i_low - start] - gobs_sums[i_upp - start]) / n_in_bin
+    gobs[n_in_bin <= 0] = np.nan
+    return gobs
+
+
+def _gbar_sorted(r_sorted, m_sorted, r_low, r_upp, m_enc=None):
+    """A private function to be used behind the scenes for calculating the
+    baryonic acceleration of a single halo in every radial bin at once. The
+    enclosed mass at the lower edge of each bin is read from a cumulative mass
+    array, and the mean of :math:`1 / r^2` within each bin from suffix sums,
+    using binary searches on the sorted radii rather than a scan per bin
+
+    Parameters
+    ----------
+    :param r_sorted: Radii of the particles, sorted in increasing order
+    :type r_sorted: 1D array-like float
+    :param m_sorted: Masses of the particles, in the same order as
+    :param:`r_sorted`. Not used if :param:`m_enc` is given
+    :type m_sorted: 1D array-like float or None
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array-like float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array-like float
+    :param m_enc: The mass enclosed within the radius of each particle,
+    including the particle itself, as saved for halos sorted by radius. If
+    given, only the particles within the bins are used. Default None
+    :type m_enc: 1D array-like float, optional
+
+    Returns
+    -------
+    :return gbar: The baryonic acceleration averaged in each radial bin, or
+    NaN for bins containing no particles
+    :rtype gbar: 1D array float
+    """
+    i_low, i_upp, start, stop = _bin_indices(r_sorted, r_low, r_upp)
+    if m_enc is None:
+        cum_mass = np.zeros(stop + 1)
+        np.cumsum(m_sorted[:stop], dtype=float, out=cum_mass[1:])
+        m_in = cum_mass[i_low]
+    else:
+        m_in = np.where(i_low > 0, np.asarray(m_enc)[
+            np.clip(i_low - 1, 0, len(m_enc) - 1)], 0.0)
+    r_use = np.asarray(r_sorted[start:stop], dtype=float)
+    inv_r2_sums = _suffix_sums(r_use**-2)
+    n_in_bin = i_upp - i_low
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_inv_r2 = (inv_r2_sums[i_low - start] -
+                       inv_r2_sums[i_upp - start]) / n_in_bin
+    gbar = grav_constant * m_in * mean_inv_r2
+    gbar[n_in_bin <= 0] = np.nan
+    return gbar
+
+
+def _halo_accels(source, r_low, r_upp, gobs=True, gbar=True,
+                 part_types=None):
+    """A private function to be used behind the scenes for calculating the
+    observed and/or baryonic acceleration of a single halo in every radial
+    bin. Bins outside of the radial extent of the halo are NaN without
+    reading the particles, and halos already sorted by radius are not sorted
+    again
+
+    Parameters
+    ----------
+    :param source: Where to read the subhalo from, as from
+    :func:`_get_halo_sources`
+    :type source: dict
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array float
+    :param gobs: Whether to calculate the observed acceleration. Default True
+    :type gobs: bool, optional
+    :param gbar: Whether to calculate the baryonic acceleration. Default True
+    :type gbar: bool, optional
+    :param part_types: The integer codes of the particle types to use, or
+    None to use every particle. Default None
+    :type part_types: 1D array int8, optional
+
+    Returns
+    -------
+    :return gobs: The observed acceleration in each bin, or None if not
+    calculated
+    :rtype gobs: 1D array float or None
+    :return gbar: The baryonic acceleration in each bin, or None if not
+    calculated
+    :rtype gbar: 1D array float or None
+    """
+    gobs_h = np.full(r_low.size, np.nan) if gobs else None
+    gbar_h = np.full(r_low.size, np.nan) if gbar else None
+    # NaN extents (unknown) compare False, so every bin is used
+    use = ~((r_upp <= source["r_min"]) | (r_low > source["r_max"]))
+    if not use.any():
+        return gobs_h, gbar_h
+    columns = ["r"]
+    if gobs:
+        columns.append("v")
+    if gbar:
+        # The saved enclosed mass includes every particle type
+        columns.append("M_enc" if source["sorted"] and part_types is None
+                       else "M")
+    data = _read_halo(source, columns, part_types)
+    if data["r"].size == 0:
+        return gobs_h, gbar_h
+    with instrumentation.timed("bin"):
+        if source["sorted"]:
+            data_sorted = data
+        else:
+            order = np.argsort(data["r"], kind="mergesort")
+            data_sorted = dict((col, data[col][order]) for col in columns)
+        if gobs:
+            gobs_h[use] = _gobs_sorted(data_sorted["r"], data_sorted["v"],
+                                       r_low[use], r_upp[use])
+        if gbar:
+            gbar_h[use] = _gbar_sorted(data_sorted["r"], data_sorted.get("M"),
+                                       r_low[use], r_upp[use],
+                                       m_enc=data_sorted.get("M_enc"))
+    return gobs_h, gbar_h
+
+
+def _halo_profile(source, bin_edges, part_types=None):
+    """A private function to be used behind the scenes for calculating the
+    observed acceleration of a single halo in contiguous radial bins, as for
+    :func:`calc_gobs_profile`
+
+    Parameters
+    ----------
+    :param source: Where to read the subhalo from, as from
+    :func:`_get_halo_sources`
+    :type source: dict
+    :param bin_edges: The strictly increasing edges of the radial bins
+    :type bin_edges: 1D array float
+    :param part_types: The integer codes of the particle types to use, or
+    None to use every particle. Default None
+    :type part_types: 1D array int8, optional
+
+    Returns
+    -------
+    :return gobs: The observed acceleration in each bin
+    :rtype gobs: 1D array float
+    """
+    if source["sorted"]:
+        return _halo_accels(source, bin_edges[:-1], bin_edges[1:],
+                            gbar=False, part_types=part_types)[0]
+    data = _read_halo(source, ["r", "v"], part_types)
+    with instrumentation.timed("bin"):
+        return _gobs_binned(data["r"], data["v"], bin_edges)
+
+
+def _profile_accels(list_file_loc, subhalo_id, r_low, r_upp, gobs=True,
+                    gbar=True):
+    """A private function to be used behind the scenes for calculating the
+    observed and/or baryonic acceleration of every halo from the profiles
+    saved on a base grid, without reading any particles. This is only
+    possible if profiles were saved for every requested halo on a grid with
+    an edge at every bin edge
+
+    Parameters
+    ----------
+    :param list_file_loc: Location of the list file or consolidated store
+    for the simulation and snapshot being used
+    :type list_file_loc: str
+    :param subhalo_id: The requested subhalo IDs
+    :type subhalo_id: 1D array int
+    :param r_low: Lower edge(s) of the radial bins (inclusive)
+    :type r_low: 1D array float
+    :param r_upp: Upper edge(s) of the radial bins (exclusive)
+    :type r_upp: 1D array float
+    :param gobs: Whether to calculate the observed acceleration. Default True
+    :type gobs: bool, optional
+    :param gbar: Whether to calculate the baryonic acceleration. Default True
+    :type gbar: bool, optional
+
+    Returns
+    -------
+    :return results: For each halo, the observed and baryonic acceleration in
+    each bin as from :func:`_halo_accels`, or None if the bins can't be
+    calculated from the profiles
+    :rtype results: list of tuple or None
+    """
+    for (_, store) in sorted(halo_profiles.open_profiles(
+            list_file_loc).items()):
+        i_low, i_upp = halo_profiles.align_bins(store.edges, r_low, r_upp)
+        if i_low is None or not np.all(np.isin(subhalo_id, store.ids)):
+            continue
+        start, stop = i_low.min(), i_upp.max()
+        columns = ["count"]
+        if gobs:
+            columns.append("sum_v2_r")
+        if gbar:
+            columns += ["sum_inv_r2", "m_enc"]
+        with instrumentation.timed("load"):
+            profiles = store.read(subhalo_id, columns, start, stop)
+        with instrumentation.timed("bin"):
+            i_low = i_low - start
+            i_upp = i_upp - start
+            counts = np.zeros((subhalo_id.size, stop - start + 1),
+                              dtype=np.int64)
+            np.cumsum(profiles["count"], axis=1, out=counts[:, 1:])
+            n_in_bin = counts[:, i_upp] - counts[:, i_low]
+            gobs_h = gbar_h = None
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if gobs:
+                    sums = _suffix_sums_2d(profiles["sum_v2_r"])
+                    gobs_h = (sums[:, i_low] - sums[:, i_upp]) / n_in_bin
+                    gobs_h[n_in_bin <= 0] = np.nan
+                if gbar:
+                    sums = _suffix_sums_2d(profiles["sum_inv_r2"])
+                    gbar_h = (grav_constant * profiles["m_enc"][:, i_low] *
+                              (sums[:, i_low] - sums[:, i_upp]) / n_in_bin)
+                    gbar_h[n_in_bin <= 0] = np.nan
+        return [(None if gobs_h is None else gobs_h[i],
+                 None if gbar_h is None else gbar_h[i]) for i in
+                range(subhalo_id.size)]
+    return None
+
+
+def _timed_halo(source, func, task):
+    """A private function to be used behind the scenes for applying a
+    calculation to a single subhalo while recording the time spent loading
+    and binning it, in whichever process it runs
+
+    Parameters
+    ----------
+    :param source: Where to read the subhalo from, as from
+    :func:`_get_halo_sources`
+    :type source: dict
+    :param func: The calculation for a single subhalo
+    :type func: callable
+    :param task: The name of the calc function, for the record
+    :type task: str
+
+    Returns
+    -------
+    :return result: The result of :param:`func` for the subhalo
+    :rtype result: tuple or 1D array float
+    :return record: The record of the subhalo, to be finished with
+    :func:`instrumentation.finish_record` by the caller
+    :rtype record: dict
+    """
+    record = instrumentation.new_record(task, source["id"], force=True)
+    with instrumentation.activate(record):
+        result = func(source)
+    record["elapsed"] = time.time() - record["start"]
+    return result, record
+
+
+def _finish_halos(results):
+    """A private function to be used behind the scenes for finishing the
+    records of subhalos from :func:`_timed_halo` as their results are used
+
+    Parameters
+    ----------
+    :param results: The result and record of each subhalo
+    :type results: iterable of tuple
+
+    Returns
+    -------
+    :return results: The result of each subhalo
+    :rtype results: generator
+    """
+    for (result, record) in results:
+        instrumentation.finish_record(record)
+        yield result
+
+
+def _map_halos(func, sources, n_jobs=1, executor=None, task=None):
+    """A private function to be used behind the scenes for applying a
+    calculation to each subhalo, either in this process or spread over
+    several. Only the small dicts saying where to read each subhalo are sent
+    to the workers, which read the particles themselves. If instrumentation
+    is enabled, each subhalo is recorded (see
+    :func:`instrumentation.configure_instrumentation`)
+
+    Parameters
+    ----------
+    :param func: The calculation for a single subhalo, which must be
+    picklable (i.e. a module level function or a partial of one) to run in
+    other processes
+    :type func: callable
+    :param sources: Where to read each subhalo from, as from
+    :func:`_get_halo_sources`
+    :type sources: list of dict
+    :param n_jobs: The number of processes to use, or -1 or None for one per
+    CPU. Ignored if :param:`executor` is given. Default 1
+    :type n_jobs: int or None, optional
+    :param executor: An executor to run the calculations in, such as a
+    :class:`concurrent.futures.ProcessPoolExecutor` that is reused between
+    calls. Default None
+    :type executor: :class:`concurrent.futures.Executor`, optional
+    :param task: The name of the calc function, for the records of the
+    subhalos. Default None
+    :type task: str, optional
+
+    Returns
+    -------
+    :return results: The result of :param:`func` for each subhalo, in the same
+    order as :param:`sources`
+    :rtype results: iterable
+    """
+    timing = instrumentation.is_enabled()
+    if timing:
+        func = partial(_timed_halo, func=func, task=task)
+    if executor is not None:
+        results = executor.map(func, sources)
+    else:
+        if n_jobs is None or n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+        if n_jobs < 1:
+            raise ValueError("n_jobs must be at least 1, or -1 for all CPUs")
+        n_jobs = min(n_jobs, len(sources))
+        if n_jobs <= 1:
+            results = map(func, sources)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(func, sources, chunksize=max(
+                    1, len(sources) // (4 * n_jobs))))
+    return _finish_halos(results) if timing else results
+
+
+def _accel_result(accel, r, subhalo_id, as_array=False):
+    """A private function to be used behind the scenes for returning the
+    accelerations of a set of halos, either wrapped in a DataFrame or as the
+    raw array with the radii and IDs
+
+    Parameters
+    ----------
+    :param accel: The accelerations, with one row per radial bin and one
+    column per halo
+    :type accel: 2D array float
+    :param r: The radius of each bin
+    :type r: 1D array float
+    :param subhalo_id: The ID of each halo
+    :type subhalo_id: 1D array int
+    :param as_array: If True, return the array, radii, and IDs instead of a
+    DataFrame. Default False
+    :type as_array: bool, optional
+
+    Returns
+    -------
+    :return accel: The accelerations, indexed by radius with a column for
+    each halo, or the tuple (accel, r, subhalo_id) if :param:`as_array`
+    :rtype accel: pandas DataFrame or tuple
+    """
+    if as_array:
+        return accel, r, subhalo_id
+    return pd.DataFrame(accel, index=pd.Index(r, name="r"),
+                        columns=pd.Index(subhalo_id, name="ID"), copy=False)
+
+
+def calc_gobs(r, delta_r, list_file_loc, subhalo_id=None, n_jobs=1,
+              executor=None, use_profiles=True, as_array=False,
+              part_types=None):
+    """Calculate the observed gravitational acceleration, :math:`g_{obs}(r) =
+    \frac{V_{obs}^2(r)}{r}`
+
+    Parameters
+    ----------
+    :param r: Radius/radii at which to calculate the acceleration
+    :type r: scalar or 1D array-like float
+    :param delta_r: Radial bin size(s), for averaging. Accelerations for
+    particles within :math:`r \pm 0.5 \cdot delta\_r` are averaged together
+    for a given radius r. Note that :param:`delta_r` must be scalar if
+    :param:`r` is scalar, can be scalar if using the same width for each bin
+    when :param:`r` is array-like, but must be same size as :param:`r` if not
+    scalar
+    :type delta_r: scalar or 1D array-like float
+    :param list_file_loc: Location of the list file or consolidated store
+    for the simulation and snapshot being used
+    :type list_file_loc: str
+    :param subhalo_id: ID(s) of subhalos within snapshot for which to
+    calculate, or None to calculate for all subhalos. Default None
+    :type subhalo_id: scalar or 1D array-like int, optional
+    :param n_jobs: The number of processes over which to spread the halos,
+    or -1 or None to use every CPU. The results are the same for any number
+    of processes. Default 1
+    :type n_jobs: int or None, optional
+    :param executor: An executor in which to run the calculation for each
+    halo instead, such as a :class:`concurrent.futures.ProcessPoolExecutor`
+    to reuse between calls. Default None
+    :type executor: :class:`concurrent.futures.Executor`, optional
+    :param use_profiles: If True and profiles were saved for every requested
+    halo on a base grid with an edge at every bin edge (see
+    :func:`data_read_utils.save_halos`), calculate from the profiles without
+    reading the particles. Profiles include every particle type, so they are
+    not used when :param:`part_types` is given. Default True
+    :type use_profiles: bool, optional
+    :param as_array: If True, return the accelerations as a float array with
+    the radii and subhalo IDs, rather than as a DataFrame. Default False
+    :type as_array: bool, optional
+    :param part_types: The name(s) of the particle types to use, e.g. 'gas'
+    or 'star' alone, or None to use every saved particle. Particles of other
+    types are left out of both accelerations. Default None
+    :type part_types: str or list of str, optional
+
+    Returns
+    -------
+    :return gobs: The observed gravitational acceleration for each halo
+    averaged in each radial bin, indexed by radius with a column for each
+    halo. If :param:`as_array`, the tuple (gobs, r, subhalo_id) of the
+    accelerations with one row per bin and one column per halo, the radii, and
+    the subhalo IDs
+    :rtype gobs: pandas DataFrame of float or tuple
+    """
+    r, r_low, r_upp = _get_bins(r, delta_r)
+    subhalo_id, sources = _get_halo_sources(list_file_loc, subhalo_id)
+    part_types = _check_part_types(part_types)
+    gobs = np.full((r.size, subhalo_id.size), np.nan)
+    results = None
+    if use_profiles and part_types is None:
+        results = _profile_accels(list_file_loc, subhalo_id, r_low, r_upp,
+                                   gbar=False)
+    if results is None:
+        results = _map_halos(partial(_halo_accels, r_low=r_low, r_upp=r_upp,
+                                     gbar=False, part_types=part_types),
+                             sources, n_jobs, executor, "calc_gobs")
+    for i, (id, (gobs_h, _)) in enumerate(zip(subhalo_id, results)):
+        gobs[:, i] = gobs_h
+        instrumentation.progress("calc_gobs", i + 1, subhalo_id.size, id)
+    return _accel_result(gobs, r, subhalo_id, as_array)
+
+
+def calc_gbar(r, delta_r, list_file_loc, subhalo_id=None, n_jobs=1,
+              executor=None, use_profiles=True, as_array=False,
+              part_types=None):
     """Calculate the baryonic gravitational acceleration, :math:`g_{bar}(r) =
     \frac{G M(<r)}{r^2}`
 
@@ -128,52 +818,207 @@ def calc_gbar(r, delta_r, list_file_loc, subhalo_id=None):
     when :param:`r` is array-like, but must be same size as :param:`r` if not
     scalar
     :type delta_r: scalar or 1D array-like float
-    :param list_file_loc: Location of the list file for the simulation and
-    snapshot being used
+    :param list_file_loc: Location of the list file or consolidated store
+    for the simulation and snapshot being used
     :type list_file_loc: str
     :param subhalo_id: ID(s) of subhalos within snapshot for which to
     calculate, or None to calculate for all subhalos. Default None
     :type subhalo_id: scalar or 1D array-like int, optional
+    :param n_jobs: The number of processes over which to spread the halos,
+    or -1 or None to use every CPU. The results are the same for any number
+    of processes. Default 1
+    :type n_jobs: int or None, optional
+    :param executor: An executor in which to run the calculation for each
+    halo instead, such as a :class:`concurrent.futures.ProcessPoolExecutor`
+    to reuse between calls. Default None
+    :type executor: :class:`concurrent.futures.Executor`, optional
+    :param use_profiles: If True and profiles were saved for every requested
+    halo on a base grid with an edge at every bin edge (see
+    :func:`data_read_utils.save_halos`), calculate from the profiles without
+    reading the particles. Profiles include every particle type, so they are
+    not used when :param:`part_types` is given. Default True
+    :type use_profiles: bool, optional
+    :param as_array: If True, return the accelerations as a float array with
+    the radii and subhalo IDs, rather than as a DataFrame. Default False
+    :type as_array: bool, optional
+    :param part_types: The name(s) of the particle types to use, e.g. 'gas'
+    or 'star' alone, or None to use every saved particle. Particles of other
+    types are left out of both accelerations. Default None
+    :type part_types: str or list of str, optional
 
     Returns
     -------
     :return gbar: The baryonic gravitational acceleration for each halo
-    averaged in each radial bin
-    :rtype gbar: pandas DataFrame
+    averaged in each radial bin, indexed by radius with a column for each
+    halo. If :param:`as_array`, the tuple (gbar, r, subhalo_id) of the
+    accelerations with one row per bin and one column per halo, the radii, and
+    the subhalo IDs
+    :rtype gbar: pandas DataFrame of float or tuple
     """
-    r = np.atleast_1d(r)
-    if r.ndim > 1:
-        r = r.flatten()
-    if hasattr(delta_r, "len"):
-        delta_r = np.atleast_1d(delta_r)
-        if delta_r.ndim > 1:
-            delta_r = delta_r.flatten()
-        if delta_r.size != r.size:
-            raise ValueError(
-                "Non-constant bin sizes must have same length as bin centers")
-    r_low = r.copy() - 0.5 * delta_r
-    r_upp = r.copy() + 0.5 * delta_r
+    r, r_low, r_upp = _get_bins(r, delta_r)
+    subhalo_id, sources = _get_halo_sources(list_file_loc, subhalo_id)
+    part_types = _check_part_types(part_types)
+    gbar = np.full((r.size, subhalo_id.size), np.nan)
+    results = None
+    if use_profiles and part_types is None:
+        results = _profile_accels(list_file_loc, subhalo_id, r_low, r_upp,
+                                   gobs=False)
+    if results is None:
+        results = _map_halos(partial(_halo_accels, r_low=r_low, r_upp=r_upp,
+                                     gobs=False, part_types=part_types),
+                             sources, n_jobs, executor, "calc_gbar")
+    for i, (id, (_, gbar_h)) in enumerate(zip(subhalo_id, results)):
+        gbar[:, i] = gbar_h
+        instrumentation.progress("calc_gbar", i + 1, subhalo_id.size, id)
+    return _accel_result(gbar, r, subhalo_id, as_array)
 
-    snap_dir = os.path.dirname(list_file_loc)
-    file_list = np.load(list_file_loc)["arr_0"]
-    saved_ids = _get_subhalo_ids(file_list)
-    if subhalo_id is not None:
-        subhalo_id = np.atleast_1d(subhalo_id)
-        if subhalo_id.ndim > 1:
-            subhalo_id = subhalo_id.flatten()
-        if not np.all(np.isin(subhalo_id, saved_ids)):
-            raise ValueError("One or more requested subhalos not found")
+
+def calc_gobs_profile(bin_edges, list_file_loc, subhalo_id=None, n_jobs=1,
+                      executor=None, use_profiles=True, as_array=False,
+                      part_types=None):
+    """Calculate the observed gravitational acceleration, :math:`g_{obs}(r) =
+    \\frac{V_{obs}^2(r)}{r}`, in a set of contiguous radial bins. This gives
+    the same result as :func:`calc_gobs` with bins centered between each pair
+    of edges, but all bins for a halo are found in a single pass over its
+    particles
+
+    Parameters
+    ----------
+    :param bin_edges: The edges of the radial bins, which must be strictly
+    increasing but may have variable widths. Accelerations for particles
+    within :math:`bin\\_edges[i] \\leq r < bin\\_edges[i + 1]` are averaged
+    together for bin i
+    :type bin_edges: 1D array-like float
+    :param list_file_loc: Location of the list file or consolidated store
+    for the simulation and snapshot being used
+    :type list_file_loc: str
+    :param subhalo_id: ID(s) of subhalos within snapshot for which to
+    calculate, or None to calculate for all subhalos. Default None
+    :type subhalo_id: scalar or 1D array-like int, optional
+    :param n_jobs: The number of processes over which to spread the halos,
+    or -1 or None to use every CPU. The results are the same for any number
+    of processes. Default 1
+    :type n_jobs: int or None, optional
+    :param executor: An executor in which to run the calculation for each
+    halo instead, such as a :class:`concurrent.futures.ProcessPoolExecutor`
+    to reuse between calls. Default None
+    :type executor: :class:`concurrent.futures.Executor`, optional
+    :param use_profiles: If True and profiles were saved for every requested
+    halo on a base grid with an edge at every bin edge (see
+    :func:`data_read_utils.save_halos`), calculate from the profiles without
+    reading the particles. Profiles include every particle type, so they are
+    not used when :param:`part_types` is given. Default True
+    :type use_profiles: bool, optional
+    :param as_array: If True, return the accelerations as a float array with
+    the radii and subhalo IDs, rather than as a DataFrame. Default False
+    :type as_array: bool, optional
+    :param part_types: The name(s) of the particle types to use, e.g. 'gas'
+    or 'star' alone, or None to use every saved particle. Particles of other
+    types are left out of both accelerations. Default None
+    :type part_types: str or list of str, optional
+
+    Returns
+    -------
+    :return gobs: The observed gravitational acceleration for each halo
+    averaged in each radial bin, indexed by the bin centers. If
+    :param:`as_array`, the tuple (gobs, r, subhalo_id) of the accelerations
+    with one row per bin and one column per halo, the bin centers, and the
+    subhalo IDs
+    :rtype gobs: pandas DataFrame of float or tuple
+    """
+    bin_edges = _check_bin_edges(bin_edges)
+    r = 0.5 * (bin_edges[:-1] + bin_edges[1:])
+    subhalo_id, sources = _get_halo_sources(list_file_loc, subhalo_id)
+    part_types = _check_part_types(part_types)
+    gobs = np.full((r.size, subhalo_id.size), np.nan)
+    results = None
+    if use_profiles and part_types is None:
+        results = _profile_accels(list_file_loc, subhalo_id,
+                                   bin_edges[:-1], bin_edges[1:],
+                                   gbar=False)
+    if results is not None:
+        results = [gobs_h for (gobs_h, _) in results]
     else:
-        subhalo_id = saved_ids
-    gbar = pd.DataFrame(index=pd.Index(r, name="r"),
-                        columns=pd.Index(subhalo_id, name="ID"))
-    use_files = file_list[np.isin(saved_ids, subhalo_id)]
-    for id, filei in zip(subhalo_id, use_files):
-        shdf = pd.read_pickle(os.path.join(snap_dir, filei))
-        for ri, rli, rui in zip(r, r_low, r_upp):
-            shdf_in = shdf.query("r < {}".format(rli))
-            m_in = shdf_in["M"].sum()
-            shdfi = shdf.query("(r >= {}) & (r < {})".format(rli, rui))
-            gbar[id].loc[ri] = (grav_constant * m_in / shdfi["r"].pow(2)).mean()
-        print('Finished Halo ' + str(id), end = '\r')
-    return gbar
+        results = _map_halos(partial(_halo_profile, bin_edges=bin_edges,
+                                     part_types=part_types),
+                             sources, n_jobs, executor, "calc_gobs_profile")
+    for i, (id, gobs_h) in enumerate(zip(subhalo_id, results)):
+        gobs[:, i] = gobs_h
+        instrumentation.progress("calc_gobs_profile", i + 1, subhalo_id.size,
+                                 id)
+    return _accel_result(gobs, r, subhalo_id, as_array)
+
+
+def calc_rar(r, delta_r, list_file_loc, subhalo_id=None, n_jobs=1,
+             executor=None, use_profiles=True, part_types=None):
+    """Calculate the observed and baryonic gravitational accelerations
+    together, for the radial acceleration relation (RAR). Each halo is read
+    and sorted only once, and the results are the same as from
+    :func:`calc_gobs` and :func:`calc_gbar`
+
+    Parameters
+    ----------
+    :param r: Radius/radii at which to calculate the accelerations
+    :type r: scalar or 1D array-like float
+    :param delta_r: Radial bin size(s), for averaging, as in
+    :func:`calc_gobs` and :func:`calc_gbar`
+    :type delta_r: scalar or 1D array-like float
+    :param list_file_loc: Location of the list file or consolidated store
+    for the simulation and snapshot being used
+    :type list_file_loc: str
+    :param subhalo_id: ID(s) of subhalos within snapshot for which to
+    calculate, or None to calculate for all subhalos. Default None
+    :type subhalo_id: scalar or 1D array-like int, optional
+    :param n_jobs: The number of processes over which to spread the halos,
+    or -1 or None to use every CPU. The results are the same for any number
+    of processes. Default 1
+    :type n_jobs: int or None, optional
+    :param executor: An executor in which to run the calculation for each
+    halo instead, such as a :class:`concurrent.futures.ProcessPoolExecutor`
+    to reuse between calls. Default None
+    :type executor: :class:`concurrent.futures.Executor`, optional
+    :param use_profiles: If True and profiles were saved for every requested
+    halo on a base grid with an edge at every bin edge (see
+    :func:`data_read_utils.save_halos`), calculate from the profiles without
+    reading the particles. Profiles include every particle type, so they are
+    not used when :param:`part_types` is given. Default True
+    :type use_profiles: bool, optional
+    :param part_types: The name(s) of the particle types to use, e.g. 'gas'
+    or 'star' alone, or None to use every saved particle. Particles of other
+    types are left out of both accelerations. Default None
+    :type part_types: str or list of str, optional
+
+    Returns
+    -------
+    :return rar: The accelerations in tidy form, with one row per halo and
+    radius and columns 'ID', 'r', 'gobs', and 'gbar'. Rows are ordered by
+    halo and then by radius
+    :rtype rar: pandas DataFrame
+
+    Examples
+    --------
+    Averaging over halos at each radius is then a single group-by:
+
+    >>> rar = calc_rar(np.arange(1, 60), 1, list_file_loc)  # doctest: +SKIP
+    >>> rar.groupby("r")[["gobs", "gbar"]].mean()  # doctest: +SKIP
+    """
+    r, r_low, r_upp = _get_bins(r, delta_r)
+    subhalo_id, sources = _get_halo_sources(list_file_loc, subhalo_id)
+    part_types = _check_part_types(part_types)
+    gobs = np.full((subhalo_id.size, r.size), np.nan)
+    gbar = np.full((subhalo_id.size, r.size), np.nan)
+    results = None
+    if use_profiles and part_types is None:
+        results = _profile_accels(list_file_loc, subhalo_id, r_low, r_upp)
+    if results is None:
+        results = _map_halos(partial(_halo_accels, r_low=r_low, r_upp=r_upp,
+                                     part_types=part_types),
+                             sources, n_jobs, executor, "calc_rar")
+    for i, (id, (gobs_h, gbar_h)) in enumerate(zip(subhalo_id, results)):
+        gobs[i], gbar[i] = gobs_h, gbar_h
+        instrumentation.progress("calc_rar", i + 1, subhalo_id.size, id)
+    return pd.DataFrame.from_dict({
+        "ID"  :np.repeat(subhalo_id, r.size),
+        "r"   :np.tile(r, subhalo_id.size),
+        "gobs":gobs.ravel(),
+        "gbar":gbar.ravel()})[["ID", "r", "gobs", "gbar"]]
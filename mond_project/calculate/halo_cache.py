@@ -0,0 +1,133 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import OrderedDict
+import os
+import threading
+import pandas as pd
+
+
+# Default limit on the memory used by cached halo tables, in bytes
+default_cache_bytes = 2**30
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_info = {"hits":0, "misses":0, "bytes":0, "max_bytes":default_cache_bytes}
+
+
+def _table_bytes(df):
+    """A private function to be used behind the scenes for getting the memory
+    used by a halo table
+
+    Parameters
+    ----------
+    :param df: The halo table
+    :type df: pandas DataFrame
+
+    Returns
+    -------
+    :return nbytes: The number of bytes used by the table, including the
+    contents of any object columns
+    :rtype nbytes: int
+    """
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _evict(max_bytes):
+    """A private function to be used behind the scenes for removing the least
+    recently used tables until the cache fits within :param:`max_bytes`. The
+    cache lock must already be held
+
+    Parameters
+    ----------
+    :param max_bytes: The number of bytes the cache must fit within
+    :type max_bytes: int
+    """
+    while _cache and _cache_info["bytes"] > max_bytes:
+        _, (_, nbytes) = _cache.popitem(last=False)
+        _cache_info["bytes"] -= nbytes
+
+
+def load_halo(path):
+    """Read the table for a single subhalo as saved by
+    :func:`data_read_utils.save_halos`, using an in-memory cache shared by
+    the whole process. Tables are keyed by their absolute path and
+    modification time, so a file that is rewritten is read again. The least
+    recently used tables are dropped when the cache grows beyond the limit set
+    with :func:`set_halo_cache_size`, and tables larger than the limit are
+    never cached. The returned table may be shared with other callers, so it
+    must not be modified in place
+
+    Parameters
+    ----------
+    :param path: The path to the subhalo file
+    :type path: str
+
+    Returns
+    -------
+    :return df: The subhalo table
+    :rtype df: pandas DataFrame
+    """
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    with _cache_lock:
+        if key in _cache:
+            _cache_info["hits"] += 1
+            df, nbytes = _cache.pop(key)
+            _cache[key] = (df, nbytes)
+            return df
+        _cache_info["misses"] += 1
+    df = pd.read_pickle(path)
+    nbytes = _table_bytes(df)
+    with _cache_lock:
+        if nbytes <= _cache_info["max_bytes"] and key not in _cache:
+            _cache[key] = (df, nbytes)
+            _cache_info["bytes"] += nbytes
+            _evict(_cache_info["max_bytes"])
+    return df
+
+
+def set_halo_cache_size(max_bytes):
+    """Set the limit on the memory used by the halo table cache, dropping the
+    least recently used tables if the cache is already larger than the new
+    limit
+
+    Parameters
+    ----------
+    :param max_bytes: The maximum number of bytes of halo tables to keep in
+    memory. Use 0 to disable caching
+    :type max_bytes: int
+    """
+    max_bytes = int(max_bytes)
+    if max_bytes < 0:
+        raise ValueError("Cache size must be non-negative")
+    with _cache_lock:
+        _cache_info["max_bytes"] = max_bytes
+        _evict(max_bytes)
+
+
+def clear_halo_cache():
+    """Remove all tables from the halo table cache and reset the hit and miss
+    counts
+    """
+    with _cache_lock:
+        _cache.clear()
+        _cache_info["bytes"] = 0
+        _cache_info["hits"] = 0
+        _cache_info["misses"] = 0
+
+
+def halo_cache_stats():
+    """Get statistics for the halo table cache
+
+    Returns
+    -------
+    :return stats: The number of cache hits ('hits') and misses ('misses')
+    since the cache was last cleared, the number of tables ('tables') and
+    bytes ('bytes') currently held, and the limit on the bytes held
+    ('max_bytes')
+    :rtype stats: dict
+    """
+    with _cache_lock:
+        stats = dict(_cache_info)
+        stats["tables"] = len(_cache)
+    return stats
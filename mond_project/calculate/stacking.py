@@ -0,0 +1,256 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import warnings
+import numpy as np
+import pandas as pd
+
+
+def _accel_values(accel, r=None):
+    """A private function to be used behind the scenes for getting the
+    accelerations of a set of halos as a float array with one row per radial
+    bin and one column per halo
+
+    Parameters
+    ----------
+    :param accel: The accelerations, either as returned by
+    :func:`calc_accel.calc_gobs`, :func:`calc_accel.calc_gbar`, or
+    :func:`calc_accel.calc_gobs_profile`, or as an array with one row per
+    bin and one column per halo. A 1D array is a single halo
+    :type accel: pandas DataFrame or array-like float
+    :param r: The radius of each bin, or None to use the index of
+    :param:`accel` if it is a DataFrame, or the bin number otherwise.
+    Default None
+    :type r: 1D array-like float, optional
+
+    Returns
+    -------
+    :return values: The accelerations, with NaN for halos with no particles
+    in a bin
+    :rtype values: 2D array float
+    :return r: The radius of each bin
+    :rtype r: 1D array float
+    """
+    if isinstance(accel, pd.DataFrame):
+        values = np.asarray(accel.values, dtype=float)
+        if r is None:
+            r = accel.index.values
+    else:
+        values = np.asarray(accel, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        if values.ndim != 2:
+            raise ValueError("Accelerations must have one row per bin and one "
+                             "column per halo")
+        if r is None:
+            r = np.arange(values.shape[0])
+    r = np.asarray(r, dtype=float).flatten()
+    if r.size != values.shape[0]:
+        raise ValueError("Number of radii must match the number of bins")
+    return values, r
+
+
+def stack_halos(accel, r=None, percentiles=(16, 84), ddof=1):
+    """Stack the accelerations of a set of halos, finding statistics over
+    the halos in each radial bin at once. Halos with no particles in a bin
+    (NaN) are left out of the statistics for that bin
+
+    Parameters
+    ----------
+    :param accel: The accelerations, either as returned by
+    :func:`calc_accel.calc_gobs`, :func:`calc_accel.calc_gbar`, or
+    :func:`calc_accel.calc_gobs_profile`, or as an array with one row per
+    bin and one column per halo
+    :type accel: pandas DataFrame or 2D array-like float
+    :param r: The radius of each bin, or None to use the index of
+    :param:`accel` if it is a DataFrame, or the bin number otherwise.
+    Default None
+    :type r: 1D array-like float, optional
+    :param percentiles: The percentiles to find in each bin, between 0 and
+    100. Default (16, 84)
+    :type percentiles: 1D array-like float, optional
+    :param ddof: The delta degrees of freedom for the scatter, so that the
+    variance is divided by the number of halos minus :param:`ddof`. Default 1
+    :type ddof: int, optional
+
+    Returns
+    -------
+    :return stack: The number of halos with particles ('count'), and the
+    mean ('mean'), standard deviation ('std'), median ('median'), and each
+    percentile q ('p<q>', e.g. 'p16') of the accelerations of those halos,
+    in each bin. Statistics are NaN for bins without enough halos
+    :rtype stack: pandas DataFrame, indexed by radius
+
+    Examples
+    --------
+    The median RAR over all halos, with the 16th and 84th percentiles:
+
+    >>> gobs = calc_gobs(np.arange(1, 60), 1, list_file_loc)  # doctest: +SKIP
+    >>> stack_halos(gobs)[["median", "p16", "p84"]]  # doctest: +SKIP
+    """
+    values, r = _accel_values(accel, r)
+    percentiles = np.atleast_1d(percentiles).astype(float)
+    if np.any((percentiles < 0) | (percentiles > 100)):
+        raise ValueError("Percentiles must be between 0 and 100")
+    count = np.count_nonzero(~np.isnan(values), axis=1)
+    stack = {"count":count}
+    # Bins without any (or enough) halos warn about empty slices, and are
+    # NaN as intended
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        stack["mean"] = np.nanmean(values, axis=1)
+        stack["std"] = np.nanstd(values, axis=1, ddof=ddof)
+        stack["std"][count <= ddof] = np.nan
+        quantiles = np.nanpercentile(values, np.append(50.0, percentiles),
+                                     axis=1)
+    stack["median"] = quantiles[0]
+    columns = ["count", "mean", "std", "median"]
+    for (q, quantile) in zip(percentiles, quantiles[1:]):
+        columns.append("p{:g}".format(q))
+        stack[columns[-1]] = quantile
+    return pd.DataFrame(stack, index=pd.Index(r, name="r"))[columns]
+
+
+def stack_rar(rar, percentiles=(16, 84), ddof=1):
+    """Stack the observed and baryonic accelerations from
+    :func:`calc_accel.calc_rar` over halos at each radius, as
+    :func:`stack_halos` does for a single acceleration
+
+    Parameters
+    ----------
+    :param rar: The accelerations in tidy form, with columns 'ID', 'r',
+    'gobs', and 'gbar'
+    :type rar: pandas DataFrame
+    :param percentiles: The percentiles to find in each bin, between 0 and
+    100. Default (16, 84)
+    :type percentiles: 1D array-like float, optional
+    :param ddof: The delta degrees of freedom for the scatter. Default 1
+    :type ddof: int, optional
+
+    Returns
+    -------
+    :return stack: The statistics of each acceleration in each bin, with
+    columns of the acceleration ('gobs' or 'gbar') and the statistic, as in
+    :func:`stack_halos`
+    :rtype stack: pandas DataFrame, indexed by radius
+    """
+    stacks = []
+    for accel in ["gobs", "gbar"]:
+        wide = rar.pivot(index="r", columns="ID", values=accel)
+        stacks.append(stack_halos(wide, percentiles=percentiles, ddof=ddof))
+    return pd.concat(stacks, axis=1, keys=["gobs", "gbar"])
+
+
+class StackAccumulator(object):
+    """Statistics of the accelerations of halos in each radial bin, updated
+    as halos are added so that the accelerations of all halos never need to
+    be held at once. The mean and variance are updated with the method of
+    Welford (extended to batches of halos by Chan et al.), which is stable
+    for any number of halos. Medians and percentiles can't be found this
+    way, so use :func:`stack_halos` when all halos fit in memory
+
+    Parameters
+    ----------
+    :param r: The radius of each bin
+    :type r: 1D array-like float
+    :param ddof: The delta degrees of freedom for the scatter. Default 1
+    :type ddof: int, optional
+
+    Examples
+    --------
+    Stacking all halos in batches of 100:
+
+    >>> stack = StackAccumulator(r)  # doctest: +SKIP
+    >>> for i in range(0, len(ids), 100):  # doctest: +SKIP
+    ...     stack.add(calc_gbar(r, delta_r, list_file_loc, ids[i:i + 100]))
+    >>> stack.result()  # doctest: +SKIP
+    """
+    def __init__(self, r, ddof=1):
+        self.r = np.atleast_1d(r).astype(float).flatten()
+        self.ddof = ddof
+        self.count = np.zeros(self.r.size, dtype=np.int64)
+        self.mean = np.zeros(self.r.size)
+        self.min = np.full(self.r.size, np.inf)
+        self.max = np.full(self.r.size, -np.inf)
+        self._m2 = np.zeros(self.r.size)
+
+    def _combine(self, count, mean, m2, min_val, max_val):
+        """Combine the statistics of another set of halos into these"""
+        total = self.count + count
+        with np.errstate(divide="ignore", invalid="ignore"):
+            frac = np.where(total > 0, count / total, 0.0)
+        delta = np.where(count > 0, mean - self.mean, 0.0)
+        self.mean = self.mean + delta * frac
+        self._m2 = self._m2 + np.where(count > 0, m2, 0.0) + (
+            delta**2 * self.count * frac)
+        self.count = total
+        self.min = np.fmin(self.min, min_val)
+        self.max = np.fmax(self.max, max_val)
+
+    def add(self, accel):
+        """Add the accelerations of one or more halos
+
+        Parameters
+        ----------
+        :param accel: The accelerations in every bin, either as returned by
+        :func:`calc_accel.calc_gobs`, :func:`calc_accel.calc_gbar`, or
+        :func:`calc_accel.calc_gobs_profile`, as an array with one row per
+        bin and one column per halo, or as a 1D array for a single halo. The
+        rows of a DataFrame are matched to the bins by its index of radii
+        :type accel: pandas DataFrame or array-like float
+        """
+        if isinstance(accel, pd.DataFrame) and not np.array_equal(
+                accel.index.values, self.r):
+            if (accel.index.size != self.r.size or
+                    not np.isin(self.r, accel.index.values).all()):
+                raise ValueError("The radii of the accelerations don't match "
+                                 "the bins of the stack")
+            accel = accel.reindex(self.r)
+        values, _ = _accel_values(accel, self.r)
+        valid = ~np.isnan(values)
+        count = np.count_nonzero(valid, axis=1)
+        filled = np.where(valid, values, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = filled.sum(axis=1) / count
+        m2 = np.where(valid, values - mean[:, None], 0.0)
+        m2 = (m2**2).sum(axis=1)
+        self._combine(count, mean, m2,
+                      np.where(valid, values, np.inf).min(axis=1),
+                      np.where(valid, values, -np.inf).max(axis=1))
+
+    def merge(self, other):
+        """Add the halos of another accumulator for the same bins, such as
+        one filled in another process
+
+        Parameters
+        ----------
+        :param other: The other accumulator
+        :type other: :class:`StackAccumulator`
+        """
+        if not np.array_equal(other.r, self.r):
+            raise ValueError("Can only merge stacks with the same radii")
+        self._combine(other.count, other.mean, other._m2, other.min,
+                      other.max)
+
+    def result(self):
+        """Get the statistics of the halos added so far
+
+        Returns
+        -------
+        :return stack: The number of halos with particles ('count'), and the
+        mean ('mean'), standard deviation ('std'), minimum ('min'), and
+        maximum ('max') of their accelerations, in each bin. Statistics are
+        NaN for bins without enough halos
+        :rtype stack: pandas DataFrame, indexed by radius
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            std = np.sqrt(self._m2 / (self.count - self.ddof))
+        std[self.count <= self.ddof] = np.nan
+        empty = self.count == 0
+        return pd.DataFrame({
+            "count":self.count,
+            "mean" :np.where(empty, np.nan, self.mean),
+            "std"  :std,
+            "min"  :np.where(empty, np.nan, self.min),
+            "max"  :np.where(empty, np.nan, self.max)},
+            index=pd.Index(self.r, name="r"))[
+            ["count", "mean", "std", "min", "max"]]
@@ -1,3 +1,34 @@
 from .._version import __version__, __version_info__
 version = __version__
-from .data_read_utils import get, save_halos
+
+from .._lazy import attach
+
+# The module holding each export, which is imported on first use, so that
+# requests, h5py, and configobj are only imported when data is fetched
+_exports = {
+    "configure_api"            :"data_read_utils",
+    "configure_cache"          :"data_read_utils",
+    "configure_session"        :"data_read_utils",
+    "get"                      :"data_read_utils",
+    "get_api_key"              :"data_read_utils",
+    "get_hubble_param"         :"data_read_utils",
+    "request_stats"            :"data_read_utils",
+    "reset_request_stats"      :"data_read_utils",
+    "reset_settings"           :"data_read_utils",
+    "save_halos"               :"data_read_utils",
+    "save_halos_batch"         :"data_read_utils",
+    "ProfileStore"             :"halo_profiles",
+    "compute_profile"          :"halo_profiles",
+    "open_profiles"            :"halo_profiles",
+    "HaloStore"                :"halo_store",
+    "convert_to_store"         :"halo_store",
+    "open_store"               :"halo_store",
+    "sort_by_radius"           :"halo_store",
+    "configure_instrumentation":"instrumentation",
+    "halo_records"             :"instrumentation",
+    "reset_instrumentation"    :"instrumentation",
+    "stage_stats"              :"instrumentation",
+    "write_records"            :"instrumentation"}
+_submodules = ("data_read_utils", "halo_profiles", "halo_store",
+               "instrumentation", "response_cache")
+attach(__name__, globals(), _exports, _submodules)
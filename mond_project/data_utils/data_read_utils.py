@@ -1,29 +1,430 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+from collections import OrderedDict, deque
+from itertools import islice
+import operator
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import io
+import json
 import os
-from configobj import ConfigObj
+import shutil
+import tempfile
+import sys
+import threading
+import time
 import h5py
 import numpy as np
 import pandas as pd
+from future.moves.urllib.parse import urljoin, urlparse
+from .halo_profiles import (ProfileStore, _profiles_dir, compute_profile,
+                            default_profile_grids)
+from .halo_store import (HaloStore, decode_types, encode_types,
+                         sort_by_radius, type_codes, type_names)
+from .instrumentation import (activate, finish_record, new_record, progress,
+                              timed)
+from .response_cache import ResponseCache, cache_key
 
-config = ConfigObj(
-      os.path.join(os.path.dirname(__file__), "..", "mond_config.ini"))
-api_key = config["ILL_KEY"]
-hubble_param = config.as_float("ILL_h")
+# The config file with the Illustris API key ('ILL_KEY') and the Hubble
+# parameter ('ILL_h'), which is only read when they are first needed. The
+# environment variable MOND_CONFIG gives another file to read instead, and
+# each setting can be given in an environment variable of its own instead
+default_config_loc = os.path.join(os.path.dirname(__file__), "..",
+                                  "mond_config.ini")
+setting_env_vars = {"ILL_KEY":"ILL_KEY", "ILL_h":"ILL_H"}
+_settings = {}
+_settings_lock = threading.Lock()
 
+_clock = getattr(time, "monotonic", time.time)
+_replace = getattr(os, "replace", os.rename)
 
-def get(path, params=None):
+# Root URL of the Illustris API, used unless changed with configure_api
+default_base_url = "http://www.illustris-project.org/api/"
+_api_config = {"base_url":default_base_url}
+
+# Size of the chunks in which binary data is downloaded, in bytes
+download_chunk_size = 2**20
+
+# Settings for the HTTP sessions used by get, changed with configure_session
+_session_config = {"retries":5, "backoff_factor":0.5, "pool_size":10,
+                   "timeout":None}
+_session_generation = [0]
+_session_local = threading.local()
+_stats_lock = threading.Lock()
+_request_stats = {}
+
+# Particle types saved by save_halos by default, and the name of the field
+# used to request each particle type in a cutout
+default_part_types = ("gas", "star")
+part_type_fields = {"gas":"gas", "dm":"dm", "star":"stars"}
+
+# Name of the ingest manifest written by save_halos
+manifest_name = "ingest_manifest.jsonl"
+
+# Name of the record written by save_halos_batch once a snapshot is complete
+batch_record_name = "ingest_complete.json"
+
+# Comparisons allowed in subhalo selection filters
+_selection_ops = {"exact":operator.eq, "gt":operator.gt, "gte":operator.ge,
+                  "lt":operator.lt, "lte":operator.le}
+
+# The cache for JSON responses, set with configure_cache
+_cache_config = {"cache":None, "offline":False, "revalidate":False}
+
+
+def _read_config():
+    """A private function to be used behind the scenes for reading the config
+    file, from the path in the environment variable MOND_CONFIG if set
+
+    Returns
+    -------
+    :return config: The settings in the config file
+    :rtype config: :class:`configobj.ConfigObj`
+    """
+    from configobj import ConfigObj
+
+    config_loc = os.environ.get("MOND_CONFIG", default_config_loc)
+    if not os.path.isfile(config_loc):
+        raise IOError("Config file not found: {}".format(config_loc))
+    return ConfigObj(config_loc)
+
+
+def _get_setting(key):
+    """A private function to be used behind the scenes for getting a setting
+    from its environment variable or else the config file, the first time it
+    is needed
+
+    Parameters
+    ----------
+    :param key: The name of the setting in the config file
+    :type key: str
+
+    Returns
+    -------
+    :return value: The value of the setting
+    :rtype value: str
+    """
+    value = _settings.get(key)
+    if value is not None:
+        return value
+    with _settings_lock:
+        value = os.environ.get(setting_env_vars[key]) or None
+        if value is None:
+            try:
+                value = _read_config()[key]
+            except (IOError, KeyError):
+                raise IOError("{} must be set in the environment variable {} "
+                              "or the config file".format(
+                                  key, setting_env_vars[key]))
+        _settings[key] = value
+    return value
+
+
+def get_api_key():
+    """Get the Illustris API key, from the environment variable ILL_KEY or
+    else from the config file. It is only read the first time it is needed
+
+    Returns
+    -------
+    :return api_key: The API key
+    :rtype api_key: str
+    """
+    return _get_setting("ILL_KEY")
+
+
+def get_hubble_param():
+    """Get the Hubble parameter h used for the units of the simulation, from
+    the environment variable ILL_H or else from the config file ('ILL_h'). It
+    is only read the first time it is needed
+
+    Returns
+    -------
+    :return hubble_param: The Hubble parameter
+    :rtype hubble_param: float
+    """
+    return float(_get_setting("ILL_h"))
+
+
+def reset_settings():
+    """Forget the settings read so far, so that they are read again from the
+    environment and the config file when next needed
+    """
+    with _settings_lock:
+        _settings.clear()
+
+
+def __getattr__(name):
+    # The settings that used to be read when this module was imported
+    # ('api_key' and 'hubble_param') are still available as attributes
+    if name == "api_key":
+        return get_api_key()
+    if name == "hubble_param":
+        return get_hubble_param()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+                                                                    name))
+
+
+if sys.version_info < (3, 7):
+    # Module attributes can't be found on first use before Python 3.7
+    try:
+        api_key = get_api_key()
+        hubble_param = get_hubble_param()
+    except IOError:
+        pass
+
+
+def configure_api(base_url=None):
+    """Change the root URL of the Illustris API used by :func:`save_halos`
+    and :func:`save_halos_batch`, such as to point them at a mirror or a
+    local stand-in server. Relative paths given to :func:`get` are also
+    resolved against this URL
+
+    Parameters
+    ----------
+    :param base_url: The root URL of the API, or None to use
+    :data:`default_base_url`. Default None
+    :type base_url: str, optional
+
+    Returns
+    -------
+    :return base_url: The root URL now in use
+    :rtype base_url: str
+    """
+    if base_url is None:
+        base_url = default_base_url
+    if not base_url.endswith("/"):
+        base_url += "/"
+    _api_config["base_url"] = base_url
+    return base_url
+
+
+def configure_session(retries=None, backoff_factor=None, pool_size=None,
+                      timeout=None):
+    """Change the settings for the HTTP sessions used by :func:`get`. Each
+    thread keeps its own session, with a pool of connections that are kept
+    alive between requests, and requests that fail with a status of 429 or
+    5xx or with a connection error are retried. Only the settings given are
+    changed, and the sessions are recreated on their next use
+
+    Parameters
+    ----------
+    :param retries: The maximum number of times to retry a request. Default
+    None (5 to start)
+    :type retries: int, optional
+    :param backoff_factor: The factor for the exponential backoff between
+    retries, in seconds. The wait before retry n is about
+    :math:`backoff\\_factor \\cdot 2^{n - 1}`, unless the server sends a
+    'Retry-After' header, which is always respected. Default None (0.5 to
+    start)
+    :type backoff_factor: float, optional
+    :param pool_size: The maximum number of connections to keep alive for
+    each host. Default None (10 to start)
+    :type pool_size: int, optional
+    :param timeout: The timeout for connecting and reading, in seconds, or 0
+    for no timeout. Default None (no timeout to start)
+    :type timeout: float, optional
+    """
+    with _stats_lock:
+        for key, val in [("retries", retries),
+                         ("backoff_factor", backoff_factor),
+                         ("pool_size", pool_size)]:
+            if val is not None:
+                _session_config[key] = val
+        if timeout is not None:
+            _session_config["timeout"] = timeout if timeout > 0 else None
+        _session_generation[0] += 1
+
+
+def _get_session():
+    """A private function to be used behind the scenes for getting the HTTP
+    session for the current thread, creating it if needed
+
+    Returns
+    -------
+    :return session: The session for this thread
+    :rtype session: :class:`requests.Session`
+    """
+    if getattr(_session_local, "generation", None) != _session_generation[0]:
+        with _stats_lock:
+            config = dict(_session_config)
+            _session_local.generation = _session_generation[0]
+        retry_kwargs = {"total":config["retries"],
+                        "backoff_factor":config["backoff_factor"],
+                        "status_forcelist":(429, 500, 502, 503, 504),
+                        "respect_retry_after_header":True,
+                        "raise_on_status":False}
+        try:
+            retry = Retry(allowed_methods=frozenset(["GET"]), **retry_kwargs)
+        except TypeError:
+            retry = Retry(method_whitelist=frozenset(["GET"]), **retry_kwargs)
+        adapter = HTTPAdapter(pool_connections=config["pool_size"],
+                              pool_maxsize=config["pool_size"],
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        old_session = getattr(_session_local, "session", None)
+        if old_session is not None:
+            old_session.close()
+        _session_local.session = session
+        _session_local.timeout = config["timeout"]
+    return _session_local.session
+
+
+def _record_request(url, elapsed, response=None):
+    """A private function to be used behind the scenes for adding a request
+    to the timing statistics for its host
+
+    Parameters
+    ----------
+    :param url: The URL requested
+    :type url: str
+    :param elapsed: The time taken by the request, including any retries, in
+    seconds
+    :type elapsed: float
+    :param response: The response, or None if the request failed without a
+    response. Default None
+    :type response: :class:`requests.Response`, optional
+    """
+    host = urlparse(url).netloc
+    retries = getattr(getattr(getattr(response, "raw", None), "retries",
+                              None), "history", ())
+    with _stats_lock:
+        stats = _request_stats.setdefault(host, {
+            "requests":0, "errors":0, "retries":0, "total_time":0.0,
+            "max_time":0.0})
+        stats["requests"] += 1
+        stats["retries"] += len(retries or ())
+        if response is None or not response.ok:
+            stats["errors"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+
+
+def configure_cache(cache_loc=None, max_bytes=2**30, offline=False,
+                    revalidate=False):
+    """Set up a persistent on-disk cache for the JSON documents returned by
+    :func:`get`, such as the simulation, snapshot, and subhalo documents.
+    These documents don't change, so by default a cached document is used
+    without making any request. Cutouts and other files are never cached
+
+    Parameters
+    ----------
+    :param cache_loc: The path of the cache database file, or None to stop
+    using a cache. Default None
+    :type cache_loc: str, optional
+    :param max_bytes: The maximum number of bytes of documents to keep, after
+    which the least recently used are removed. Default 1 GiB
+    :type max_bytes: int, optional
+    :param offline: If True, only serve documents from the cache, raising an
+    :class:`IOError` for anything not cached instead of making a request.
+    Default False
+    :type offline: bool, optional
+    :param revalidate: If True, check cached documents with the server using
+    their 'ETag' or 'Last-Modified' validators, only downloading them again
+    if they have changed. Default False
+    :type revalidate: bool, optional
+
+    Returns
+    -------
+    :return cache: The cache in use, or None
+    :rtype cache: :class:`response_cache.ResponseCache` or None
+    """
+    if offline and cache_loc is None:
+        raise ValueError("Offline mode requires a cache")
+    old_cache = _cache_config["cache"]
+    if old_cache is not None and (cache_loc is None or
+                                  os.path.abspath(cache_loc) !=
+                                  old_cache.cache_loc):
+        old_cache.close()
+        old_cache = None
+    if cache_loc is not None and old_cache is None:
+        old_cache = ResponseCache(cache_loc, max_bytes)
+    if old_cache is not None:
+        old_cache.max_bytes = int(max_bytes)
+    _cache_config.update(cache=old_cache, offline=offline,
+                         revalidate=revalidate)
+    return old_cache
+
+
+def request_stats():
+    """Get timing statistics for the requests made by :func:`get` since the
+    statistics were last reset
+
+    Returns
+    -------
+    :return stats: For each host, the number of requests ('requests'), the
+    number that failed ('errors'), the total number of retries ('retries'),
+    and the total ('total_time'), mean ('mean_time'), and maximum
+    ('max_time') time per request in seconds, including retries
+    :rtype stats: dict of dict
+    """
+    with _stats_lock:
+        stats = dict((host, dict(host_stats)) for (host, host_stats) in
+                     _request_stats.items())
+    for host_stats in stats.values():
+        host_stats["mean_time"] = (host_stats["total_time"] /
+                                   host_stats["requests"])
+    return stats
+
+
+def reset_request_stats():
+    """Reset the timing statistics for the requests made by :func:`get`"""
+    with _stats_lock:
+        _request_stats.clear()
+
+
+def _api_headers():
+    """A private function to be used behind the scenes for getting the
+    headers sent with every request. Only the Illustris API itself needs the
+    API key, so requests to another base URL (such as a
+    :class:`benchmarks.MockIllustrisAPI`) are sent without one if it isn't
+    set
+
+    Returns
+    -------
+    :return headers: The 'api-key' header, if the key is set or needed
+    :rtype headers: dict
+    """
+    try:
+        return {"api-key":get_api_key()}
+    except IOError:
+        if _api_config["base_url"] == default_base_url:
+            raise
+        return {}
+
+
+def get(path, params=None, save_dir=None, in_memory=False, filename=None):
     """Make an HTTP request to get the data from path. Note that there are
     several possible returns with different types depending on the data received
-    from the URL
+    from the URL. Requests are made with a pooled session for each thread,
+    and are retried with exponential backoff on transient errors (see
+    :func:`configure_session`)
 
     Parameters
     ----------
-    :param path: The URL to request from
+    :param path: The URL to request from, or a path relative to the root URL
+    of the API (see :func:`configure_api`)
     :type path: str
     :param params: Extra parameters to pass to `requests`. Default None
     :type params: dict or None
+    :param save_dir: The directory in which to save binary data. The data is
+    streamed in chunks to a uniquely named temporary file, which is renamed
+    once complete. Default None (the current working directory)
+    :type save_dir: str, optional
+    :param in_memory: If True, return binary data as an in-memory file
+    rather than saving it, which can be opened directly with
+    :class:`h5py.File`. If an integer, only binary data of at most this many
+    bytes is kept in memory. Default False
+    :type in_memory: bool or int, optional
+    :param filename: The name of the file in :param:`save_dir` in which to
+    save binary data. A finished download replaces any file of the same
+    name, so give a name unique to each caller when the same data may be
+    requested at once. Default None (the name given by the server)
+    :type filename: str, optional
 
     Returns
     -------
@@ -36,6 +437,9 @@ def get(path, params=None):
     :return filename: Filename for stored HDF5 table, if request was successful
     and response is binary
     :rtype filename: str
+    :return data: The binary data, if request was successful and response is
+    binary and :param:`in_memory` applies
+    :rtype data: :class:`io.BytesIO`
 
     Examples
     --------
@@ -63,32 +467,1228 @@ def get(path, params=None):
     >>> print(filename)
     sublink_mpb_1030.hdf5
     """
-    headers = {"api-key":api_key}
+    with timed("fetch"):
+        return _get(path, params, save_dir, in_memory, filename)
+
+
+def _get(path, params=None, save_dir=None, in_memory=False, filename=None):
+    """A private function to be used behind the scenes for making the
+    request for :func:`get`, timed as the stage 'fetch'. Streaming binary
+    data is timed separately as the stage 'download'
+
+    Parameters
+    ----------
+    :param path: The URL to request from, or a path relative to the root URL
+    of the API
+    :type path: str
+    :param params: Extra parameters to pass to `requests`. Default None
+    :type params: dict or None
+    :param save_dir: The directory in which to save binary data. Default None
+    :type save_dir: str, optional
+    :param in_memory: Whether or up to what size to return binary data in
+    memory. Default False
+    :type in_memory: bool or int, optional
+    :param filename: The name of the file in which to save binary data.
+    Default None
+    :type filename: str, optional
+
+    Returns
+    -------
+    :return r: As for :func:`get`
+    :rtype r: dict, str, :class:`io.BytesIO`, or :class:`requests.Response`
+    """
+    path = urljoin(_api_config["base_url"], path)
+    headers = {}
+    cache = _cache_config["cache"]
+    cached = None
+    if cache is not None:
+        key = cache_key(path, params)
+        cached = cache.get(key)
+        if cached is not None and not (_cache_config["revalidate"] and
+                                       not _cache_config["offline"]):
+            return json.loads(cached["body"].decode("utf-8"))
+        if _cache_config["offline"]:
+            raise IOError("Offline mode: no cached response for {}".format(
+                key))
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+    
+    # The API key is only needed once a request is actually sent
+    headers.update(_api_headers())
+    session = _get_session()
+    start = _clock()
+    try:
+        r = session.get(path, params=params, headers=headers,
+                        timeout=_session_local.timeout, stream=True)
+    except requests.exceptions.RequestException:
+        _record_request(path, _clock() - start)
+        raise
+    _record_request(path, _clock() - start, r)
     
-    r = requests.get(path, params=params, headers=headers)
+    if r.status_code == 304 and cached is not None:
+        return json.loads(cached["body"].decode("utf-8"))
     
     r.raise_for_status()
     
     if r.headers["content-type"] == "application/json":
+        if cache is not None:
+            cache.put(key, r.content, r.headers["content-type"],
+                      r.headers.get("ETag"), r.headers.get("Last-Modified"))
         return r.json()
     
     if "content-disposition" in r.headers:
-        filename = r.headers["content-disposition"].split("filename=")[1]
-        with open(filename, "wb") as f:
-            f.write(r.content)
-        return os.path.abspath(filename)
+        if filename is None:
+            filename = r.headers["content-disposition"].split(
+                "filename=")[1].strip('"')
+        filename = os.path.basename(filename)
+        size = int(r.headers.get("content-length", -1))
+        if in_memory is True or (in_memory and 0 <= size <= in_memory):
+            data = io.BytesIO()
+            with timed("download") as timer:
+                for chunk in r.iter_content(chunk_size=download_chunk_size):
+                    data.write(chunk)
+                    timer.nbytes += len(chunk)
+            data.seek(0)
+            return data
+        if save_dir is None:
+            save_dir = os.getcwd()
+        fd, tmp_filename = tempfile.mkstemp(prefix=filename + ".",
+                                            suffix=".part", dir=save_dir)
+        try:
+            with os.fdopen(fd, "wb") as f, timed("download") as timer:
+                for chunk in r.iter_content(chunk_size=download_chunk_size):
+                    f.write(chunk)
+                    timer.nbytes += len(chunk)
+            _replace(tmp_filename, os.path.join(save_dir, filename))
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+        return os.path.abspath(os.path.join(save_dir, filename))
     
     return r
 
 
-def save_halos(simulation, save_loc, z=None, snapnum=None):
+class _RateLimiter(object):
+    """A private class to be used behind the scenes for limiting the rate at
+    which requests are started, shared between threads
+
+    Parameters
+    ----------
+    :param max_rate: The maximum number of requests to start per second, or
+    None for no limit
+    :type max_rate: float or None
+    """
+    def __init__(self, max_rate=None):
+        if max_rate is not None and max_rate <= 0:
+            raise ValueError("Request rate limit must be positive")
+        self.interval = 0.0 if max_rate is None else 1.0 / max_rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Wait until the next request may be started"""
+        if not self.interval:
+            return
+        with self._lock:
+            now = _clock()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _particle_columns(group, sub, a, start=0, stop=None, mass=None):
+    """A private function to be used behind the scenes for converting the
+    particles of a single type in a cutout to physical radii, masses, and
+    speeds relative to the subhalo. The arithmetic is the same as was done
+    separately for each axis, so results do not depend on how the particles
+    are split up
+
+    Parameters
+    ----------
+    :param group: The group of the cutout file for the particle type
+    :type group: :class:`h5py.Group`
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param a: The scale factor of the snapshot
+    :type a: float
+    :param start: The index of the first particle to convert. Default 0
+    :type start: int, optional
+    :param stop: The index after the last particle to convert, or None for
+    all remaining particles. Default None
+    :type stop: int, optional
+    :param mass: The mass of every particle in simulation units, for types
+    without the 'Masses' field, or None to read 'Masses'. Default None
+    :type mass: float, optional
+
+    Returns
+    -------
+    :return r: The physical distance of each particle from the subhalo
+    :rtype r: 1D array float
+    :return m: The mass of each particle
+    :rtype m: 1D array float
+    :return v: The speed of each particle relative to the subhalo
+    :rtype v: 1D array float
+    """
+    with timed("read"):
+        pos = group["Coordinates"][start:stop]
+    pos -= np.asarray([sub["pos_x"], sub["pos_y"], sub["pos_z"]],
+                      dtype=pos.dtype)
+    pos = np.asarray(pos, dtype=float)
+    pos *= pos
+    r = np.sqrt(pos[:, 0] + pos[:, 1] + pos[:, 2])
+    r *= a
+    hubble_param = get_hubble_param()
+    r /= hubble_param
+    del pos
+    with timed("read"):
+        vel = group["Velocities"][start:stop]
+    vel = vel * np.sqrt(a)
+    vel -= np.asarray([sub["vel_x"], sub["vel_y"], sub["vel_z"]],
+                      dtype=vel.dtype)
+    vel = np.asarray(vel, dtype=float)
+    vel *= vel
+    v = np.sqrt(vel[:, 0] + vel[:, 1] + vel[:, 2])
+    del vel
+    if mass is None:
+        with timed("read"):
+            m = np.asarray(group["Masses"][start:stop], dtype=float)
+    else:
+        m = np.full(r.size, mass, dtype=float)
+    m *= (10**10 / hubble_param)
+    return r, m, v
+
+
+def _part_type_mass(f, part_type):
+    """A private function to be used behind the scenes for getting the fixed
+    particle mass of a particle type without the 'Masses' field (such as dark
+    matter) from the header of a cutout
+
+    Parameters
+    ----------
+    :param f: The cutout file
+    :type f: :class:`h5py.File`
+    :param part_type: The name of the particle type
+    :type part_type: str
+
+    Returns
+    -------
+    :return mass: The mass of each particle in simulation units, or None if
+    the particle type has the 'Masses' field
+    :rtype mass: float or None
+    """
+    group = "PartType{}".format(type_codes[part_type])
+    if "Masses" in f[group]:
+        return None
+    try:
+        return float(f["Header"].attrs["MassTable"][type_codes[part_type]])
+    except KeyError:
+        raise ValueError("No masses found for particle type {}".format(
+            part_type))
+
+
+def _check_part_types(part_types):
+    """A private function to be used behind the scenes for checking the
+    particle types requested from :func:`save_halos`
+
+    Parameters
+    ----------
+    :param part_types: The names of the particle types
+    :type part_types: list of str
+
+    Returns
+    -------
+    :return query_params: The fields to request for each particle type in a
+    cutout
+    :rtype query_params: dict
+    """
+    if not part_types:
+        raise ValueError("At least one particle type must be given")
+    query_params = {}
+    for part_type in part_types:
+        if part_type not in part_type_fields:
+            raise ValueError("Unknown particle type: {}".format(part_type))
+        query_params[part_type_fields[part_type]] = (
+            "Coordinates,Velocities" if part_type == "dm" else
+            "Coordinates,Masses,Velocities")
+    return query_params
+
+
+def _particle_chunks(f, sub, a, part_types=default_part_types,
+                     chunk_size=None):
+    """A private function to be used behind the scenes for converting the
+    particles of the requested types in a cutout a slab at a time. Only the
+    slab being converted is read from the cutout
+
+    Parameters
+    ----------
+    :param f: The cutout file
+    :type f: :class:`h5py.File`
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param a: The scale factor of the snapshot
+    :type a: float
+    :param part_types: The names of the particle types to convert, in the
+    order they are stored. Types missing from the cutout have no particles.
+    Default ("gas", "star")
+    :type part_types: list of str, optional
+    :param chunk_size: The largest number of particles in a slab, or None to
+    convert each particle type in one slab. Default None
+    :type chunk_size: int, optional
+
+    Returns
+    -------
+    :return chunks: The name of the particle type, and the radii, masses,
+    and speeds of the particles, for each slab
+    :rtype chunks: generator of tuple
+    """
+    for part_type in part_types:
+        group = "PartType{}".format(type_codes[part_type])
+        if group not in f:
+            continue
+        n_part = f[group]["Coordinates"].shape[0]
+        mass = _part_type_mass(f, part_type)
+        step = n_part if chunk_size is None else int(chunk_size)
+        for start in range(0, n_part, max(step, 1)):
+            # Reading the slab is timed separately, inside the transform
+            with timed("transform"):
+                r, m, v = _particle_columns(f[group], sub, a, start,
+                                            start + step, mass)
+            yield part_type, r, m, v
+
+
+def _particle_table(f, sub, a, part_types=default_part_types, float32=False):
+    """A private function to be used behind the scenes for converting all
+    particles of the requested types in a cutout to the columns saved by
+    :func:`save_halos`. The output columns are allocated once, and the
+    particle types are converted one at a time, so only one type is read
+    from the cutout at once
+
+    Parameters
+    ----------
+    :param f: The cutout file
+    :type f: :class:`h5py.File`
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param a: The scale factor of the snapshot
+    :type a: float
+    :param part_types: The names of the particle types to convert, in the
+    order they are stored. Types missing from the cutout have no particles.
+    Default ("gas", "star")
+    :type part_types: list of str, optional
+    :param float32: If True, store the radii, masses, and speeds in single
+    precision. Default False
+    :type float32: bool, optional
+
+    Returns
+    -------
+    :return data: The radius ('r'), mass ('M'), speed ('v'), and type name
+    ('type', categorical) of each particle
+    :rtype data: dict
+    """
+    n_part = sum(f[group]["Coordinates"].shape[0] for group in [
+        "PartType{}".format(type_codes[part_type]) for part_type in
+        part_types] if group in f)
+    dtype = np.float32 if float32 else np.float64
+    data = dict((col, np.empty(n_part, dtype=dtype)) for col in
+                ["r", "M", "v"])
+    codes = np.empty(n_part, dtype=np.int8)
+    stop = 0
+    for (part_type, r, m, v) in _particle_chunks(f, sub, a, part_types):
+        start, stop = stop, stop + r.size
+        data["r"][start:stop] = r
+        data["M"][start:stop] = m
+        data["v"][start:stop] = v
+        codes[start:stop] = type_codes[part_type]
+    data["type"] = decode_types(codes)
+    return data
+
+
+def _store_chunks(f, sub, a, part_types=default_part_types, float32=False,
+                  chunk_size=None):
+    """A private function to be used behind the scenes for converting the
+    particles in a cutout to chunks for
+    :meth:`halo_store.HaloStore.append_chunks`, with the same values as the
+    table from :func:`_particle_table`
+
+    Parameters
+    ----------
+    :param f: The cutout file
+    :type f: :class:`h5py.File`
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param a: The scale factor of the snapshot
+    :type a: float
+    :param part_types: The names of the particle types to convert. Default
+    ("gas", "star")
+    :type part_types: list of str, optional
+    :param float32: If True, round the radii, masses, and speeds to single
+    precision. Default False
+    :type float32: bool, optional
+    :param chunk_size: The largest number of particles in a chunk, or None
+    for one chunk per particle type. Default None
+    :type chunk_size: int, optional
+
+    Returns
+    -------
+    :return chunks: The radius ('r'), mass ('M'), speed ('v'), and type code
+    ('type') of the particles in each chunk
+    :rtype chunks: generator of dict
+    """
+    dtype = np.float32 if float32 else np.float64
+    for (part_type, r, m, v) in _particle_chunks(f, sub, a, part_types,
+                                                 chunk_size):
+        yield {"r":r.astype(dtype, copy=False), "M":m.astype(dtype, copy=False),
+               "v":v.astype(dtype, copy=False),
+               "type":np.full(r.size, type_codes[part_type], dtype=np.int8)}
+
+
+def _download_cutout(sub, query_params, rate_limiter, scratch_dir,
+                     in_memory_bytes):
+    """A private function to be used behind the scenes for downloading the
+    cutout of a single subhalo
+
+    Parameters
+    ----------
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param query_params: The fields to request for the cutout
+    :type query_params: dict
+    :param rate_limiter: The limit on the rate of requests
+    :type rate_limiter: :class:`_RateLimiter`
+    :param scratch_dir: The directory in which to save the cutout
+    :type scratch_dir: str
+    :param in_memory_bytes: The largest cutout to keep in memory rather than
+    saving, in bytes
+    :type in_memory_bytes: int
+
+    Returns
+    -------
+    :return saved_filename: The path to the saved cutout, or the cutout
+    itself if kept in memory
+    :rtype saved_filename: str or :class:`io.BytesIO`
+    """
+    rate_limiter.wait()
+    return get(sub["cutouts"]["subhalo"], query_params, save_dir=scratch_dir,
+               in_memory=in_memory_bytes)
+
+
+def _remove_cutout(saved_filename):
+    """A private function to be used behind the scenes for removing a cutout
+    from :func:`_download_cutout` once it has been read
+
+    Parameters
+    ----------
+    :param saved_filename: The path to the saved cutout, or the cutout
+    itself if kept in memory
+    :type saved_filename: str or :class:`io.BytesIO`
+    """
+    if not isinstance(saved_filename, io.BytesIO):
+        os.remove(saved_filename)
+
+
+def _halo_table(sub, query_params, a, rate_limiter, scratch_dir,
+                in_memory_bytes, part_types=default_part_types,
+                float32=False):
+    """A private function to be used behind the scenes for downloading the
+    cutout of a single subhalo and converting it to the table of particle
+    radii, masses, speeds, and types saved by :func:`save_halos`
+
+    Parameters
+    ----------
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param query_params: The fields to request for the cutout
+    :type query_params: dict
+    :param a: The scale factor of the snapshot
+    :type a: float
+    :param rate_limiter: The limit on the rate of requests
+    :type rate_limiter: :class:`_RateLimiter`
+    :param scratch_dir: The directory in which to save the cutout while it is
+    read
+    :type scratch_dir: str
+    :param in_memory_bytes: The largest cutout to keep in memory rather than
+    saving, in bytes
+    :type in_memory_bytes: int
+    :param part_types: The names of the particle types to save. Default
+    ("gas", "star")
+    :type part_types: list of str, optional
+    :param float32: If True, store the radii, masses, and speeds in single
+    precision. Default False
+    :type float32: bool, optional
+
+    Returns
+    -------
+    :return df: The table of particles for the subhalo
+    :rtype df: pandas DataFrame
+    """
+    saved_filename = _download_cutout(sub, query_params, rate_limiter,
+                                      scratch_dir, in_memory_bytes)
+    with h5py.File(saved_filename, "r") as f:
+        df = pd.DataFrame.from_dict(_particle_table(f, sub, a, part_types,
+                                                    float32))
+    _remove_cutout(saved_filename)
+    return df
+
+
+def _check_selection(selection):
+    """A private function to be used behind the scenes for checking that all
+    filters in a subhalo selection use a known comparison
+
+    Parameters
+    ----------
+    :param selection: The filters, with keys of the form 'field__op' (or just
+    'field' for equality)
+    :type selection: dict
+    """
+    for key in selection:
+        op = key.split("__", 1)[1] if "__" in key else "exact"
+        if op not in _selection_ops:
+            raise ValueError("Invalid selection filter: {}".format(key))
+
+
+def _is_selected(sub, selection):
+    """A private function to be used behind the scenes for checking a subhalo
+    document against all filters of a selection
+
+    Parameters
+    ----------
+    :param sub: The API document for the subhalo
+    :type sub: dict
+    :param selection: The filters, as checked by :func:`_check_selection`
+    :type selection: dict
+
+    Returns
+    -------
+    :return selected: True if the subhalo passes every filter
+    :rtype selected: bool
+    """
+    for key, val in selection.items():
+        field, op = key.split("__", 1) if "__" in key else (key, "exact")
+        if not _selection_ops[op](sub[field], val):
+            return False
+    return True
+
+
+def _iter_selected_ids(subhalos_url, selection, page_limit, rate_limiter):
+    """A private generator to be used behind the scenes for getting the IDs
+    of the subhalos passing a selection in increasing order, using filtered
+    listings of the subhalos in pages of :param:`page_limit`
+
+    Parameters
+    ----------
+    :param subhalos_url: The URL of the subhalo listing for the snapshot
+    :type subhalos_url: str
+    :param selection: The filters to pass to the API
+    :type selection: dict
+    :param page_limit: The number of subhalos per page
+    :type page_limit: int
+    :param rate_limiter: The limit on the rate of requests
+    :type rate_limiter: :class:`_RateLimiter`
+
+    Yields
+    ------
+    :return id: The ID of the next subhalo in the listing
+    :rtype id: int
+    """
+    params = dict(selection, limit=page_limit, order_by="id")
+    rate_limiter.wait()
+    page = get(subhalos_url, params)
+    while True:
+        for result in page["results"]:
+            yield result["id"]
+        if not page.get("next"):
+            return
+        rate_limiter.wait()
+        page = get(page["next"])
+
+
+def _table_summary(data, part_types, chunk_size=None):
+    """A private function to be used behind the scenes for getting the
+    particle counts, radial extent, and checksum of the particles saved for a
+    subhalo, as recorded in the ingest manifest
+
+    Parameters
+    ----------
+    :param data: The particles for the subhalo, with the particle types
+    given as names, categorical names, or integer codes
+    :type data: pandas DataFrame or dict
+    :param part_types: The names of the particle types to count
+    :type part_types: list of str
+    :param chunk_size: The number of particles to read at once, or None to
+    read each column at once. Default None
+    :type chunk_size: int, optional
+
+    Returns
+    -------
+    :return summary: The number of particles of each type ('n_<type>'), the
+    minimum ('r_min') and maximum ('r_max') radius, and the SHA-256 digest
+    ('checksum') of the radius, mass, speed, and type columns
+    :rtype summary: dict
+    """
+    n_part = len(data["r"])
+    step = max(n_part if chunk_size is None else int(chunk_size), 1)
+    slabs = [slice(start, start + step) for start in range(0, n_part, step)]
+    names = np.empty(max(type_names) + 1, dtype=object)
+    for (code, name) in type_names.items():
+        names[code] = name
+    summary = dict(("n_{}".format(part_type), 0) for part_type in
+                   part_types)
+    r_min = np.inf
+    r_max = -np.inf
+    digest = hashlib.sha256()
+    for col in ["r", "M", "v"]:
+        arr = np.asarray(data[col])
+        for slab in slabs:
+            digest.update(np.ascontiguousarray(arr[slab],
+                                               dtype=float).tobytes())
+            if col == "r":
+                r_min = min(r_min, arr[slab].min())
+                r_max = max(r_max, arr[slab].max())
+    types = encode_types(data["type"])
+    for slab in slabs:
+        types_slab = names[types[slab]].astype(str)
+        digest.update("".join(types_slab).encode("utf-8"))
+        for part_type in part_types:
+            summary["n_{}".format(part_type)] += int(np.count_nonzero(
+                types_slab == part_type))
+    summary.update(r_min=float(r_min) if n_part else np.nan,
+                   r_max=float(r_max) if n_part else np.nan,
+                   checksum=digest.hexdigest())
+    return summary
+
+
+def _read_manifest(manifest_loc, fname_base=None):
+    """A private function to be used behind the scenes for reading the
+    subhalos completed in earlier runs from an ingest manifest
+
+    Parameters
+    ----------
+    :param manifest_loc: The path to the manifest
+    :type manifest_loc: str
+    :param fname_base: The name of the file or store a subhalo is saved in,
+    to be formatted with its ID, to only read the records of subhalos saved
+    there, such as those of a single snapshot, or None to read every record.
+    Default None
+    :type fname_base: str, optional
+
+    Returns
+    -------
+    :return completed: The last record with status 'done' for each subhalo
+    ID, for subhalos without a later failure
+    :rtype completed: dict
+    """
+    completed = {}
+    if not os.path.isfile(manifest_loc):
+        return completed
+    with open(manifest_loc) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line only partly written before a crash
+                continue
+            if (fname_base is not None and "file" in record and
+                    record["file"] != fname_base.format(record["id"])):
+                continue
+            if record["status"] == "done":
+                completed[record["id"]] = record
+            else:
+                completed.pop(record["id"], None)
+    return completed
+
+
+def _append_manifest(manifest_loc, record):
+    """A private function to be used behind the scenes for adding a record to
+    an ingest manifest, making sure it is on disk before returning
+
+    Parameters
+    ----------
+    :param manifest_loc: The path to the manifest
+    :type manifest_loc: str
+    :param record: The record to add
+    :type record: dict
+    """
+    with open(manifest_loc, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _check_ingest_options(n_workers=1, store=False, sort_radius=False,
+                          selection=None, part_types=default_part_types,
+                          chunk_size=None):
+    """A private function to be used behind the scenes for checking the
+    options of :func:`save_halos` before any requests are made
+
+    Parameters
+    ----------
+    :param n_workers: The number of threads to use. Default 1
+    :type n_workers: int, optional
+    :param store: Whether to save to a consolidated store. Default False
+    :type store: bool, optional
+    :param sort_radius: Whether to sort the particles by radius. Default False
+    :type sort_radius: bool, optional
+    :param selection: Filters on the fields of the subhalo documents, or None
+    for the default selection of galaxies. Default None
+    :type selection: dict, optional
+    :param part_types: The names of the particle types to save. Default
+    ("gas", "star")
+    :type part_types: list of str, optional
+    :param chunk_size: The largest number of particles to convert at once, or
+    None. Default None
+    :type chunk_size: int, optional
+
+    Returns
+    -------
+    :return selection: The filters for choosing subhalos
+    :rtype selection: dict
+    """
+    mass_cut = 0.0
+    if selection is None:
+        selection = {"mass_stars__gt":mass_cut, "mass_gas__gt":mass_cut}
+    _check_selection(selection)
+    _check_part_types(part_types)
+    if n_workers < 1:
+        raise ValueError("n_workers must be at least 1")
+    if chunk_size is not None:
+        if not store:
+            raise ValueError("chunk_size can only be used with store=True")
+        if sort_radius:
+            raise ValueError("chunk_size can't be used with sort_radius=True")
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+    return selection
+
+
+def _ingest_options(sort_radius=False, part_types=default_part_types,
+                    float32=False):
+    """A private function to be used behind the scenes for the options of
+    :func:`save_halos` that change the particles saved for each subhalo,
+    which are recorded with every saved subhalo so that subhalos saved with
+    other options are never reused
+
+    Parameters
+    ----------
+    :param sort_radius: Whether the particles are sorted by radius. Default
+    False
+    :type sort_radius: bool, optional
+    :param part_types: The names of the particle types saved. Default
+    ("gas", "star")
+    :type part_types: list of str, optional
+    :param float32: Whether the columns are saved in single precision.
+    Default False
+    :type float32: bool, optional
+
+    Returns
+    -------
+    :return options: The options, as they are recorded in the ingest manifest
+    and in the attributes of a consolidated store
+    :rtype options: dict
+    """
+    return {"sort_radius":bool(sort_radius),
+            "part_types":[str(part_type) for part_type in part_types],
+            "float32":bool(float32)}
+
+
+def _resolve_simulation(simulation):
+    """A private function to be used behind the scenes for finding the API
+    document of an Illustris simulation
+
+    Parameters
+    ----------
+    :param simulation: The name of the Illustris simulation, or an integer to
+    reference one of 'Illustris-1', 'Illustris-2', or 'Illustris-3'
+    :type simulation: str or int
+
+    Returns
+    -------
+    :return simulation: The name of the simulation
+    :rtype simulation: str
+    :return sim: The API document for the simulation
+    :rtype sim: dict
+    """
+    base = get(_api_config["base_url"])
+    valid_sims = [sim["name"] for sim in base["simulations"]]
+    if isinstance(simulation, int):
+        simulation = "Illustris-{}".format(simulation)
+    if not simulation in valid_sims:
+        raise ValueError("Invalid Illustris simulation: {}. Please use a valid "
+                         "simulation!".format(simulation))
+    return simulation, get(base["simulations"][valid_sims.index(simulation)][
+        "url"])
+
+
+def _snapshot_url(simulation, sim, z=None, snapnum=None, sim_snaps=None):
+    """A private function to be used behind the scenes for finding the URL of
+    the API document for a snapshot, given either its redshift or its number
+
+    Parameters
+    ----------
+    :param simulation: The name of the simulation
+    :type simulation: str
+    :param sim: The API document for the simulation
+    :type sim: dict
+    :param z: The redshift of the snapshot, which is preferred if given.
+    Default None
+    :type z: int or float, optional
+    :param snapnum: The number of the snapshot. Default None
+    :type snapnum: int, optional
+    :param sim_snaps: The list of snapshots of the simulation, if already
+    fetched, or None to fetch it if needed. Default None
+    :type sim_snaps: list of dict, optional
+
+    Returns
+    -------
+    :return snap_url: The URL of the snapshot document
+    :rtype snap_url: str
+    """
+    if z is None and snapnum is None:
+        raise ValueError("At least one of z and snapnum MUST be given")
+    if z is not None:
+        return sim["snapshots"] + "z={}/".format(float(z))
+    if sim_snaps is None:
+        sim_snaps = get(sim["snapshots"])
+    snapnum = int(snapnum)
+    sim_snapnums = [snap["number"] for snap in sim_snaps]
+    if not snapnum in sim_snapnums:
+        raise ValueError(
+              "Invalid snapshot number for simulation {}: {}. Please use a "
+              "valid snapshot number for this simulation".format(simulation,
+                                                                 snapnum))
+    return sim_snaps[sim_snapnums.index(snapnum)]["url"]
+
+
+def _open_halo_store(save_loc, simulation, label, options, sort_radius=False,
+                     float32=False):
+    """A private function to be used behind the scenes for opening the
+    consolidated store of a snapshot in :param:`save_loc` to add subhalos to
+    it. Each snapshot has its own store, named after the simulation and
+    snapshot, which are also recorded in its attributes. Subhalos can't be
+    replaced in a store, so a store saved for another snapshot or with other
+    options can't be added to
+
+    Parameters
+    ----------
+    :param save_loc: The directory in which the subhalos are saved
+    :type save_loc: str
+    :param simulation: The name of the simulation
+    :type simulation: str
+    :param label: The snapshot as it appears in the file names, such as
+    'z=0' or 'snapnum=135'
+    :type label: str
+    :param options: The options the subhalos are saved with, from
+    :func:`_ingest_options`
+    :type options: dict
+    :param sort_radius: Whether the particles are sorted by radius. Default
+    False
+    :type sort_radius: bool, optional
+    :param float32: Whether the columns are saved in single precision.
+    Default False
+    :type float32: bool, optional
+
+    Returns
+    -------
+    :return halo_store: The store, opened to append
+    :rtype halo_store: :class:`halo_store.HaloStore`
+    """
+    attrs = {"simulation":simulation, "snapshot":label, "options":options}
+    store_loc = os.path.join(save_loc, "subhalo_store_{}_{}".format(
+        simulation, label))
+    halo_store = HaloStore(store_loc, mode="a", sort_radius=sort_radius,
+                           float32=float32, attrs=attrs)
+    if (halo_store.attrs.get("simulation") != simulation or
+            halo_store.attrs.get("snapshot") != label):
+        halo_store.close()
+        raise ValueError("The subhalo store {} was saved for another snapshot "
+                         "than {} {}".format(store_loc, simulation, label))
+    if halo_store.attrs.get("options") != options:
+        halo_store.close()
+        raise ValueError("The subhalo store in {} was saved with other "
+                         "options than {}, so use another save_loc".format(
+                             save_loc, options))
+    return halo_store
+
+
+def _write_halo(i, df, save_loc, fname_base, sort_radius=False,
+                halo_store=None):
+    """A private function to be used behind the scenes for saving the
+    particles of a single subhalo, either in a consolidated store (unless
+    already there) or as a file of its own
+
+    Parameters
+    ----------
+    :param i: The ID of the subhalo
+    :type i: int
+    :param df: The particles of the subhalo
+    :type df: pandas DataFrame
+    :param save_loc: The directory in which to save the subhalo
+    :type save_loc: str
+    :param fname_base: The name of the file for a subhalo, to be formatted
+    with its ID
+    :type fname_base: str
+    :param sort_radius: Whether to sort the particles of a file by radius.
+    The store sorts them itself. Default False
+    :type sort_radius: bool, optional
+    :param halo_store: The store to save the subhalo in, or None to save it
+    as a file. Default None
+    :type halo_store: :class:`halo_store.HaloStore`, optional
+
+    Returns
+    -------
+    :return filei: The name of the file or store the subhalo is saved in
+    :rtype filei: str
+    :return df: The particles as saved in a file, or :param:`df` if saved in
+    the store
+    :rtype df: pandas DataFrame
+    """
+    if halo_store is not None:
+        if i not in halo_store:
+            halo_store.append(i, df)
+        return os.path.basename(halo_store.store_loc), df
+    if sort_radius:
+        df = sort_by_radius(df)
+    filei = fname_base.format(i)
+    df.to_pickle(os.path.join(save_loc, filei))
+    return filei, df
+
+
+def _done_record(i, filei, df, options, part_types, chunk_size=None):
+    """A private function to be used behind the scenes for the record of a
+    saved subhalo in the ingest manifest
+
+    Parameters
+    ----------
+    :param i: The ID of the subhalo
+    :type i: int
+    :param filei: The name of the file or store the subhalo is saved in
+    :type filei: str
+    :param df: The particles of the subhalo
+    :type df: pandas DataFrame
+    :param options: The options the subhalo was saved with, from
+    :func:`_ingest_options`
+    :type options: dict
+    :param part_types: The names of the particle types saved
+    :type part_types: list of str
+    :param chunk_size: The number of particles to read at once, or None to
+    read each column at once. Default None
+    :type chunk_size: int, optional
+
+    Returns
+    -------
+    :return record: The record, with the summary from :func:`_table_summary`
+    :rtype record: dict
+    """
+    record = {"id":i, "file":filei, "status":"done", "options":options}
+    record.update(_table_summary(df, part_types, chunk_size))
+    return record
+
+
+def _write_list_file(save_loc, simulation, label, file_list, r_min, r_max,
+                     sort_radius=False):
+    """A private function to be used behind the scenes for saving the list
+    file of the subhalos of a snapshot saved as files of their own, which
+    records the simulation and snapshot ('simulation' and 'snapshot') so
+    that their profiles can be found
+
+    Parameters
+    ----------
+    :param save_loc: The directory in which the subhalos are saved
+    :type save_loc: str
+    :param simulation: The name of the simulation
+    :type simulation: str
+    :param label: The snapshot as it appears in the file names, such as
+    'z=0' or 'snapnum=135'
+    :type label: str
+    :param file_list: The name of the file of each subhalo
+    :type file_list: list of str
+    :param r_min: The smallest radius of the particles of each subhalo
+    :type r_min: list of float
+    :param r_max: The largest radius of the particles of each subhalo
+    :type r_max: list of float
+    :param sort_radius: Whether the particles are sorted by radius. Default
+    False
+    :type sort_radius: bool, optional
+
+    Returns
+    -------
+    :return list_file: The path to the list file
+    :rtype list_file: str
+    """
+    list_file_loc = os.path.join(save_loc, "subhalo_list.npz")
+    np.savez_compressed(list_file_loc, file_list, r_min=r_min, r_max=r_max,
+                        sorted=sort_radius, simulation=simulation,
+                        snapshot=label)
+    return list_file_loc
+
+
+def _ingest_snapshot(snap, simulation, label, save_loc, executor,
+                     rate_limiter, n_workers=1, store=False,
+                     sort_radius=False, scratch_dir=None, in_memory_bytes=0,
+                     selection=None, page_limit=1000, max_halos=100,
+                     part_types=default_part_types, float32=False,
+                     chunk_size=None, profiles=False, in_flight=None):
+    """A private function to be used behind the scenes for saving the
+    subhalos of a single snapshot, as described in :func:`save_halos`. The
+    requests are made in an executor and with a rate limit that may be
+    shared with other snapshots, as may the limit on the number of subhalos
+    held in memory
+
+    Parameters
+    ----------
+    :param snap: The API document for the snapshot
+    :type snap: dict
+    :param simulation: The name of the simulation
+    :type simulation: str
+    :param label: The snapshot as it appears in the file names, such as
+    'z=0' or 'snapnum=135'
+    :type label: str
+    :param save_loc: The directory in which to save the results
+    :type save_loc: str
+    :param executor: The threads in which to fetch subhalos
+    :type executor: :class:`concurrent.futures.ThreadPoolExecutor`
+    :param rate_limiter: The limit on the rate of requests
+    :type rate_limiter: :class:`_RateLimiter`
+    :param in_flight: A slot is taken from this semaphore for each subhalo
+    being fetched or waiting to be saved, or None to allow
+    2 * :param:`n_workers` of them for this snapshot alone. Default None
+    :type in_flight: :class:`threading.Semaphore`, optional
+
+    The remaining parameters are as for :func:`save_halos`, except that
+    :param:`n_workers` only sets how many subhalos are fetched at a time
+
+    Returns
+    -------
+    :return list_file: The path to the list file, or to the consolidated
+    store if :param:`store` is True
+    :rtype list_file: str
+    """
+    selection = _check_ingest_options(n_workers, store, sort_radius,
+                                      selection, part_types, chunk_size)
+    if max_halos is None:
+        max_halos = np.inf
+    sub_url = "{}{{}}".format(snap["subhalos"])
+    
+    file_list = []
+    r_min = []
+    r_max = []
+    fname_base = "{}_{}_subhalo{{}}.pickle.gz".format(simulation, label)
+    a = 1.0 / (1.0 + snap["redshift"])
+    query_params = _check_part_types(part_types)
+    options = _ingest_options(sort_radius, part_types, float32)
+    if in_flight is None:
+        in_flight = threading.Semaphore(2 * n_workers)
+    halo_store = None
+    if store:
+        halo_store = _open_halo_store(save_loc, simulation, label, options,
+                                      sort_radius, float32)
+    if profiles is True:
+        profiles = default_profile_grids
+    profiles_dir = _profiles_dir(save_loc, simulation, label)
+    profile_stores = [ProfileStore(os.path.join(profiles_dir, name), mode="a",
+                                   grid=grid) for (name, grid) in
+                      sorted((profiles or {}).items())]
+
+    # The manifest is shared by every snapshot saved in save_loc, so only the
+    # records of subhalos saved in the files of this snapshot are used.
+    # Subhalo files saved with other options are fetched again and replaced
+    manifest_loc = os.path.join(save_loc, manifest_name)
+    if store:
+        saved_name = os.path.basename(halo_store.store_loc)
+    else:
+        saved_name = fname_base
+    recorded = _read_manifest(manifest_loc, saved_name)
+    if store:
+        completed = dict((i, record) for (i, record) in recorded.items() if
+                         i in halo_store)
+    else:
+        completed = dict((i, record) for (i, record) in recorded.items() if
+                         record.get("options") == options and
+                         os.path.isfile(os.path.join(save_loc,
+                                                     record["file"])))
+
+    def _add_profiles(i, df=None):
+        # Profiles are added after the particles are saved, so subhalos
+        # saved without profiles get them from the saved particles
+        missing = [profile_store for profile_store in profile_stores if i not
+                   in profile_store]
+        if not missing:
+            return
+        if df is None:
+            if store:
+                df = halo_store.read(i)
+            else:
+                df = pd.read_pickle(os.path.join(save_loc,
+                                                 completed[i]["file"]))
+        with timed("profile"):
+            for profile_store in missing:
+                profile_store.append(i, compute_profile(
+                    df, profile_store.edges, chunk_size))
+
+    def _add(record):
+        file_list.append(record["file"])
+        r_min.append(record["r_min"])
+        r_max.append(record["r_max"])
+        progress("ingest", len(file_list), total, record["id"])
+
+    def _fetch(sub, timing):
+        with activate(timing):
+            if chunk_size is None:
+                return _halo_table(sub, query_params, a, rate_limiter,
+                                   run_scratch_dir, in_memory_bytes,
+                                   part_types, float32)
+            return sub, _download_cutout(sub, query_params, rate_limiter,
+                                         run_scratch_dir, in_memory_bytes)
+
+    def _save(i, future, timing):
+        with activate(timing):
+            try:
+                df = future.result()
+                if chunk_size is not None:
+                    # Stream the cutout into the store, then summarize the
+                    # stored particles a chunk at a time
+                    sub, saved_filename = df
+                    if i not in halo_store:
+                        with timed("write"), h5py.File(saved_filename,
+                                                       "r") as f:
+                            halo_store.append_chunks(i, _store_chunks(
+                                f, sub, a, part_types, float32, chunk_size))
+                    _remove_cutout(saved_filename)
+                    with timed("load"):
+                        df = halo_store.read(i)
+            except Exception as err:
+                _append_manifest(manifest_loc, {"id":i, "status":"failed",
+                                                "file":saved_name.format(i),
+                                                "error":repr(err)})
+                finish_record(timing, status="failed")
+                raise
+            with timed("write"):
+                filei, df = _write_halo(i, df, save_loc, fname_base,
+                                        sort_radius, halo_store)
+            _add_profiles(i, df)
+            with timed("write"):
+                record = _done_record(i, filei, df, options, part_types,
+                                      chunk_size)
+                _append_manifest(manifest_loc, record)
+        finish_record(timing, status="done", **dict(
+            (key, record[key]) for key in record if key.startswith("n_")))
+        _add(record)
+
+    def _get_sub(i):
+        rate_limiter.wait()
+        return get(sub_url.format(i))
+
+    def _submit(i, sub):
+        # Profiles can't be replaced either, so a subhalo file saved with
+        # other options can't be fetched again once it has profiles
+        if (i in recorded and recorded[i].get("options") != options and
+                any(i in profile_store for profile_store in profile_stores)):
+            raise ValueError("Subhalo {} in {} was saved with other options "
+                             "than {} and already has profiles, so use another "
+                             "save_loc".format(i, save_loc, options))
+        # Take a slot for the subhalo, saving the oldest subhalos of this
+        # snapshot to free one if needed. Without any of its own to save,
+        # this snapshot waits for others to free a slot
+        while not in_flight.acquire(False):
+            if not pending:
+                in_flight.acquire()
+                break
+            _save_next()
+        timing = new_record("ingest", i)
+        try:
+            future = executor.submit(_fetch, sub, timing)
+        except BaseException:
+            in_flight.release()
+            raise
+        pending.append((i, future, timing))
+
+    def _save_next():
+        i, future, timing = pending.popleft()
+        if future is None:
+            _add_profiles(i)
+            _add(completed[i])
+            return
+        try:
+            _save(i, future, timing)
+        finally:
+            in_flight.release()
+
+    # Subhalo documents of the listed subhalos are fetched in batches, and
+    # cutouts are downloaded in the background while later batches are
+    # checked. Results are saved in order of subhalo ID, so the selection
+    # doesn't depend on n_workers. Subhalos completed in an earlier run keep
+    # their place in the order without being fetched again
+    selected_ids = _iter_selected_ids(snap["subhalos"], selection, page_limit,
+                                      rate_limiter)
+    n_selected = 0
+    total = None if np.isinf(max_halos) else int(max_halos)
+    pending = deque()
+    run_scratch_dir = tempfile.mkdtemp(prefix=".scratch_", dir=(
+        save_loc if scratch_dir is None else scratch_dir))
+    try:
+        while n_selected < max_halos:
+            ids = list(islice(selected_ids,
+                              int(min(n_workers, max_halos - n_selected))))
+            if not ids:
+                break
+            new_ids = [i for i in ids if i not in completed]
+            subs = dict(zip(new_ids, executor.map(_get_sub, new_ids)))
+            for i in ids:
+                if i in completed:
+                    pending.append((i, None, None))
+                    n_selected += 1
+                elif _is_selected(subs[i], selection):
+                    _submit(i, subs[i])
+                    n_selected += 1
+            while pending and (pending[0][1] is None or
+                               pending[0][1].done()):
+                _save_next()
+        while pending:
+            _save_next()
+    finally:
+        # Slots of subhalos that won't be saved after an error are freed
+        # for any other snapshots
+        for (i, future, timing) in pending:
+            if future is not None:
+                future.cancel()
+                in_flight.release()
+        shutil.rmtree(run_scratch_dir, ignore_errors=True)
+    for profile_store in profile_stores:
+        profile_store.close()
+    if store:
+        halo_store.close()
+        return halo_store.store_loc
+    return _write_list_file(save_loc, simulation, label, file_list, r_min,
+                            r_max, sort_radius)
+
+
+def save_halos(simulation, save_loc, z=None, snapnum=None, store=False,
+               sort_radius=False, n_workers=1, max_rate=None,
+               scratch_dir=None, in_memory_bytes=0, selection=None,
+               page_limit=1000, max_halos=100, part_types=default_part_types,
+               float32=False, chunk_size=None, profiles=False):
     """Save the info for each subhalo in :param:`sumulation` at redshift
     :param:`z`. The results are stored in one file per subhalo, with each
-    file containing the radii, masses, and velocities of gas and stars
-    associated with the subhalo. The files are stored at :param:`save_loc`,
-    as well as a file containing a list of the subhalo file names. The file
-    path for the list file will be returned for future use. Only the first 100
-    halos identified as galaxies will be saved.
+    file containing the radii, masses, and velocities of the particles
+    (gas and stars by default) associated with the subhalo. The files are
+    stored at :param:`save_loc`, as well as a file containing a list of the
+    subhalo file names. The file path for the list file will be returned for
+    future use. Only the first :param:`max_halos` halos identified as
+    galaxies will be saved.
+    
+    Each subhalo is recorded in an ingest manifest ('ingest_manifest.jsonl'
+    in :param:`save_loc`) as soon as it is saved, with its ID, file, particle
+    counts, and a checksum of its particles. Running again with the same
+    :param:`save_loc` skips any subhalos already recorded there, so an
+    interrupted run resumes where it stopped, and :param:`max_halos` can be
+    increased later to add more subhalos. Subhalos are only reused if they
+    were saved with the same :param:`sort_radius`, :param:`part_types`, and
+    :param:`float32`: other subhalo files are fetched again, while a
+    consolidated store (or a subhalo with saved profiles) from other options
+    raises a ValueError, as they can't be replaced.
     
     Parameters
     ----------
@@ -109,112 +1709,205 @@ def save_halos(simulation, save_loc, z=None, snapnum=None):
     :param:`z` is given. If both are provided, :param:`z` will be preferred.
     Default None
     :type snapnum: int, optional
+    :param store: If True, save all subhalos to a single consolidated store
+    (see :class:`halo_store.HaloStore`) for the snapshot in :param:`save_loc`
+    (named 'subhalo_store_<simulation>_<snapshot>', e.g.
+    'subhalo_store_Illustris-1_snapnum=135') rather than one file per
+    subhalo. Default False
+    :type store: bool, optional
+    :param sort_radius: If True, the particles of each subhalo are saved
+    sorted by radius, with the extra column 'M_enc' giving the mass enclosed
+    within the radius of each particle (including the particle itself). This
+    makes later calculations in any radial bins a binary search rather than
+    a scan of all particles. Default False
+    :type sort_radius: bool, optional
+    :param n_workers: The number of threads to use for fetching subhalo
+    documents and downloading cutouts. The subhalos saved are the same for
+    any number of threads. Default 1
+    :type n_workers: int, optional
+    :param max_rate: The maximum number of requests to start per second, or
+    None for no limit. Default None
+    :type max_rate: float, optional
+    :param scratch_dir: The directory in which to download cutouts while
+    they are read. A temporary directory is made inside this directory (or
+    inside :param:`save_loc` if None) and removed when done, so that
+    separate runs never share downloaded files. Default None
+    :type scratch_dir: str, optional
+    :param in_memory_bytes: Cutouts of at most this many bytes are read in
+    memory rather than saved to the scratch directory. Default 0
+    :type in_memory_bytes: int, optional
+    :param selection: Filters on the fields of the subhalo documents for
+    choosing which subhalos to save, with keys of the form 'field__op' for a
+    comparison op of 'gt', 'gte', 'lt', or 'lte', or just 'field' for
+    equality. For instance, `{"mass_stars__gte": 1.0, "mass_gas__gt": 0}`.
+    The filters are applied by the API when listing subhalos, so only the
+    documents of selected subhalos are fetched. Default None (both
+    'mass_stars' and 'mass_gas' greater than 0)
+    :type selection: dict, optional
+    :param page_limit: The number of subhalos to request per page of the
+    listing. Default 1000
+    :type page_limit: int, optional
+    :param max_halos: The maximum number of subhalos to save, or None to save
+    every selected subhalo. Default 100
+    :type max_halos: int or None, optional
+    :param part_types: The names of the particle types to save for each
+    subhalo, out of 'gas', 'dm', and 'star'. Dark matter particles all have
+    the mass given in the header of the cutout. Default ("gas", "star")
+    :type part_types: list of str, optional
+    :param float32: If True, the radii, masses, and speeds are calculated in
+    double precision but saved in single precision, halving the size of the
+    saved columns, in subhalo files and consolidated stores alike. Default
+    False
+    :type float32: bool, optional
+    :param chunk_size: If given, each cutout is read, converted, and written
+    to the consolidated store in slabs of at most this many particles, so the
+    memory used depends on :param:`chunk_size` rather than the size of the
+    largest subhalo. The saved particles are exactly the same as without
+    chunking. Requires :param:`store` to be True, and can't be used with
+    :param:`sort_radius`, which needs all particles of a subhalo at once.
+    Default None
+    :type chunk_size: int, optional
+    :param profiles: If True, also save the profile of each subhalo on the
+    fine base grids of :data:`halo_profiles.default_profile_grids`, in the
+    directory 'subhalo_profiles' in :param:`save_loc`. The calc functions
+    use these profiles instead of the particles for any bins whose edges
+    fall on one of the grids. A dict of named grids may be given instead to
+    use other grids (see :func:`halo_profiles.grid_edges`). Subhalos saved
+    earlier without profiles get them from their saved particles. Default
+    False
+    :type profiles: bool or dict, optional
     
     Returns
     -------
     :return list_file: The path to the file created containing the list of
-    output file names
+    output file names, or the path to the consolidated store if
+    :param:`store` is True. The list file also holds the minimum ('r_min')
+    and maximum ('r_max') particle radius of each subhalo, and whether the
+    particles are sorted by radius ('sorted')
     :rtype list_file: str
     
     :TODO: Decide on definition of subhalo as a 'galaxy'. Is :math:`M_{gas} >
     0` and :math:`M_{stars} > 0` good enough?
     """
-    mass_cut = 0.0
-    query_params = {
-        "stars":"Coordinates,Masses,Velocities",
-        "gas"  :"Coordinates,Masses,Velocities"}
-    base_url = "http://www.illustris-project.org/api/"
-    base = get(base_url)
-    valid_sims = [sim["name"] for sim in base["simulations"]]
-    if isinstance(simulation, int):
-        simulation = "Illustris-{}".format(simulation)
-    if not simulation in valid_sims:
-        raise ValueError("Invalid Illustris simulation: {}. Please use a valid "
-                         "simulation!".format(simulation))
-    sim = get(base["simulations"][valid_sims.index(simulation)]["url"])
+    selection = _check_ingest_options(n_workers, store, sort_radius,
+                                      selection, part_types, chunk_size)
+    rate_limiter = _RateLimiter(max_rate)
+    simulation, sim = _resolve_simulation(simulation)
+    snap = get(_snapshot_url(simulation, sim, z, snapnum))
+    label = "z={}".format(z) if z is not None else "snapnum={}".format(
+        snapnum)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        return _ingest_snapshot(snap, simulation, label, save_loc, executor,
+                                rate_limiter, n_workers, store, sort_radius,
+                                scratch_dir, in_memory_bytes, selection,
+                                page_limit, max_halos, part_types, float32,
+                                chunk_size, profiles)
+
+
+def save_halos_batch(simulation, save_loc, z=None, snapnum=None, store=False,
+                     sort_radius=False, n_workers=1, max_rate=None,
+                     scratch_dir=None, in_memory_bytes=0, selection=None,
+                     page_limit=1000, max_halos=100,
+                     part_types=default_part_types, float32=False,
+                     chunk_size=None, profiles=False):
+    """Save the subhalos of several snapshots of :param:`simulation`, as
+    :func:`save_halos` does for a single snapshot. The simulation and its
+    list of snapshots are only looked up once, and the snapshots are all
+    saved at the same time, sharing one set of :param:`n_workers` threads
+    and one limit of :param:`max_rate` requests per second between them.
+    
+    The results for each snapshot are saved in their own directory inside
+    :param:`save_loc`, named for the simulation and snapshot (for instance
+    'Illustris-1_snapnum=135'), with the same files as from
+    :func:`save_halos`. Once a snapshot is complete, a record of the options
+    used is saved with it ('ingest_complete.json'), and a snapshot that was
+    already completed with the same options is not requested again. A
+    snapshot that was only partly saved, or saved with different options,
+    resumes from its ingest manifest as in :func:`save_halos`, and at most
+    2 * :param:`n_workers` subhalos are held in memory for all snapshots
+    together.
+    
+    Parameters
+    ----------
+    :param simulation: The name of the Illustris simulation to query,
+    or an integer to reference one of 'Illustris-1', 'Illustris-2',
+    or 'Illustris-3'
+    :type simulation: str or int
+    :param save_loc: The directory in which to make the directory for each
+    snapshot
+    :type save_loc: str
+    :param z: The redshifts of the snapshots to save. If both this and
+    :param:`snapnum` are given, this will be preferred. Default None
+    :type z: 1D array-like float, optional
+    :param snapnum: The numbers of the snapshots to save. Default None
+    :type snapnum: 1D array-like int, optional
+    
+    The remaining parameters are as for :func:`save_halos`, with
+    :param:`n_workers` and :param:`max_rate` applying to all snapshots
+    together
+    
+    Returns
+    -------
+    :return list_files: The path to the list file (or consolidated store) for
+    each snapshot, keyed by the redshift or snapshot number as given, in the
+    order given
+    :rtype list_files: :class:`collections.OrderedDict`
+    """
     if z is None and snapnum is None:
         raise ValueError("At least one of z and snapnum MUST be given")
-    if z is None:
-        sim_snaps = get(sim["snapshots"])
-        snapnum = int(snapnum)
-        sim_snapnums = [snap["number"] for snap in sim_snaps]
-        if not snapnum in sim_snapnums:
-            raise ValueError(
-                  "Invalid snapshot number for simulation {}: {}. Please use a "
-                  "valid snapshot number for this simulation".format(simulation,
-                                                                     snapnum))
-        snap_url = sim_snaps[sim_snapnums.index(snapnum)]["url"]
+    selection = _check_ingest_options(n_workers, store, sort_radius,
+                                      selection, part_types, chunk_size)
+    options = json.loads(json.dumps({
+        "store":store, "sort_radius":sort_radius, "selection":selection,
+        "max_halos":max_halos, "part_types":list(part_types),
+        "float32":float32, "profiles":profiles}))
+    rate_limiter = _RateLimiter(max_rate)
+    simulation, sim = _resolve_simulation(simulation)
+    if z is not None:
+        snap_keys = list(np.atleast_1d(z).tolist())
+        snap_urls = [_snapshot_url(simulation, sim, z=zi) for zi in snap_keys]
+        labels = ["z={}".format(zi) for zi in snap_keys]
     else:
-        snap_url = sim["snapshots"] + "z={}/".format(float(z))
-    snap = get(snap_url)
-    sub_url = "{}{{}}".format(snap["subhalos"])
-    
-    file_list = []
-    fname_base = "{}_{}={}_subhalo{{}}.pickle.gz".format(simulation,
-                                                         "z" if z is not None
-                                                         else "snapnum",
-                                                         z if z is not None
-                                                         else snapnum)
-    z = snap["redshift"]
-    a = 1.0 / (1.0 + z)
-    for i in range(snap["num_groups_subfind"]):
-        if len(file_list) >= 100:
-            break
-        sub = get(sub_url.format(i))
-        if sub["mass_stars"] > mass_cut and sub["mass_gas"] > mass_cut:
-            saved_filename = get(sub["cutouts"]["subhalo"], query_params)
-            with h5py.File(saved_filename, "r") as f:
-                # Get gas data
-                dx = np.asarray(f["PartType0"]["Coordinates"][:, 0] -
-                        sub["pos_x"], dtype=float)
-                dy = np.asarray(f["PartType0"]["Coordinates"][:, 1] -
-                        sub["pos_y"], dtype=float)
-                dz = np.asarray(f["PartType0"]["Coordinates"][:, 2] -
-                        sub["pos_z"], dtype=float)
-                r_gas = np.sqrt(dx**2 + dy**2 + dz**2) * a / hubble_param
-                vx = np.asarray(f["PartType0"]["Velocities"][:, 0] * np.sqrt(a) 
-                        - sub["vel_x"], dtype=float)
-                vy = np.asarray(f["PartType0"]["Velocities"][:, 1] * np.sqrt(a) 
-                        - sub["vel_y"], dtype=float)
-                vz = np.asarray(f["PartType0"]["Velocities"][:, 2] * np.sqrt(a) 
-                        - sub["vel_z"], dtype=float)
-                v_gas = np.sqrt(vx**2 + vy**2 + vz**2)
-                m_gas = np.asarray(f["PartType0"]["Masses"], dtype=float) 
-                m_gas *= (10**10 / hubble_param)
-                type_gas = np.full(m_gas.size, "gas")
-                
-                # Get star data
-                dx = np.asarray(f["PartType4"]["Coordinates"][:, 0] -
-                        sub["pos_x"], dtype=float)
-                dy = np.asarray(f["PartType4"]["Coordinates"][:, 1] -
-                        sub["pos_y"], dtype=float)
-                dz = np.asarray(f["PartType4"]["Coordinates"][:, 2] -
-                        sub["pos_z"], dtype=float)
-                r_stars = np.sqrt(dx**2 + dy**2 + dz**2) * a / hubble_param
-                vx = np.asarray(f["PartType4"]["Velocities"][:, 0] * np.sqrt(a)
-                        - sub["vel_x"], dtype=float)
-                vy = np.asarray(f["PartType4"]["Velocities"][:, 1] * np.sqrt(a)
-                        - sub["vel_y"], dtype=float)
-                vz = np.asarray(f["PartType4"]["Velocities"][:, 2] * np.sqrt(a)
-                        - sub["vel_z"], dtype=float)
-                v_stars = np.sqrt(vx**2 + vy**2 + vz**2)
-                m_stars = np.asarray(f["PartType4"]["Masses"], dtype=float) 
-                m_stars *= (10**10 / hubble_param)
-                type_stars = np.full(m_stars.size, "star")
-                
-                # Put in DataFrame
-                df = pd.DataFrame.from_dict({
-                    "r"   :np.append(r_gas, r_stars),
-                    "M"   :np.append(m_gas, m_stars),
-                    "v"   :np.append(v_gas, v_stars),
-                    "type":np.append(type_gas, type_stars)})
-                df.to_pickle(os.path.join(save_loc, fname_base.format(i)))
-                file_list.append(fname_base.format(i))
-            os.remove(saved_filename)
-    list_file_loc = os.path.join(save_loc, "subhalo_list.npz")
-    np.savez_compressed(list_file_loc, file_list)
-    return list_file_loc
+        snap_keys = list(np.atleast_1d(snapnum).tolist())
+        sim_snaps = get(sim["snapshots"])
+        snap_urls = [_snapshot_url(simulation, sim, snapnum=sn,
+                                   sim_snaps=sim_snaps) for sn in snap_keys]
+        labels = ["snapnum={}".format(sn) for sn in snap_keys]
+
+    def _save_snapshot(snap_url, label):
+        snap_dir = os.path.join(save_loc, "{}_{}".format(simulation, label))
+        record_loc = os.path.join(snap_dir, batch_record_name)
+        if os.path.isfile(record_loc):
+            with open(record_loc) as f:
+                record = json.load(f)
+            result = os.path.join(snap_dir, record["result"])
+            if record["options"] == options and os.path.exists(result):
+                return result
+        if not os.path.isdir(snap_dir):
+            os.makedirs(snap_dir)
+        rate_limiter.wait()
+        result = _ingest_snapshot(get(snap_url), simulation, label, snap_dir,
+                                  executor, rate_limiter, n_workers, store,
+                                  sort_radius, scratch_dir, in_memory_bytes,
+                                  selection, page_limit, max_halos,
+                                  part_types, float32, chunk_size,
+                                  profiles, in_flight)
+        with open(record_loc + ".tmp", "w") as f:
+            json.dump({"options":options,
+                       "result":os.path.relpath(result, snap_dir)}, f,
+                      indent=1, sort_keys=True)
+        _replace(record_loc + ".tmp", record_loc)
+        return result
 
+    # Each snapshot is driven from its own thread, which only waits on the
+    # shared workers, so the snapshots interleave their requests. The
+    # subhalos held in memory are limited for all snapshots together
+    in_flight = threading.Semaphore(2 * n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        with ThreadPoolExecutor(max_workers=max(1, min(
+                n_workers, len(snap_urls)))) as drivers:
+            results = list(drivers.map(_save_snapshot, snap_urls, labels))
+    return OrderedDict(zip(snap_keys, results))
 
 if __name__ == "__main__":
     import doctest
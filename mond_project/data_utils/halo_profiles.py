@@ -0,0 +1,416 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import os
+import numpy as np
+from .halo_store import is_store, open_store
+
+
+# Version of the profile store layout
+profile_version = 2
+
+# Name of the file in a profile store holding the subhalo ID of each row
+profile_index_name = "ids.bin"
+
+# Base grids for the profiles saved by data_read_utils.save_halos. Any bins
+# whose edges fall on the edges of one of these grids can be calculated from
+# the profiles without reading the particles
+default_profile_grids = {
+    "linear":{"spacing":"linear", "start":0.0, "stop":300.0, "step":0.1},
+    "log"   :{"spacing":"log", "start":-2.0, "stop":3.0, "step":0.01}}
+
+# Quantities saved for each bin of a profile, and their data types
+profile_columns = {"count":"<i8", "sum_v2_r":"<f8", "sum_inv_r2":"<f8",
+                   "sum_m":"<f8", "m_enc":"<f8"}
+
+# Start of the name of the directory holding the profile stores for a
+# snapshot, which is followed by the simulation and snapshot
+profiles_name = "subhalo_profiles"
+
+
+def grid_edges(grid):
+    """Get the bin edges of a profile base grid
+
+    Parameters
+    ----------
+    :param grid: The grid, with the spacing ('spacing', either 'linear' or
+    'log'), and the first edge ('start'), last edge ('stop'), and bin width
+    ('step'), all in kpc for a linear grid or in dex for a log grid
+    :type grid: dict
+
+    Returns
+    -------
+    :return edges: The bin edges, in kpc
+    :rtype edges: 1D array float
+    """
+    n_bins = int(round((grid["stop"] - grid["start"]) / grid["step"]))
+    if n_bins < 1:
+        raise ValueError("Profile grid must have at least one bin")
+    edges = grid["start"] + grid["step"] * np.arange(n_bins + 1)
+    if grid["spacing"] == "log":
+        return 10**edges
+    if grid["spacing"] != "linear":
+        raise ValueError("Invalid profile grid spacing: {}".format(
+            grid["spacing"]))
+    return edges
+
+
+def compute_profile(data, edges, chunk_size=None):
+    """Calculate the profile of a single subhalo on a base grid. For each
+    bin, the profile holds the number of particles ('count'), the sums of
+    :math:`v^2 / r` ('sum_v2_r'), :math:`1 / r^2` ('sum_inv_r2'), and mass
+    ('sum_m') over the particles in the bin, and the mass enclosed within
+    the inner edge of the bin ('m_enc'). Bins include their inner edge but
+    not their outer edge
+
+    Parameters
+    ----------
+    :param data: The particles of the subhalo, with at least the columns
+    'r', 'M', and 'v'
+    :type data: pandas DataFrame or dict
+    :param edges: The edges of the base grid
+    :type edges: 1D array float
+    :param chunk_size: The number of particles to read at once, or None to
+    read all particles at once. Default None
+    :type chunk_size: int, optional
+
+    Returns
+    -------
+    :return profile: The array of each quantity in every bin
+    :rtype profile: dict
+    """
+    n_bins = edges.size - 1
+    r_all = np.asarray(data["r"])
+    m_all = np.asarray(data["M"])
+    v_all = np.asarray(data["v"])
+    profile = dict((col, np.zeros(n_bins, dtype=dtype)) for (col, dtype) in
+                   profile_columns.items())
+    m_inside = 0.0
+    step = max(r_all.size if chunk_size is None else int(chunk_size), 1)
+    for start in range(0, r_all.size, step):
+        r = np.asarray(r_all[start:start + step], dtype=float)
+        m = np.asarray(m_all[start:start + step], dtype=float)
+        v = np.asarray(v_all[start:start + step], dtype=float)
+        idx = np.searchsorted(edges, r, side="right") - 1
+        m_inside += m[idx < 0].sum()
+        in_bins = (idx >= 0) & (idx < n_bins)
+        idx = idx[in_bins]
+        r = r[in_bins]
+        profile["count"] += np.bincount(idx, minlength=n_bins)
+        profile["sum_v2_r"] += np.bincount(idx, weights=v[in_bins]**2 / r,
+                                           minlength=n_bins)
+        profile["sum_inv_r2"] += np.bincount(idx, weights=r**-2,
+                                             minlength=n_bins)
+        profile["sum_m"] += np.bincount(idx, weights=m[in_bins],
+                                        minlength=n_bins)
+    profile["m_enc"][0] = m_inside
+    profile["m_enc"][1:] = m_inside + np.cumsum(profile["sum_m"][:-1])
+    return profile
+
+
+class ProfileStore(object):
+    """The profiles of all subhalos in a snapshot on a single base grid. The
+    store is a directory containing one raw binary file per quantity, with
+    one row of bins per subhalo, and an index of the subhalo ID of each row,
+    to which each ID is appended once the bins of the subhalo are written.
+    The files are memory mapped, so reading a range of bins for a set of
+    subhalos only reads those bins from disk
+
+    Parameters
+    ----------
+    :param store_loc: The directory of the store
+    :type store_loc: str
+    :param mode: 'r' to open an existing store for reading, or 'a' to open a
+    store for appending, creating it if it doesn't exist. Default 'r'
+    :type mode: str, optional
+    :param grid: The base grid of a new store, as for :func:`grid_edges`.
+    Required when creating a store, and must match the grid of an existing
+    store opened for appending. Default None
+    :type grid: dict, optional
+    """
+    def __init__(self, store_loc, mode="r", grid=None):
+        if mode not in ("r", "a"):
+            raise ValueError("Invalid store mode: {}".format(mode))
+        self.store_loc = os.path.abspath(store_loc)
+        self.mode = mode
+        meta_file = os.path.join(self.store_loc, "profile.json")
+        if not os.path.isfile(meta_file):
+            if mode == "r":
+                raise IOError("No profile store found at {}".format(
+                    store_loc))
+            if grid is None:
+                raise ValueError("A grid is needed to create a profile store")
+            if not os.path.isdir(self.store_loc):
+                os.makedirs(self.store_loc)
+            grid_edges(grid)
+            # The metadata is written last, as it marks the store as made
+            open(self._index_file(), "ab").close()
+            with open(meta_file, "w") as f:
+                json.dump({"version":profile_version, "grid":grid}, f,
+                          indent=1, sort_keys=True)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta["version"] != profile_version:
+            raise IOError("Unsupported profile store version: {}".format(
+                meta["version"]))
+        self.grid = meta["grid"]
+        if grid is not None and grid != self.grid:
+            raise ValueError("Profile store at {} has a different grid".format(
+                store_loc))
+        self.edges = grid_edges(self.grid)
+        self.n_bins = self.edges.size - 1
+        n_profiles = os.path.getsize(self._index_file()) // 8
+        self._id_list = np.fromfile(self._index_file(), dtype="<i8",
+                                    count=n_profiles).tolist()
+        # The row of each subhalo, so finding one doesn't scan every ID
+        self._rows = dict((id, i) for (i, id) in enumerate(self._id_list))
+        self._ids = None
+        self._maps = {}
+        if mode == "a":
+            # Drop anything written after the last complete profile
+            with open(self._index_file(), "ab") as f:
+                f.truncate(n_profiles * 8)
+            for (col, dtype) in profile_columns.items():
+                nbytes = n_profiles * self.n_bins * np.dtype(dtype).itemsize
+                with open(self._column_file(col), "ab") as f:
+                    f.truncate(nbytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._id_list)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    @property
+    def ids(self):
+        """The subhalo ID of each row, in the order they were added"""
+        if self._ids is None:
+            self._ids = np.array(self._id_list, dtype=np.int64)
+        return self._ids
+
+    def _index_file(self):
+        return os.path.join(self.store_loc, profile_index_name)
+
+    def _column_file(self, col):
+        return os.path.join(self.store_loc, "{}.bin".format(col))
+
+    def _column(self, col):
+        """Get the memory mapped array of quantity :param:`col` for every
+        subhalo and bin
+        """
+        if col not in self._maps:
+            if len(self) == 0:
+                self._maps[col] = np.zeros((0, self.n_bins),
+                                           dtype=profile_columns[col])
+            else:
+                self._maps[col] = np.memmap(
+                    self._column_file(col), dtype=profile_columns[col],
+                    mode="r", shape=(len(self), self.n_bins))
+        return self._maps[col]
+
+    def read(self, ids, columns=None, start=0, stop=None):
+        """Read a range of bins of the profiles for a set of subhalos
+
+        Parameters
+        ----------
+        :param ids: The subhalo IDs
+        :type ids: 1D array-like int
+        :param columns: The names of the quantities to read, or None for all
+        quantities. Default None
+        :type columns: list of str, optional
+        :param start: The first bin to read. Default 0
+        :type start: int, optional
+        :param stop: The bin after the last bin to read, or None for the last
+        bin. Default None
+        :type stop: int, optional
+
+        Returns
+        -------
+        :return profiles: The array of each requested quantity, with one row
+        per subhalo in the order of :param:`ids` and one column per bin
+        :rtype profiles: dict
+        """
+        if columns is None:
+            columns = list(profile_columns)
+        try:
+            rows = np.array([self._rows[id] for id in
+                             np.atleast_1d(ids).tolist()], dtype=np.int64)
+        except KeyError:
+            raise KeyError("One or more subhalos not found in profile store")
+        return dict((col, np.array(self._column(col)[:, start:stop][rows]))
+                    for col in columns)
+
+    def append(self, id, profile):
+        """Add the profile of a single subhalo to the end of the store. The
+        quantity files are written before the index, so a profile is only
+        part of the store once it has been completely written
+
+        Parameters
+        ----------
+        :param id: The subhalo ID
+        :type id: int
+        :param profile: The profile on the grid of the store, as from
+        :func:`compute_profile`
+        :type profile: dict
+        """
+        if self.mode != "a":
+            raise IOError("Profile store not opened for appending")
+        if id in self:
+            raise ValueError("Subhalo {} already in profile store".format(id))
+        arrays = dict((col, np.asarray(profile[col], dtype=dtype)) for
+                      (col, dtype) in profile_columns.items())
+        if any(arr.shape != (self.n_bins,) for arr in arrays.values()):
+            raise ValueError("Profile does not match the grid of the store")
+        for col in profile_columns:
+            with open(self._column_file(col), "ab") as f:
+                f.write(arrays[col].tobytes())
+        with open(self._index_file(), "ab") as f:
+            f.write(np.array([id], dtype="<i8").tobytes())
+        self._rows[int(id)] = len(self._id_list)
+        self._id_list.append(int(id))
+        self._ids = None
+        self._maps = {}
+
+    def close(self):
+        """Release the memory maps for the store"""
+        self._maps = {}
+
+
+def _profiles_dir(save_loc, simulation=None, snapshot=None):
+    """A private function to be used behind the scenes for the directory of
+    the profile stores of a snapshot saved in :param:`save_loc`
+
+    Parameters
+    ----------
+    :param save_loc: The directory in which the subhalos are saved
+    :type save_loc: str
+    :param simulation: The name of the simulation, or None for subhalos saved
+    without their simulation and snapshot. Default None
+    :type simulation: str, optional
+    :param snapshot: The snapshot as it appears in the file names, such as
+    'z=0' or 'snapnum=135'. Default None
+    :type snapshot: str, optional
+
+    Returns
+    -------
+    :return profiles_dir: The directory holding a profile store for each
+    base grid
+    :rtype profiles_dir: str
+    """
+    if simulation is None or snapshot is None:
+        return os.path.join(save_loc, profiles_name)
+    return os.path.join(save_loc, "{}_{}_{}".format(profiles_name, simulation,
+                                                    snapshot))
+
+
+def profiles_loc(list_file_loc):
+    """Get the directory of the profiles for a snapshot, which is next to the
+    list file or consolidated store and named after the simulation and
+    snapshot recorded there
+
+    Parameters
+    ----------
+    :param list_file_loc: Location of the list file or consolidated store for
+    the snapshot
+    :type list_file_loc: str
+
+    Returns
+    -------
+    :return profiles_loc: The directory holding a profile store for each
+    base grid
+    :rtype profiles_loc: str
+    """
+    list_file_loc = os.path.abspath(list_file_loc)
+    if is_store(list_file_loc):
+        list_file_loc = list_file_loc.rstrip(os.sep)
+        attrs = open_store(list_file_loc).attrs
+    else:
+        with np.load(list_file_loc) as list_file:
+            attrs = dict((key, str(list_file[key])) for key in [
+                "simulation", "snapshot"] if key in list_file.files)
+    return _profiles_dir(os.path.dirname(list_file_loc),
+                         attrs.get("simulation"), attrs.get("snapshot"))
+
+
+_open_profiles = {}
+
+
+def open_profiles(list_file_loc):
+    """Open the profile stores for a snapshot for reading, reusing stores
+    that are already open if no profiles were added since
+
+    Parameters
+    ----------
+    :param list_file_loc: Location of the list file or consolidated store for
+    the snapshot
+    :type list_file_loc: str
+
+    Returns
+    -------
+    :return stores: The profile store for each base grid, keyed by the name
+    of the grid. Empty if no profiles were saved
+    :rtype stores: dict
+    """
+    loc = profiles_loc(list_file_loc)
+    stores = {}
+    if not os.path.isdir(loc):
+        return stores
+    for name in sorted(os.listdir(loc)):
+        store_loc = os.path.join(loc, name)
+        ids_file = os.path.join(store_loc, profile_index_name)
+        if not os.path.isfile(ids_file):
+            continue
+        # The index only grows, so its size changes with every profile even
+        # when its modification time doesn't
+        stamp = (os.path.getmtime(ids_file), os.path.getsize(ids_file))
+        if store_loc not in _open_profiles or _open_profiles[store_loc][
+                0] != stamp:
+            _open_profiles[store_loc] = (stamp, ProfileStore(store_loc))
+        stores[name] = _open_profiles[store_loc][1]
+    return stores
+
+
+def align_bins(edges, r_low, r_upp, rtol=1.e-9):
+    """Find the base grid edges matching the edges of a set of radial bins
+
+    Parameters
+    ----------
+    :param edges: The edges of the base grid
+    :type edges: 1D array float
+    :param r_low: Lower edge(s) of the radial bins
+    :type r_low: 1D array float
+    :param r_upp: Upper edge(s) of the radial bins
+    :type r_upp: 1D array float
+    :param rtol: The largest difference between a bin edge and a grid edge,
+    relative to the width of the grid bin, for them to be treated as the
+    same edge. Default 1e-9
+    :type rtol: float, optional
+
+    Returns
+    -------
+    :return i_low: The index of the grid edge at the lower edge of each bin,
+    or None if any bin edge is not on the grid
+    :rtype i_low: 1D array int or None
+    :return i_upp: The index of the grid edge at the upper edge of each bin,
+    or None if any bin edge is not on the grid
+    :rtype i_upp: 1D array int or None
+    """
+    widths = np.diff(edges)
+    idx = []
+    for r_edge in [r_low, r_upp]:
+        i = np.clip(np.searchsorted(edges, r_edge), 1, edges.size - 1)
+        i = np.where(np.abs(edges[i - 1] - r_edge) <
+                     np.abs(edges[i] - r_edge), i - 1, i)
+        tol = rtol * widths[np.clip(i, 0, widths.size - 1)]
+        if not np.all(np.abs(edges[i] - r_edge) <= tol):
+            return None, None
+        idx.append(i)
+    if not np.all(idx[1] > idx[0]):
+        return None, None
+    return idx[0], idx[1]
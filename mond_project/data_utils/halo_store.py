@@ -0,0 +1,503 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+# Version of the consolidated store layout
+store_version = 2
+
+# The file holding the index of a consolidated store
+index_name = "index.npz"
+
+# Data types of the columns in a consolidated store, and of the radius,
+# mass, and speed columns of a store in single precision. The data types of
+# each store are recorded in its metadata
+store_columns = {"r":"<f8", "M":"<f8", "v":"<f8", "type":"|i1"}
+float32_columns = {"r":"<f4", "M":"<f4", "v":"<f4"}
+
+# Integer codes used for the particle types in a consolidated store, matching
+# the Illustris particle type numbers
+type_codes = {"gas":0, "dm":1, "star":4}
+type_names = dict((code, name) for (name, code) in type_codes.items())
+
+# Categories of the particle type column in saved subhalo tables, in order of
+# their codes
+type_categories = [type_names[code] for code in sorted(type_names)]
+
+_replace = getattr(os, "replace", os.rename)
+
+
+def sort_by_radius(data):
+    """Sort the particles of a subhalo by increasing radius, and add the
+    column 'M_enc' with the mass enclosed within the radius of each particle,
+    including the particle itself. The enclosed mass is always summed in
+    double precision
+
+    Parameters
+    ----------
+    :param data: The particles of the subhalo, with at least the columns
+    'r' and 'M'
+    :type data: pandas DataFrame or dict
+
+    Returns
+    -------
+    :return data: The sorted particles with the added 'M_enc' column, of the
+    same type as :param:`data`
+    :rtype data: pandas DataFrame or dict
+    """
+    order = np.argsort(np.asarray(data["r"]), kind="mergesort")
+    if isinstance(data, pd.DataFrame):
+        data = data.iloc[order].reset_index(drop=True)
+        data["M_enc"] = np.cumsum(data["M"].values, dtype=float)
+        return data
+    data = dict((col, np.asarray(arr)[order]) for (col, arr) in data.items()
+                if col != "M_enc")
+    data["M_enc"] = np.cumsum(data["M"], dtype=float)
+    return data
+
+
+def encode_types(types):
+    """Convert particle types to the integer codes used in a consolidated
+    store
+
+    Parameters
+    ----------
+    :param types: The particle types, either as names (e.g. "gas" or "star")
+    or as integer codes already
+    :type types: 1D array-like str or int, or pandas Categorical
+
+    Returns
+    -------
+    :return codes: The integer code for each particle type
+    :rtype codes: 1D array int8
+    """
+    if isinstance(types, pd.Series):
+        types = types.values
+    if isinstance(types, pd.Categorical):
+        # Only the categories need converting, rather than every particle
+        return encode_types(np.asarray(types.categories))[types.codes]
+    types = np.asarray(types)
+    if types.dtype.kind in "iu":
+        return types.astype(np.int8)
+    if types.dtype.kind == "O":
+        types = types.astype(str)
+    names, inverse = np.unique(types, return_inverse=True)
+    for name in names:
+        if name not in type_codes:
+            raise ValueError("Unknown particle type: {}".format(name))
+    codes = np.array([type_codes[name] for name in names], dtype=np.int8)
+    return codes[inverse]
+
+
+def decode_types(codes):
+    """Convert the integer codes of particle types to the categorical names
+    used in the subhalo tables saved by :func:`data_read_utils.save_halos`
+
+    Parameters
+    ----------
+    :param codes: The integer code for each particle type
+    :type codes: 1D array-like int
+
+    Returns
+    -------
+    :return types: The name of each particle type, with categories
+    :data:`type_categories`
+    :rtype types: pandas Categorical
+    """
+    lookup = np.full(max(type_names) + 1, -1, dtype=np.int8)
+    for (i, name) in enumerate(type_categories):
+        lookup[type_codes[name]] = i
+    return pd.Categorical.from_codes(lookup[np.asarray(codes)],
+                                     categories=type_categories)
+
+
+class HaloStore(object):
+    """A consolidated store of the particles for all subhalos in a single
+    snapshot. The store is a directory containing one raw binary file per
+    column, with the particles of every subhalo concatenated, and an index of
+    subhalo IDs with the offset of each subhalo's first particle. The column
+    files are memory mapped, so reading a subhalo is a slice of the mapped
+    arrays and only the pages actually used are read from disk
+
+    Parameters
+    ----------
+    :param store_loc: The directory of the store
+    :type store_loc: str
+    :param mode: 'r' to open an existing store for reading, or 'a' to open a
+    store for appending, creating it if it doesn't exist. Default 'r'
+    :type mode: str, optional
+    :param sort_radius: If True when creating a new store, the particles of
+    each subhalo are sorted by radius as they are added (see
+    :func:`sort_by_radius`) and the enclosed mass is stored in the column
+    'M_enc'. Ignored when opening an existing store. Default False
+    :type sort_radius: bool, optional
+    :param float32: If True when creating a new store, the radii, masses, and
+    speeds are stored in single precision, halving the size of those
+    columns. The enclosed mass of a sorted store is always kept in double
+    precision. Ignored when opening an existing store. Default False
+    :type float32: bool, optional
+    :param attrs: Any other information to record with a new store, such as
+    the options its subhalos were saved with, which must be JSON
+    serializable. Available as :attr:`attrs`. Ignored when opening an
+    existing store. Default None
+    :type attrs: dict, optional
+    """
+    def __init__(self, store_loc, mode="r", sort_radius=False, float32=False,
+                 attrs=None):
+        if mode not in ("r", "a"):
+            raise ValueError("Invalid store mode: {}".format(mode))
+        self.store_loc = os.path.abspath(store_loc)
+        self.mode = mode
+        meta_file = os.path.join(self.store_loc, "store.json")
+        if not os.path.isfile(meta_file):
+            if mode == "r":
+                raise IOError("No halo store found at {}".format(store_loc))
+            if not os.path.isdir(self.store_loc):
+                os.makedirs(self.store_loc)
+            columns = dict(store_columns)
+            if float32:
+                columns.update(float32_columns)
+            if sort_radius:
+                columns["M_enc"] = "<f8"
+            # The metadata is written last, as it marks the store as made
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.r_min = np.zeros(0)
+            self.r_max = np.zeros(0)
+            self._save_index()
+            with open(meta_file + ".tmp", "w") as f:
+                json.dump({"version":store_version, "columns":columns,
+                           "sorted":bool(sort_radius),
+                           "attrs":attrs or {}},
+                          f, indent=1, sort_keys=True)
+            _replace(meta_file + ".tmp", meta_file)
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta["version"] != store_version:
+            raise IOError("Unsupported halo store version: {}".format(
+                meta["version"]))
+        self.columns = dict((col, np.dtype(str(dtype))) for (col, dtype) in
+                            meta["columns"].items())
+        self.sorted = meta.get("sorted", False)
+        self.attrs = meta.get("attrs", {})
+        with np.load(os.path.join(self.store_loc, index_name)) as index:
+            self.ids = index["ids"]
+            self.offsets = index["offsets"]
+            self.r_min = index["r_min"]
+            self.r_max = index["r_max"]
+        # The row of each subhalo, so finding one doesn't scan every ID
+        self._rows = dict((int(id), i) for (i, id) in enumerate(self.ids))
+        self._maps = {}
+        if mode == "a":
+            self._truncate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.ids.size
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def _column_file(self, col):
+        return os.path.join(self.store_loc, "{}.bin".format(col))
+
+    def _save_index(self):
+        """Replace the index with the current IDs, offsets, and radial
+        extents, all in one file so they can never be out of step
+        """
+        index_loc = os.path.join(self.store_loc, index_name)
+        with open(index_loc + ".tmp", "wb") as f:
+            np.savez(f, ids=self.ids, offsets=self.offsets, r_min=self.r_min,
+                     r_max=self.r_max)
+        _replace(index_loc + ".tmp", index_loc)
+
+    def _truncate(self):
+        """Drop anything written to the column files after the last complete
+        subhalo
+        """
+        for col in self.columns:
+            nbytes = self.offsets[-1] * self.columns[col].itemsize
+            with open(self._column_file(col), "ab") as f:
+                f.truncate(nbytes)
+
+    def _column(self, col):
+        """Get the memory mapped array for all particles in column
+        :param:`col`
+        """
+        if col not in self._maps:
+            n_part = int(self.offsets[-1])
+            if n_part == 0:
+                self._maps[col] = np.zeros(0, dtype=self.columns[col])
+            else:
+                self._maps[col] = np.memmap(self._column_file(col),
+                                            dtype=self.columns[col],
+                                            mode="r", shape=(n_part,))
+        return self._maps[col]
+
+    def _index(self, id):
+        try:
+            return self._rows[id]
+        except KeyError:
+            raise KeyError("Subhalo {} not found in store".format(id))
+
+    def particle_counts(self):
+        """Get the number of particles stored for each subhalo
+
+        Returns
+        -------
+        :return counts: The number of particles for each subhalo in
+        :attr:`ids`
+        :rtype counts: 1D array int
+        """
+        return np.diff(self.offsets)
+
+    def read(self, id, columns=None):
+        """Read the particles for a single subhalo. The arrays returned are
+        read-only views into the memory mapped store
+
+        Parameters
+        ----------
+        :param id: The subhalo ID
+        :type id: int
+        :param columns: The names of the columns to read, or None for all
+        columns. Default None
+        :type columns: list of str, optional
+
+        Returns
+        -------
+        :return data: The array for each requested column
+        :rtype data: dict
+        """
+        if columns is None:
+            columns = list(self.columns)
+        i = self._index(id)
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return dict((col, self._column(col)[start:stop]) for col in columns)
+
+    def read_table(self, id):
+        """Read all columns for a single subhalo into a table with the same
+        columns as the files saved by :func:`data_read_utils.save_halos`, with
+        the particle types as categorical names
+
+        Parameters
+        ----------
+        :param id: The subhalo ID
+        :type id: int
+
+        Returns
+        -------
+        :return df: The subhalo table
+        :rtype df: pandas DataFrame
+        """
+        data = dict((col, np.array(arr)) for (col, arr) in
+                    self.read(id).items())
+        data["type"] = decode_types(data["type"])
+        return pd.DataFrame.from_dict(data)[
+            ["r", "M", "v", "type"] + (["M_enc"] if self.sorted else [])]
+
+    def _check_columns(self, data):
+        """Check that a set of particles has every column of the store, other
+        than 'M_enc' which is always calculated here
+        """
+        missing = [col for col in self.columns if col not in data and col !=
+                   "M_enc"]
+        if missing:
+            raise ValueError("Missing columns for store: {}".format(
+                ", ".join(sorted(missing))))
+
+    def _encode(self, data):
+        """Convert the columns of a set of particles to the types used in the
+        store, checking that every column is present and of the same length
+        """
+        self._check_columns(data)
+        arrays = {}
+        for col in self.columns:
+            if col == "type":
+                arrays[col] = encode_types(data[col])
+            else:
+                arrays[col] = np.asarray(data[col], dtype=self.columns[col])
+        n_part = arrays["r"].size
+        if any(arr.size != n_part for arr in arrays.values()):
+            raise ValueError("All columns must have the same length")
+        return arrays
+
+    def _write(self, id, chunks):
+        """Write the particles for a single subhalo, given as any number of
+        chunks, to the end of the column files and then add the subhalo to
+        the index. If anything fails before the index is written, the column
+        files are cut back to their previous length
+        """
+        if self.mode != "a":
+            raise IOError("Halo store not opened for appending")
+        if id in self:
+            raise ValueError("Subhalo {} already in store".format(id))
+        n_part = 0
+        r_min = np.inf
+        r_max = -np.inf
+        try:
+            files = dict((col, open(self._column_file(col), "ab")) for col in
+                         self.columns)
+            try:
+                for data in chunks:
+                    arrays = self._encode(data)
+                    for col in self.columns:
+                        files[col].write(arrays[col].tobytes())
+                    if arrays["r"].size:
+                        r_min = min(r_min, arrays["r"].min())
+                        r_max = max(r_max, arrays["r"].max())
+                    n_part += arrays["r"].size
+            finally:
+                for f in files.values():
+                    f.close()
+        except BaseException:
+            self._truncate()
+            raise
+        self.r_min = np.append(self.r_min, r_min if n_part else np.nan)
+        self.r_max = np.append(self.r_max, r_max if n_part else np.nan)
+        self.offsets = np.append(self.offsets, self.offsets[-1] + n_part)
+        self.ids = np.append(self.ids, np.int64(id))
+        self._save_index()
+        self._rows[int(id)] = self.ids.size - 1
+        self._maps = {}
+
+    def append(self, id, data):
+        """Add the particles for a single subhalo to the end of the store. The
+        column files are written before the index, so a subhalo is only part
+        of the store once it has been completely written
+
+        Parameters
+        ----------
+        :param id: The subhalo ID
+        :type id: int
+        :param data: The array for each column of the store, which must all
+        have the same length. The 'type' column may be given either as names
+        or as integer codes, and the 'M_enc' column of a sorted store is
+        always calculated here
+        :type data: dict or pandas DataFrame
+        """
+        if self.sorted:
+            self._check_columns(data)
+            data = sort_by_radius(dict((col, data[col]) for col in
+                                       self.columns if col != "M_enc"))
+        self._write(id, [data])
+
+    def append_chunks(self, id, chunks):
+        """Add the particles for a single subhalo to the end of the store a
+        chunk at a time, so that only one chunk needs to be in memory. As
+        with :meth:`append`, the subhalo is only part of the store once every
+        chunk has been written. Chunks can't be added to a sorted store,
+        which needs all particles of a subhalo at once to sort them
+
+        Parameters
+        ----------
+        :param id: The subhalo ID
+        :type id: int
+        :param chunks: The chunks of particles, each with the same columns as
+        the data for :meth:`append`
+        :type chunks: iterable of dict
+        """
+        if self.sorted:
+            raise ValueError("Particles can't be added in chunks to a sorted "
+                             "store")
+        self._write(id, chunks)
+
+    def close(self):
+        """Release the memory maps for the store"""
+        self._maps = {}
+
+
+_open_stores = {}
+
+
+def open_store(store_loc):
+    """Open a consolidated store for reading, reusing an already open store
+    if its index hasn't changed since it was opened
+
+    Parameters
+    ----------
+    :param store_loc: The directory of the store
+    :type store_loc: str
+
+    Returns
+    -------
+    :return store: The opened store
+    :rtype store: :class:`HaloStore`
+    """
+    store_loc = os.path.abspath(store_loc)
+    mtime = os.path.getmtime(os.path.join(store_loc, index_name))
+    if store_loc in _open_stores and _open_stores[store_loc][0] == mtime:
+        return _open_stores[store_loc][1]
+    store = HaloStore(store_loc)
+    _open_stores[store_loc] = (mtime, store)
+    return store
+
+
+def is_store(loc):
+    """Check whether a location is a consolidated store
+
+    Parameters
+    ----------
+    :param loc: The location to check
+    :type loc: str
+
+    Returns
+    -------
+    :return is_store: True if :param:`loc` is a directory containing a
+    consolidated store
+    :rtype is_store: bool
+    """
+    return os.path.isfile(os.path.join(loc, "store.json"))
+
+
+def convert_to_store(list_file_loc, store_loc, sort_radius=False,
+                     float32=False):
+    """Convert the per-subhalo files saved by
+    :func:`data_read_utils.save_halos` into a consolidated store. Subhalos
+    that are already in the store are skipped, so an interrupted conversion
+    can simply be run again
+
+    Parameters
+    ----------
+    :param list_file_loc: Location of the list file for the simulation and
+    snapshot being converted
+    :type list_file_loc: str
+    :param store_loc: The directory of the store to create or add to
+    :type store_loc: str
+    :param sort_radius: If True and the store is being created, sort the
+    particles of each subhalo by radius as in :class:`HaloStore`. Default
+    False
+    :type sort_radius: bool, optional
+    :param float32: If True and the store is being created, store the radii,
+    masses, and speeds in single precision as in :class:`HaloStore`. Default
+    False
+    :type float32: bool, optional
+
+    Returns
+    -------
+    :return store_loc: The directory of the store
+    :rtype store_loc: str
+    """
+    snap_dir = os.path.dirname(list_file_loc)
+    # The simulation and snapshot are kept so that the profiles of a store
+    # next to the list file are those of the list file
+    with np.load(list_file_loc) as list_file:
+        file_list = list_file["arr_0"]
+        attrs = dict((key, str(list_file[key])) for key in [
+            "simulation", "snapshot"] if key in list_file.files)
+    with HaloStore(store_loc, mode="a", sort_radius=sort_radius,
+                   float32=float32, attrs=attrs) as store:
+        for filei in file_list:
+            id = int(os.path.splitext(os.path.splitext(filei)[0])[0].split(
+                "subhalo", 1)[1])
+            if id in store:
+                continue
+            store.append(id, pd.read_pickle(os.path.join(snap_dir, filei)))
+    return os.path.abspath(store_loc)
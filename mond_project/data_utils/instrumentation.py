@@ -0,0 +1,364 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import contextlib
+import json
+import threading
+import time
+import pandas as pd
+
+_clock = getattr(time, "perf_counter", time.time)
+
+# Settings for the instrumentation, changed with configure_instrumentation
+_config = {"enabled":False, "progress":None, "records_loc":None,
+           "keep_records":True}
+_lock = threading.Lock()
+_local = threading.local()
+_stage_stats = {}
+_records = []
+
+
+class _Timer(object):
+    """A private class to be used behind the scenes for timing one stage of
+    the work, as a context manager. Time spent in stages timed inside this
+    one on the same thread is not counted for this stage, so the stages of a
+    halo add up to the time spent on it. The number of bytes handled by the
+    stage can be added to :attr:`nbytes`
+
+    Parameters
+    ----------
+    :param stage: The name of the stage
+    :type stage: str
+    :param record: The record of the halo the stage is for, or None to only
+    add to the totals for the stage
+    :type record: dict or None
+    """
+    def __init__(self, stage, record=None):
+        self.stage = stage
+        self.record = record
+        self.nbytes = 0
+        self._inner = 0.0
+        self._start = None
+
+    def __enter__(self):
+        stack = getattr(_local, "timers", None)
+        if stack is None:
+            stack = _local.timers = []
+        stack.append(self)
+        self._start = _clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = _clock() - self._start
+        stack = _local.timers
+        stack.pop()
+        if stack:
+            stack[-1]._inner += elapsed
+        elapsed -= self._inner
+        if self.record is not None:
+            times = self.record["times"]
+            times[self.stage] = times.get(self.stage, 0.0) + elapsed
+            if self.nbytes:
+                nbytes = self.record["bytes"]
+                nbytes[self.stage] = nbytes.get(self.stage, 0) + self.nbytes
+        else:
+            _add_stage(self.stage, elapsed, self.nbytes)
+
+
+class _NullTimer(object):
+    """A private class to be used behind the scenes in place of
+    :class:`_Timer` when nothing is being timed
+    """
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def _add_stage(stage, elapsed, nbytes=0):
+    """A private function to be used behind the scenes for adding the time
+    and bytes of a stage to its totals
+
+    Parameters
+    ----------
+    :param stage: The name of the stage
+    :type stage: str
+    :param elapsed: The time spent on the stage, in seconds
+    :type elapsed: float
+    :param nbytes: The number of bytes handled by the stage. Default 0
+    :type nbytes: int, optional
+    """
+    with _lock:
+        stats = _stage_stats.setdefault(stage, {
+            "count":0, "total_time":0.0, "max_time":0.0, "bytes":0})
+        stats["count"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        stats["bytes"] += nbytes
+
+
+def configure_instrumentation(enabled=True, progress=None, records_loc=None,
+                              keep_records=True):
+    """Turn the timing of each stage of the ingest and of the calc functions
+    on or off, and set where progress and the record of each halo are sent.
+    The stages are fetching documents from the API ('fetch'), downloading
+    cutouts ('download', with the number of bytes), reading them ('read'),
+    converting the particles ('transform'), writing them ('write'),
+    computing profiles at ingest ('profile'), loading saved particles
+    ('load'), and binning them ('bin'). When turned off, nothing is timed or
+    recorded
+
+    Parameters
+    ----------
+    :param enabled: Whether to time stages and record halos. Default True
+    :type enabled: bool, optional
+    :param progress: A function called as ``progress(task, done, total, id)``
+    after each halo is finished, whether or not timing is enabled, where
+    task is 'ingest' or the name of the calc function, done is the number of
+    halos finished so far, total is the number to do (or None if not known
+    in advance), and id is the subhalo ID. Default None (no progress)
+    :type progress: callable, optional
+    :param records_loc: The path of a JSON lines file to which the record of
+    each halo is appended as soon as it is finished, or None to not write
+    records. Default None
+    :type records_loc: str, optional
+    :param keep_records: If True, also keep the records in memory, for
+    :func:`halo_records`. Default True
+    :type keep_records: bool, optional
+    """
+    with _lock:
+        _config.update(enabled=bool(enabled), progress=progress,
+                       records_loc=records_loc,
+                       keep_records=bool(keep_records))
+
+
+def is_enabled():
+    """Check whether stages are being timed
+
+    Returns
+    -------
+    :return enabled: True if stages are being timed
+    :rtype enabled: bool
+    """
+    return _config["enabled"]
+
+
+def timed(stage, record=None):
+    """Time a stage of the work, as a context manager. The time is added to
+    the record of the halo given, or of the halo being worked on in this
+    thread (see :func:`activate`), or otherwise to the totals for the stage
+
+    Parameters
+    ----------
+    :param stage: The name of the stage
+    :type stage: str
+    :param record: The record of the halo the stage is for. Default None
+    :type record: dict, optional
+
+    Returns
+    -------
+    :return timer: The timer, with the attribute 'nbytes' to which the bytes
+    handled by the stage can be added
+    :rtype timer: context manager
+    """
+    if record is None:
+        record = getattr(_local, "record", None)
+        if record is None and not _config["enabled"]:
+            return _null_timer
+    return _Timer(stage, record)
+
+
+def new_record(task, id, force=False):
+    """Start the record of a single halo
+
+    Parameters
+    ----------
+    :param task: The name of the work being done, such as 'ingest'
+    :type task: str
+    :param id: The subhalo ID
+    :type id: int
+    :param force: If True, start the record even if timing is disabled, such
+    as in another process for a caller which has timing enabled. Default
+    False
+    :type force: bool, optional
+
+    Returns
+    -------
+    :return record: The new record, or None if timing is disabled
+    :rtype record: dict or None
+    """
+    if not (force or _config["enabled"]):
+        return None
+    return {"task":task, "id":int(id), "start":time.time(), "elapsed":None,
+            "times":{}, "bytes":{}, "fields":{}}
+
+
+@contextlib.contextmanager
+def activate(record):
+    """Make a halo record the one that stages timed in this thread are added
+    to, as a context manager. Does nothing if the record is None
+
+    Parameters
+    ----------
+    :param record: The record of the halo
+    :type record: dict or None
+    """
+    if record is None:
+        yield record
+        return
+    previous = getattr(_local, "record", None)
+    _local.record = record
+    try:
+        yield record
+    finally:
+        _local.record = previous
+
+
+def note(**fields):
+    """Add fields, such as particle counts, to the record of the halo being
+    worked on in this thread, if any
+    """
+    record = getattr(_local, "record", None)
+    if record is not None:
+        record["fields"].update(fields)
+
+
+def _flatten(record):
+    """A private function to be used behind the scenes for converting a halo
+    record to a flat dict, with the time ('<stage>_time') and bytes
+    ('<stage>_bytes') of each stage as separate fields
+
+    Parameters
+    ----------
+    :param record: The record of the halo
+    :type record: dict
+
+    Returns
+    -------
+    :return flat: The flattened record
+    :rtype flat: dict
+    """
+    flat = {"task":record["task"], "id":record["id"],
+            "start":record["start"], "elapsed":record["elapsed"]}
+    for (stage, elapsed) in record["times"].items():
+        flat["{}_time".format(stage)] = elapsed
+    for (stage, nbytes) in record["bytes"].items():
+        flat["{}_bytes".format(stage)] = nbytes
+    flat.update(record["fields"])
+    return flat
+
+
+def finish_record(record, **fields):
+    """Finish the record of a single halo, adding its stage times to the
+    totals for each stage and keeping or writing it as set with
+    :func:`configure_instrumentation`. Does nothing if the record is None
+
+    Parameters
+    ----------
+    :param record: The record of the halo
+    :type record: dict or None
+    :param fields: Any other fields to add to the record, such as particle
+    counts
+    """
+    if record is None:
+        return
+    if record["elapsed"] is None:
+        record["elapsed"] = time.time() - record["start"]
+    record["fields"].update(fields)
+    for (stage, elapsed) in record["times"].items():
+        _add_stage(stage, elapsed, record["bytes"].get(stage, 0))
+    flat = _flatten(record)
+    with _lock:
+        if _config["keep_records"]:
+            _records.append(flat)
+        if _config["records_loc"] is not None:
+            with open(_config["records_loc"], "a") as f:
+                f.write(json.dumps(flat, sort_keys=True) + "\n")
+
+
+def progress(task, done, total=None, id=None):
+    """Report progress to the function set with
+    :func:`configure_instrumentation`, if any
+
+    Parameters
+    ----------
+    :param task: The name of the work being done, such as 'ingest'
+    :type task: str
+    :param done: The number of halos finished so far
+    :type done: int
+    :param total: The number of halos to do, or None if not known. Default
+    None
+    :type total: int, optional
+    :param id: The ID of the halo just finished. Default None
+    :type id: int, optional
+    """
+    callback = _config["progress"]
+    if callback is not None:
+        callback(task, done, total, id)
+
+
+def stage_stats():
+    """Get the totals for each stage timed since the last reset
+
+    Returns
+    -------
+    :return stats: For each stage, the number of halos or calls it was timed
+    for ('count'), the total ('total_time'), mean ('mean_time'), and longest
+    ('max_time') time spent on it in seconds, and the number of bytes handled
+    ('bytes')
+    :rtype stats: dict
+    """
+    with _lock:
+        stats = dict((stage, dict(stage_stats)) for (stage, stage_stats) in
+                     _stage_stats.items())
+    for stage_stats in stats.values():
+        stage_stats["mean_time"] = (stage_stats["total_time"] /
+                                    stage_stats["count"])
+    return stats
+
+
+def halo_records():
+    """Get the records of the halos finished since the last reset, to find
+    the slowest halos or size jobs
+
+    Returns
+    -------
+    :return records: One row per halo, with the work being done ('task'),
+    the subhalo ID ('id'), when the halo was started ('start', in seconds
+    since the epoch) and the time spent on it ('elapsed'), the time spent on
+    each stage ('<stage>_time') and the bytes handled ('<stage>_bytes'), and
+    the particle counts (such as 'n_gas' and 'n_star' for the ingest and
+    'n_part' for the calc functions)
+    :rtype records: pandas DataFrame
+    """
+    with _lock:
+        records = list(_records)
+    return pd.DataFrame(records)
+
+
+def write_records(path):
+    """Write the records of the halos finished since the last reset to a
+    JSON lines file, with one record per line as in :func:`halo_records`
+
+    Parameters
+    ----------
+    :param path: The path of the file to write
+    :type path: str
+    """
+    with _lock:
+        records = list(_records)
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def reset_instrumentation():
+    """Remove the stage totals and halo records gathered so far"""
+    with _lock:
+        _stage_stats.clear()
+        del _records[:]
@@ -0,0 +1,181 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import sqlite3
+import threading
+import time
+import requests
+
+
+def cache_key(path, params=None):
+    """Get the key used to store the response for a request. The key is the
+    full URL of the request, with the parameters sorted so that the same
+    request always gives the same key
+
+    Parameters
+    ----------
+    :param path: The URL of the request
+    :type path: str
+    :param params: Extra parameters for the request. Default None
+    :type params: dict or None
+
+    Returns
+    -------
+    :return key: The key for the request
+    :rtype key: str
+    """
+    if params:
+        params = sorted(params.items())
+    return requests.Request("GET", path, params=params).prepare().url
+
+
+class ResponseCache(object):
+    """A persistent cache of HTTP response bodies, stored in an SQLite
+    database. The validators ('ETag' and 'Last-Modified') sent with each
+    response are stored as well so that cached responses can be revalidated.
+    Once the bodies stored take more than :param:`max_bytes`, the least
+    recently used responses are removed. The size of the bodies is counted
+    when the cache is opened and kept up to date as responses are added, so
+    responses added to the same file by other processes are only counted
+    once it is opened again
+
+    Parameters
+    ----------
+    :param cache_loc: The path of the database file, which is created if it
+    doesn't exist
+    :type cache_loc: str
+    :param max_bytes: The maximum number of bytes of response bodies to
+    keep. Default 1 GiB
+    :type max_bytes: int, optional
+    """
+    def __init__(self, cache_loc, max_bytes=2**30):
+        self.cache_loc = os.path.abspath(cache_loc)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        cache_dir = os.path.dirname(self.cache_loc)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._conn = sqlite3.connect(self.cache_loc, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                "body BLOB, content_type TEXT, etag TEXT, last_modified TEXT, "
+                "size INTEGER, accessed REAL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS accessed_index ON responses "
+                "(accessed)")
+            self._total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """Get a cached response, marking it as recently used
+
+        Parameters
+        ----------
+        :param key: The key for the request, from :func:`cache_key`
+        :type key: str
+
+        Returns
+        -------
+        :return entry: The response body ('body'), content type
+        ('content_type'), and validators ('etag' and 'last_modified'), or None
+        if the response is not cached
+        :rtype entry: dict or None
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT body, content_type, etag, last_modified FROM "
+                "responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = "
+                               "?", (time.time(), key))
+        return {"body":bytes(row[0]), "content_type":row[1], "etag":row[2],
+                "last_modified":row[3]}
+
+    def put(self, key, body, content_type=None, etag=None,
+            last_modified=None):
+        """Add or replace a cached response, then remove the least recently
+        used responses if the cache is too large
+
+        Parameters
+        ----------
+        :param key: The key for the request, from :func:`cache_key`
+        :type key: str
+        :param body: The response body
+        :type body: bytes
+        :param content_type: The content type of the response. Default None
+        :type content_type: str, optional
+        :param etag: The 'ETag' header of the response. Default None
+        :type etag: str, optional
+        :param last_modified: The 'Last-Modified' header of the response.
+        Default None
+        :type last_modified: str, optional
+        """
+        with self._lock:
+            # The total is only updated once the changes are committed
+            with self._conn:
+                row = self._conn.execute(
+                    "SELECT size FROM responses WHERE key = ?",
+                    (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, "
+                    "?, ?)", (key, sqlite3.Binary(body), content_type, etag,
+                              last_modified, len(body), time.time()))
+                total = self._evict(self._total + len(body) - (
+                    0 if row is None else row[0]))
+            self._total = total
+
+    def _evict(self, total):
+        """Remove the least recently used responses until the cache fits
+        within :attr:`max_bytes`, given the current size :param:`total` of
+        the bodies, and return the size left. The lock must already be held
+        """
+        if total <= self.max_bytes:
+            return total
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+        return total
+
+    def clear(self):
+        """Remove all cached responses and reset the hit and miss counts"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self._total = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get statistics for the cache
+
+        Returns
+        -------
+        :return stats: The number of hits ('hits') and misses ('misses') since
+        the cache was opened or cleared, and the number of responses
+        ('responses') and bytes ('bytes') currently stored
+        :rtype stats: dict
+        """
+        with self._lock:
+            n_resp, n_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM "
+                "responses").fetchone()
+            return {"hits":self.hits, "misses":self.misses,
+                    "responses":n_resp, "bytes":n_bytes}
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._conn.close()
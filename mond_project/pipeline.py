@@ -0,0 +1,733 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import argparse
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from .calculate import calc_accel, halo_cache
+from .calculate.stacking import stack_halos
+from .data_utils import data_read_utils, instrumentation
+
+# The stages of the pipeline, in the order they are run
+stage_names = ("ingest", "profiles", "stack")
+
+# The name of the file in each stage directory recording the inputs of the
+# cached output, and the names of the outputs of the last two stages
+stage_record_name = "stage.json"
+accel_name = "accelerations.npz"
+stack_name = "stack.csv"
+
+# A rough upper bound on the memory used per particle while a subhalo is
+# converted at ingest or binned, in bytes, for sizing work to the memory
+# budget
+bytes_per_particle = 64
+
+# The settings used for anything not given in the configuration
+default_pipeline_config = {
+    "ingest"  :{"simulation":"Illustris-1", "z":0.0, "snapnum":None,
+                "max_halos":100, "store":True, "sort_radius":True,
+                "float32":False, "part_types":["gas", "star"],
+                "base_profiles":True, "selection":{}},
+    "bins"    :{"edges":None, "r_min":0.5, "r_max":100.0, "n_bins":20,
+                "log":False},
+    "profiles":{"part_types":None, "use_profiles":True},
+    "stack"   :{"percentiles":[16.0, 84.0], "ddof":1},
+    "run"     :{"output_dir":"rar_pipeline", "n_workers":1, "n_jobs":1,
+                "memory_budget":2**30}}
+
+_byte_units = {"":0, "k":1, "m":2, "g":3, "t":4}
+
+
+def _is_string(value):
+    """A private function to be used behind the scenes for checking whether a
+    setting is still a string, as read from a configuration file
+    """
+    return isinstance(value, (type(""), str))
+
+
+def _as_bool(value):
+    """A private function to be used behind the scenes for converting a
+    setting to a bool
+    """
+    if _is_string(value):
+        if value.strip().lower() in ["true", "yes", "on", "1"]:
+            return True
+        if value.strip().lower() in ["false", "no", "off", "0"]:
+            return False
+        raise ValueError("Invalid boolean setting: {}".format(value))
+    return bool(value)
+
+
+def _as_number(value):
+    """A private function to be used behind the scenes for converting a
+    setting to an int or float if possible, or leaving it as it is otherwise
+    """
+    if not _is_string(value):
+        return value
+    for convert in [int, float]:
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _as_bytes(value):
+    """A private function to be used behind the scenes for converting a
+    memory size, either a number of bytes or a string such as '512M' or
+    '2 GiB' (with powers of 1024), to a number of bytes
+    """
+    if _is_string(value):
+        match = re.match(r"^\s*([0-9.]+)\s*([kmgt]?)(i?b)?\s*$", value,
+                         re.IGNORECASE)
+        if match is None:
+            raise ValueError("Invalid memory size: {}".format(value))
+        return int(float(match.group(1)) *
+                   1024**_byte_units[match.group(2).lower()])
+    return int(value)
+
+
+def _optional(convert):
+    """A private function to be used behind the scenes for allowing a
+    setting to be None (or 'none' or empty in a configuration file)
+    """
+    def _convert(value):
+        if value is None or (_is_string(value) and
+                             value.strip().lower() in ["", "none"]):
+            return None
+        return convert(value)
+    return _convert
+
+
+def _as_list(convert):
+    """A private function to be used behind the scenes for converting each
+    item of a list setting, which may be a comma separated string
+    """
+    def _convert(value):
+        if _is_string(value):
+            value = [item.strip() for item in value.split(",")
+                     if item.strip()]
+        return [convert(item) for item in value]
+    return _convert
+
+
+def _as_selection(value):
+    """A private function to be used behind the scenes for converting the
+    values of the selection filters to numbers
+    """
+    return dict((str(name), _as_number(filter_value)) for (name, filter_value)
+                in value.items())
+
+
+def _as_str(value):
+    """A private function to be used behind the scenes for converting a
+    setting to a string
+    """
+    return str(value)
+
+
+_config_types = {
+    "ingest"  :{"simulation":_as_number, "z":_optional(float),
+                "snapnum":_optional(int), "max_halos":_optional(int),
+                "store":_as_bool, "sort_radius":_as_bool,
+                "float32":_as_bool, "part_types":_as_list(_as_str),
+                "base_profiles":_as_bool, "selection":_as_selection},
+    "bins"    :{"edges":_optional(_as_list(float)), "r_min":float,
+                "r_max":float, "n_bins":int, "log":_as_bool},
+    "profiles":{"part_types":_optional(_as_list(_as_str)),
+                "use_profiles":_as_bool},
+    "stack"   :{"percentiles":_as_list(float), "ddof":int},
+    "run"     :{"output_dir":_as_str, "n_workers":int, "n_jobs":_optional(int),
+                "memory_budget":_as_bytes}}
+
+
+def load_pipeline_config(config=None):
+    """Read the configuration of the pipeline, filling in the defaults of
+    :data:`default_pipeline_config` for anything not given. The
+    configuration has the sections
+
+    * 'ingest': the arguments of :func:`data_read_utils.save_halos`
+      ('simulation', 'z' or 'snapnum', 'max_halos', 'store', 'sort_radius',
+      'float32', 'part_types', and the subsection 'selection'), and
+      'base_profiles' for its ``profiles`` argument
+    * 'bins': the radial bin edges ('edges'), or 'n_bins' bins from 'r_min'
+      to 'r_max' in kpc, spaced logarithmically if 'log' is True
+    * 'profiles': the particle types to use ('part_types', or None for all)
+      and whether to use the profiles saved at ingest ('use_profiles'), as
+      for :func:`calc_accel.calc_rar`
+    * 'stack': the 'percentiles' and 'ddof' of :func:`stacking.stack_halos`
+    * 'run': the directory for the outputs of every stage ('output_dir'),
+      the number of threads for the ingest ('n_workers') and of processes
+      for the profiles ('n_jobs', or -1 or None for one per CPU), and the
+      memory budget ('memory_budget', in bytes or as a string like '2G')
+
+    Parameters
+    ----------
+    :param config: The path to a configuration file in INI format, with one
+    section per stage, or a dict of the sections. Default None (all defaults)
+    :type config: str or dict, optional
+
+    Returns
+    -------
+    :return config: The full configuration, with one dict per section
+    :rtype config: dict
+    """
+    if config is None:
+        config = {}
+    elif _is_string(config):
+        if not os.path.isfile(config):
+            raise IOError("Pipeline configuration not found: {}".format(
+                config))
+        from configobj import ConfigObj
+        config = ConfigObj(config).dict()
+    full = copy.deepcopy(default_pipeline_config)
+    for (section, settings) in config.items():
+        if section not in _config_types:
+            raise ValueError("Unknown pipeline configuration section: "
+                             "{}".format(section))
+        for (name, value) in settings.items():
+            if name not in _config_types[section]:
+                raise ValueError("Unknown setting {!r} in section {!r}".format(
+                    name, section))
+            full[section][name] = _config_types[section][name](value)
+    ingest = config.get("ingest", {})
+    if "snapnum" in ingest and "z" not in ingest:
+        full["ingest"]["z"] = None
+    if full["ingest"]["z"] is None and full["ingest"]["snapnum"] is None:
+        raise ValueError("Either z or snapnum is needed for the ingest")
+    if full["run"]["memory_budget"] <= 0:
+        raise ValueError("Memory budget must be positive")
+    _bin_edges(full["bins"])
+    return full
+
+
+def _bin_edges(bins):
+    """A private function to be used behind the scenes for getting the radial
+    bin edges from the 'bins' section of the configuration
+
+    Parameters
+    ----------
+    :param bins: The 'bins' section of the configuration
+    :type bins: dict
+
+    Returns
+    -------
+    :return bin_edges: The edges of the contiguous radial bins
+    :rtype bin_edges: 1D array float
+    """
+    if bins["edges"] is not None:
+        return calc_accel._check_bin_edges(bins["edges"])
+    if bins["n_bins"] < 1:
+        raise ValueError("At least one radial bin is needed")
+    if bins["log"]:
+        if bins["r_min"] <= 0:
+            raise ValueError("Logarithmic bins must start at a positive "
+                             "radius")
+        edges = np.geomspace(bins["r_min"], bins["r_max"], bins["n_bins"] + 1)
+    else:
+        edges = np.linspace(bins["r_min"], bins["r_max"], bins["n_bins"] + 1)
+    return calc_accel._check_bin_edges(edges)
+
+
+def _stage_key(inputs):
+    """A private function to be used behind the scenes for hashing the inputs
+    of a stage, which identifies its cached output
+
+    Parameters
+    ----------
+    :param inputs: The inputs of the stage, which must be JSON serializable
+    :type inputs: dict
+
+    Returns
+    -------
+    :return key: The SHA-1 digest of the inputs
+    :rtype key: str
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode(
+        "utf-8")).hexdigest()
+
+
+def _stage_dir(output_dir, stage, key):
+    """A private function to be used behind the scenes for getting the
+    directory of the output of a stage with the given key
+    """
+    return os.path.join(output_dir, stage, key[:16])
+
+
+def _read_stage(stage_dir, key):
+    """A private function to be used behind the scenes for reading the record
+    of the cached output of a stage, if it was finished with the same key
+
+    Parameters
+    ----------
+    :param stage_dir: The directory of the output of the stage
+    :type stage_dir: str
+    :param key: The key of the inputs of the stage
+    :type key: str
+
+    Returns
+    -------
+    :return record: The record written when the stage was finished, or None
+    if it wasn't finished with these inputs
+    :rtype record: dict or None
+    """
+    record_loc = os.path.join(stage_dir, stage_record_name)
+    if not os.path.isfile(record_loc):
+        return None
+    with open(record_loc) as f:
+        try:
+            record = json.load(f)
+        except ValueError:
+            return None
+    if record.get("key") != key or not os.path.exists(os.path.join(
+            stage_dir, record["result"])):
+        return None
+    return record
+
+
+def _write_stage(stage_dir, record):
+    """A private function to be used behind the scenes for recording that a
+    stage was finished, once its output is complete
+    """
+    record_loc = os.path.join(stage_dir, stage_record_name)
+    with open(record_loc + ".tmp", "w") as f:
+        json.dump(record, f, sort_keys=True, indent=2)
+    data_read_utils._replace(record_loc + ".tmp", record_loc)
+
+
+def _stage_result(stage, key, stage_dir, result, ran, **fields):
+    """A private function to be used behind the scenes for the summary of a
+    stage returned by :func:`run_pipeline`
+    """
+    summary = {"stage":stage, "key":key, "dir":stage_dir,
+               "result":os.path.join(stage_dir, result), "ran":ran}
+    summary.update(fields)
+    return summary
+
+
+def _run_ingest(config):
+    """A private function to be used behind the scenes for running the ingest
+    stage. The saved subhalos depend on everything in the 'ingest' section
+    except 'max_halos', so raising 'max_halos' resumes the ingest in the same
+    directory and only the new subhalos are downloaded (see
+    :func:`data_read_utils.save_halos`). The stage isn't run at all if it
+    was already finished with the same settings
+
+    Parameters
+    ----------
+    :param config: The full configuration
+    :type config: dict
+
+    Returns
+    -------
+    :return summary: The key ('key') and directory ('dir') of the stage, the
+    path to the list file or consolidated store ('result'), whether the
+    stage was run ('ran'), and the maximum number of subhalos to use
+    ('max_halos')
+    :rtype summary: dict
+    """
+    ingest = config["ingest"]
+    run = config["run"]
+    inputs = dict((name, value) for (name, value) in ingest.items() if
+                  name != "max_halos")
+    key = _stage_key(inputs)
+    stage_dir = _stage_dir(run["output_dir"], "ingest", key)
+    record = _read_stage(stage_dir, key)
+    if record is not None and record["max_halos"] == ingest["max_halos"]:
+        return _stage_result("ingest", key, stage_dir, record["result"],
+                             False, max_halos=ingest["max_halos"])
+    if not os.path.isdir(stage_dir):
+        os.makedirs(stage_dir)
+    # Converting in slabs bounds the memory of each download thread, but
+    # needs all particles of a subhalo at once to sort them
+    chunk_size = None
+    if ingest["store"] and not ingest["sort_radius"]:
+        chunk_size = max(1, run["memory_budget"] // (
+            run["n_workers"] * bytes_per_particle))
+    result = data_read_utils.save_halos(
+        ingest["simulation"], stage_dir, z=ingest["z"],
+        snapnum=ingest["snapnum"], store=ingest["store"],
+        sort_radius=ingest["sort_radius"], n_workers=run["n_workers"],
+        selection=ingest["selection"] or None,
+        max_halos=ingest["max_halos"], part_types=ingest["part_types"],
+        float32=ingest["float32"], chunk_size=chunk_size,
+        profiles=ingest["base_profiles"])
+    result = os.path.relpath(result, stage_dir)
+    _write_stage(stage_dir, {"stage":"ingest", "key":key, "inputs":inputs,
+                             "max_halos":ingest["max_halos"],
+                             "result":result})
+    return _stage_result("ingest", key, stage_dir, result, True,
+                         max_halos=ingest["max_halos"])
+
+
+def _saved_halos(ingest):
+    """A private function to be used behind the scenes for getting the IDs,
+    checksums, and particle counts of the subhalos saved by the ingest stage,
+    from its ingest manifest. The directory of the ingest may hold more
+    subhalos than 'max_halos' from an earlier run, so only the first
+    'max_halos' subhalos in the manifest are used
+
+    Parameters
+    ----------
+    :param ingest: The summary of the ingest stage
+    :type ingest: dict
+
+    Returns
+    -------
+    :return subhalo_id: The IDs of the saved subhalos
+    :rtype subhalo_id: 1D array int
+    :return checksums: The checksum of the particles of each subhalo
+    :rtype checksums: list of str
+    :return n_part: The number of particles of each subhalo
+    :rtype n_part: 1D array int
+    """
+    subhalo_id = calc_accel._get_halo_sources(ingest["result"])[0]
+    manifest = data_read_utils._read_manifest(os.path.join(
+        ingest["dir"], data_read_utils.manifest_name))
+    if ingest["max_halos"] is not None:
+        use = set(list(manifest)[:ingest["max_halos"]])
+        subhalo_id = subhalo_id[np.array([int(id) in use for id in
+                                          subhalo_id], dtype=bool)]
+    checksums = []
+    n_part = np.zeros(subhalo_id.size, dtype=int)
+    for (i, id) in enumerate(subhalo_id):
+        record = manifest[int(id)]
+        checksums.append(record["checksum"])
+        n_part[i] = sum(value for (name, value) in record.items() if
+                        name.startswith("n_"))
+    return subhalo_id, checksums, n_part
+
+
+def _batches(nbytes, max_bytes):
+    """A private function to be used behind the scenes for splitting
+    subhalos into consecutive batches with at most :param:`max_bytes` in
+    total, with at least one subhalo in each batch
+
+    Parameters
+    ----------
+    :param nbytes: The memory needed for each subhalo
+    :type nbytes: 1D array-like int
+    :param max_bytes: The memory budget of a batch
+    :type max_bytes: int
+
+    Returns
+    -------
+    :return batches: The indices of the subhalos in each batch
+    :rtype batches: list of 1D array int
+    """
+    batches = []
+    start = 0
+    total = 0
+    for (i, halo_bytes) in enumerate(nbytes):
+        if i > start and total + halo_bytes > max_bytes:
+            batches.append(np.arange(start, i))
+            start = i
+            total = 0
+        total += halo_bytes
+    if start < len(nbytes):
+        batches.append(np.arange(start, len(nbytes)))
+    return batches
+
+
+def _save_accels(accel_loc, bin_edges, subhalo_id, checksums, done):
+    """A private function to be used behind the scenes for saving the
+    accelerations of the subhalos finished so far, replacing the earlier
+    file only once the new one is complete
+
+    Parameters
+    ----------
+    :param accel_loc: The path of the file to write
+    :type accel_loc: str
+    :param bin_edges: The edges of the radial bins
+    :type bin_edges: 1D array float
+    :param subhalo_id: The IDs of the saved subhalos, in order
+    :type subhalo_id: 1D array int
+    :param checksums: The checksum of each saved subhalo
+    :type checksums: list of str
+    :param done: The checksum, observed acceleration, and baryonic
+    acceleration of each subhalo calculated so far, by ID
+    :type done: dict
+    """
+    keep = [i for (i, (id, checksum)) in enumerate(zip(subhalo_id, checksums))
+            if done.get(int(id), (None,))[0] == checksum]
+    ids = np.asarray(subhalo_id)[keep]
+    n_bins = bin_edges.size - 1
+    gobs = np.empty((n_bins, ids.size))
+    gbar = np.empty((n_bins, ids.size))
+    for (j, id) in enumerate(ids):
+        gobs[:, j], gbar[:, j] = done[int(id)][1:]
+    tmp_loc = accel_loc + ".tmp"
+    with open(tmp_loc, "wb") as f:
+        np.savez(f, ids=ids, checksums=np.array(
+            [checksums[i] for i in keep], dtype="U"), bin_edges=bin_edges,
+                 r=0.5 * (bin_edges[1:] + bin_edges[:-1]), gobs=gobs,
+                 gbar=gbar)
+    data_read_utils._replace(tmp_loc, accel_loc)
+
+
+def _run_profiles(config, ingest, rerun=False):
+    """A private function to be used behind the scenes for running the
+    profiles stage, which calculates the observed and baryonic accelerations
+    of each subhalo in the radial bins. The output depends on the subhalos
+    saved by the ingest, the bins, and the particle types, but each subhalo
+    is kept by ID and checksum, so only subhalos added (or changed) since the
+    last run are calculated. Subhalos are calculated in batches whose
+    particles fit in the memory budget, and the accelerations are saved
+    after each batch so an interrupted run loses at most one batch. The
+    number of processes is reduced if that many copies of the largest
+    subhalo don't fit in the memory budget
+
+    Parameters
+    ----------
+    :param config: The full configuration
+    :type config: dict
+    :param ingest: The summary of the ingest stage
+    :type ingest: dict
+    :param rerun: If True, calculate every subhalo again. Default False
+    :type rerun: bool, optional
+
+    Returns
+    -------
+    :return summary: The key ('key') and directory ('dir') of the stage, the
+    path to the accelerations ('result'), whether any subhalo was calculated
+    ('ran'), the number calculated ('n_computed'), and a digest of the
+    subhalos included ('halos')
+    :rtype summary: dict
+    """
+    run = config["run"]
+    profiles = config["profiles"]
+    bin_edges = _bin_edges(config["bins"])
+    inputs = {"ingest":ingest["key"], "bin_edges":bin_edges.tolist(),
+              "part_types":profiles["part_types"]}
+    key = _stage_key(inputs)
+    stage_dir = _stage_dir(run["output_dir"], "profiles", key)
+    accel_loc = os.path.join(stage_dir, accel_name)
+    subhalo_id, checksums, n_part = _saved_halos(ingest)
+    halos = _stage_key({"ids":subhalo_id.tolist(), "checksums":checksums})
+    done = {}
+    saved_ids = None
+    if not rerun and _read_stage(stage_dir, key) is not None:
+        with np.load(accel_loc) as saved:
+            saved_ids = saved["ids"].tolist()
+            for (j, id) in enumerate(saved_ids):
+                done[int(id)] = (str(saved["checksums"][j]),
+                                 saved["gobs"][:, j], saved["gbar"][:, j])
+    todo = np.array([i for (i, (id, checksum)) in enumerate(zip(
+        subhalo_id, checksums)) if done.get(int(id), (None,))[0] != checksum],
+                    dtype=int)
+    if todo.size == 0 and saved_ids == subhalo_id.tolist():
+        return _stage_result("profiles", key, stage_dir, accel_name, False,
+                             n_computed=0, halos=halos)
+    if not os.path.isdir(stage_dir):
+        os.makedirs(stage_dir)
+    r = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+    delta_r = np.diff(bin_edges)
+    halo_bytes = n_part[todo] * bytes_per_particle
+    n_jobs = run["n_jobs"]
+    if n_jobs is None or n_jobs == -1:
+        n_jobs = multiprocessing.cpu_count()
+    if todo.size > 0:
+        n_jobs = max(1, min(n_jobs, todo.size, run["memory_budget"] // max(
+            halo_bytes.max(), 1)))
+    executor = ProcessPoolExecutor(n_jobs) if n_jobs > 1 else None
+    try:
+        for batch in _batches(halo_bytes, run["memory_budget"]):
+            batch_ids = subhalo_id[todo[batch]]
+            rar = calc_accel.calc_rar(
+                r, delta_r, ingest["result"], batch_ids, executor=executor,
+                use_profiles=profiles["use_profiles"],
+                part_types=profiles["part_types"])
+            gobs = rar["gobs"].values.reshape(batch_ids.size, r.size)
+            gbar = rar["gbar"].values.reshape(batch_ids.size, r.size)
+            for (j, i) in enumerate(todo[batch]):
+                done[int(subhalo_id[i])] = (checksums[i], gobs[j], gbar[j])
+            # Each subhalo is only read once, so cached tables would only
+            # hold memory outside of the budget
+            halo_cache.clear_halo_cache()
+            _save_accels(accel_loc, bin_edges, subhalo_id, checksums, done)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if todo.size == 0:
+        _save_accels(accel_loc, bin_edges, subhalo_id, checksums, done)
+    _write_stage(stage_dir, {"stage":"profiles", "key":key, "inputs":inputs,
+                             "result":accel_name})
+    return _stage_result("profiles", key, stage_dir, accel_name,
+                         bool(todo.size), n_computed=int(todo.size),
+                         halos=halos)
+
+
+def _run_stack(config, profiles, rerun=False):
+    """A private function to be used behind the scenes for running the
+    stacking stage, which finds the statistics of the accelerations over the
+    subhalos in each radial bin with :func:`stacking.stack_halos`. The output
+    depends on the accelerations (through the key of the profiles stage, the
+    subhalos included, and 'max_halos') and the 'stack' section
+
+    Parameters
+    ----------
+    :param config: The full configuration
+    :type config: dict
+    :param profiles: The summary of the profiles stage
+    :type profiles: dict
+    :param rerun: If True, stack again even if cached. Default False
+    :type rerun: bool, optional
+
+    Returns
+    -------
+    :return summary: The key ('key') and directory ('dir') of the stage, the
+    path to the stacked accelerations ('result'), and whether the stage was
+    run ('ran')
+    :rtype summary: dict
+    """
+    stack_config = config["stack"]
+    inputs = {"profiles":profiles["key"], "halos":profiles["halos"],
+              "max_halos":config["ingest"]["max_halos"],
+              "percentiles":stack_config["percentiles"],
+              "ddof":stack_config["ddof"]}
+    key = _stage_key(inputs)
+    stage_dir = _stage_dir(config["run"]["output_dir"], "stack", key)
+    if not rerun and _read_stage(stage_dir, key) is not None:
+        return _stage_result("stack", key, stage_dir, stack_name, False)
+    if not os.path.isdir(stage_dir):
+        os.makedirs(stage_dir)
+    with np.load(profiles["result"]) as saved:
+        stack = pd.concat([stack_halos(
+            saved[accel], saved["r"], stack_config["percentiles"],
+            stack_config["ddof"]) for accel in ["gobs", "gbar"]], axis=1,
+                          keys=["gobs", "gbar"])
+    stack.columns = ["{}_{}".format(accel, stat) for (accel, stat) in
+                     stack.columns]
+    stack_loc = os.path.join(stage_dir, stack_name)
+    stack.to_csv(stack_loc + ".tmp")
+    data_read_utils._replace(stack_loc + ".tmp", stack_loc)
+    _write_stage(stage_dir, {"stage":"stack", "key":key, "inputs":inputs,
+                             "result":stack_name})
+    return _stage_result("stack", key, stage_dir, stack_name, True)
+
+
+def run_pipeline(config=None, rerun=None):
+    """Run the whole RAR pipeline: ingest the subhalos from the Illustris
+    API, calculate the observed and baryonic accelerations of each subhalo
+    in the radial bins ('profiles'), and stack them over the subhalos. The
+    output of each stage is saved in the output directory under a key
+    hashed from its inputs, and a stage is only run again when its inputs
+    change, so changing the bins doesn't repeat the ingest, and changing
+    the percentiles only repeats the stacking. Raising 'max_halos' only
+    downloads and calculates the subhalos that are new
+
+    Parameters
+    ----------
+    :param config: The configuration, as a path to an INI file or a dict of
+    sections, or the full configuration from :func:`load_pipeline_config`.
+    Default None (all defaults)
+    :type config: str or dict, optional
+    :param rerun: The first stage to run again even if its output is cached,
+    'profiles' or 'stack' (and every stage after it), or None to only run
+    stages whose inputs changed. The ingest always reuses the subhalos
+    already saved, so remove its directory to download them again. Default
+    None
+    :type rerun: str, optional
+
+    Returns
+    -------
+    :return summaries: For each stage in :data:`stage_names`, the key
+    ('key'), directory ('dir'), and output ('result') of the stage, and
+    whether it was run ('ran'). The output of the ingest is its list file or
+    consolidated store, of the profiles an NPZ file of the bin edges
+    ('bin_edges'), radii ('r'), subhalo IDs ('ids'), and accelerations
+    ('gobs' and 'gbar', with one row per bin and one column per subhalo),
+    and of the stacking a CSV file of the statistics of each acceleration
+    (e.g. 'gobs_median') indexed by radius
+    :rtype summaries: dict
+    """
+    if rerun not in [None, "profiles", "stack"]:
+        raise ValueError("Only the profiles or stack stages can be rerun")
+    config = load_pipeline_config(config)
+    summaries = {}
+    summaries["ingest"] = _run_ingest(config)
+    summaries["profiles"] = _run_profiles(config, summaries["ingest"],
+                                          rerun == "profiles")
+    summaries["stack"] = _run_stack(config, summaries["profiles"],
+                                    rerun is not None)
+    return summaries
+
+
+def _print_progress(task, done, total, id):
+    """A private function to be used behind the scenes for printing the
+    progress of each stage to stderr
+    """
+    print("{}: {}/{} (subhalo {})".format(task, done, "?" if total is None
+                                          else total, id), file=sys.stderr)
+
+
+def main(argv=None):
+    """Run the RAR pipeline from the command line with a configuration file
+    (see :func:`load_pipeline_config`), printing which stages were run and
+    where their outputs are
+
+    Parameters
+    ----------
+    :param argv: The command line arguments, or None to use
+    :data:`sys.argv`. Default None
+    :type argv: list of str, optional
+
+    Returns
+    -------
+    :return status: The exit status
+    :rtype status: int
+    """
+    parser = argparse.ArgumentParser(
+        prog="mond-rar",
+        description="Ingest subhalos, calculate their accelerations, and "
+                    "stack the radial acceleration relation, rerunning only "
+                    "the stages whose inputs changed")
+    parser.add_argument("config", nargs="?",
+                        help="INI file of pipeline settings")
+    parser.add_argument("--output-dir", help="Directory for the outputs of "
+                                             "every stage")
+    parser.add_argument("--n-workers", type=int,
+                        help="Number of threads for the ingest")
+    parser.add_argument("--n-jobs", type=int,
+                        help="Number of processes for the profiles, or -1 "
+                             "for one per CPU")
+    parser.add_argument("--memory-budget",
+                        help="Memory budget, in bytes or e.g. '2G'")
+    parser.add_argument("--rerun", choices=["profiles", "stack"],
+                        help="Run this stage and those after it even if "
+                             "cached")
+    parser.add_argument("--progress", action="store_true",
+                        help="Print progress for each subhalo")
+    parser.add_argument("--records", help="JSON lines file in which to save "
+                                          "the timings of each subhalo")
+    args = parser.parse_args(argv)
+    config = load_pipeline_config(args.config)
+    for name in ["output_dir", "n_workers", "n_jobs", "memory_budget"]:
+        if getattr(args, name) is not None:
+            config["run"][name] = _config_types["run"][name](
+                getattr(args, name))
+    if args.progress or args.records:
+        instrumentation.configure_instrumentation(
+            enabled=args.records is not None,
+            progress=_print_progress if args.progress else None,
+            records_loc=args.records, keep_records=False)
+    try:
+        summaries = run_pipeline(config, args.rerun)
+    finally:
+        instrumentation.configure_instrumentation(False)
+    for stage in stage_names:
+        summary = summaries[stage]
+        print("{:<8s} {:<6s} {}".format(
+            stage, "ran" if summary["ran"] else "cached", summary["result"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import numpy as np
+import pandas as pd
+from mond_project.benchmarks import mock_api, suite, synthetic
+from mond_project.calculate import calc_accel
+from mond_project.data_utils import data_read_utils, halo_store
+
+
+def test_synthetic_halos(tmpdir):
+    """Test that synthetic subhalos are written in the layout of
+    :function:`data_utils.data_read_utils.save_halos`, both as files and in a
+    consolidated store, and give the same accelerations as the original
+    implementations
+    """
+    df = synthetic.synthetic_halo(1000, gas_frac=0.3, seed=4)
+    pd.testing.assert_frame_equal(df, synthetic.synthetic_halo(
+        1000, gas_frac=0.3, seed=4))
+    assert list(df.columns) == ["r", "M", "v", "type"]
+    assert (df["type"] == "gas").sum() == 300
+    assert (df["r"] > 0).all() and (df["v"] > 0).all()
+
+    list_file = synthetic.write_synthetic_halos(
+        str(tmpdir.mkdir("files")), 3, 500, seed=1)
+    store_loc = synthetic.write_synthetic_halos(
+        str(tmpdir.mkdir("store")), 3, 500, seed=1, store=True,
+        sort_radius=True)
+    assert halo_store.is_store(store_loc)
+    manifest = data_read_utils._read_manifest(os.path.join(
+        os.path.dirname(list_file), data_read_utils.manifest_name))
+    assert sorted(manifest) == [0, 1, 2]
+    assert manifest[1]["n_gas"] == 250 and manifest[1]["n_star"] == 250
+    assert manifest[1]["options"] == data_read_utils._ingest_options()
+    assert halo_store.HaloStore(store_loc).attrs["options"] == (
+        data_read_utils._ingest_options(sort_radius=True))
+    r = np.arange(1.0, 50.0, 2.0)
+    rar = calc_accel.calc_rar(r, 2.0, list_file)
+    pd.testing.assert_frame_equal(calc_accel.calc_rar(r, 2.0, store_loc), rar,
+                                  rtol=1.e-10)
+    for i in range(3):
+        df = synthetic.synthetic_halo(500, seed=1 + i)
+        np.testing.assert_allclose(rar[rar["ID"] == i]["gbar"],
+                                   suite.reference_gbar(df, r - 1.0, r + 1.0),
+                                   rtol=1.e-10)
+
+
+def test_run_benchmarks(tmpdir):
+    """Test that the benchmarks run over every combination of sizes and agree
+    with the original implementations, and that regressions are found
+    """
+    results = suite.run_benchmarks(n_halos=[2, 3], n_part=200,
+                                   n_bins=[5, 20], repeat=1,
+                                   save_loc=str(tmpdir))
+    assert list(results.columns) == suite.result_columns
+    assert len(results) == len(suite.import_benchmarks) + 1 + 2 * 2 * 4
+    assert results["ok"].all()
+    # Importing the package or the calc functions avoids heavy modules
+    imports = results[results["n_part"] == 0]
+    assert list(imports["benchmark"]) == ["import_package", "import_calc"]
+    assert (imports["max_rel_err"] == 0).all()
+    assert (results["seconds"] > 0).all()
+    assert (results["peak_mib"] > 0).all()
+    assert os.listdir(str(tmpdir)) == []
+
+    baseline = results.copy()
+    baseline.loc[baseline["benchmark"] == "calc_gbar", "seconds"] /= 10.0
+    comparison = suite.compare_benchmarks(results, baseline, max_slowdown=2.0)
+    assert len(comparison) == len(results)
+    assert set(comparison[comparison["regression"]]["benchmark"]) == {
+        "calc_gbar"}
+
+    output = os.path.join(str(tmpdir), "results.csv")
+    assert suite.main(["--n-halos", "2", "--n-part", "100", "--n-bins", "5",
+                       "--repeat", "1", "--output", output]) == 0
+    assert len(pd.read_csv(output)) == len(suite.import_benchmarks) + 5
+
+
+def test_mock_api(tmpdir):
+    """Test that :function:`data_utils.data_read_utils.save_halos` ingests
+    subhalos from the local mock API, retrying injected errors, and that the
+    mock serves the same subhalos every time
+    """
+    with mock_api.MockIllustrisAPI(n_subhalos=12, n_part=300, latency=0.001,
+                                   error_rate=0.1, seed=2) as api:
+        try:
+            assert data_read_utils.configure_api(api.base_url[:-1]) == (
+                api.base_url)
+            data_read_utils.configure_session(backoff_factor=0)
+            r = data_read_utils.get("")
+            assert [sim["name"] for sim in r["simulations"]] == [
+                "Illustris-1", "Illustris-2", "Illustris-3"]
+            page = data_read_utils.get("Illustris-1/snapshots/135/subhalos/",
+                                       {"limit":5, "offset":10})
+            assert page["count"] == 12
+            assert [sub["id"] for sub in page["results"]] == [10, 11]
+            assert page["next"] is None
+            list_file = data_read_utils.save_halos(
+                1, str(tmpdir), z=0, max_halos=None, n_workers=3,
+                page_limit=5)
+            stats = api.stats()
+        finally:
+            data_read_utils.configure_api()
+            data_read_utils.configure_session(backoff_factor=0.5)
+    assert data_read_utils._api_config["base_url"] == (
+        data_read_utils.default_base_url)
+    assert stats["total"]["errors"] > 0
+    assert stats["cutout"]["requests"] >= 10
+    # Subhalos without stars or gas are skipped
+    file_list = np.load(list_file)["arr_0"]
+    assert len(file_list) == 10
+    assert not any("subhalo3." in fname or "subhalo7." in fname for fname
+                   in file_list)
+    # The particles are those of the synthetic subhalo drawn by the mock
+    fname = [fname for fname in file_list if "subhalo5." in fname][0]
+    df = pd.read_pickle(os.path.join(str(tmpdir), fname))
+    ref = synthetic.synthetic_halo(300, seed=2 + 104729 * 135 + 5)
+    np.testing.assert_allclose(np.sort(df["r"].values),
+                               np.sort(ref["r"].values), rtol=1.e-8)
+    np.testing.assert_allclose(np.sort(df["M"].values),
+                               np.sort(ref["M"].values), rtol=1.e-8)
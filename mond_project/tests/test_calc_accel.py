@@ -0,0 +1,366 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import pandas as pd
+from mond_project.calculate import calc_accel, halo_cache
+from mond_project.data_utils import halo_profiles, halo_store
+
+test_ids = [3, 7, 12]
+test_r = np.arange(1.0, 20.0)
+test_delta_r = 1.0
+
+
+def _write_test_halos(save_loc, ids=test_ids, n_part=2000, seed=0,
+                      sort_radius=None):
+    """Write synthetic subhalos to :param:`save_loc` using the same file
+    layout as :function:`data_utils.data_read_utils.save_halos`, and return
+    the path to the list file. If :param:`sort_radius` is None, the list file
+    is written without the radial extents of the halos as in older versions
+    """
+    rng = np.random.RandomState(seed)
+    file_list = []
+    r_min = []
+    r_max = []
+    for id in ids:
+        n_gas = n_part // 2
+        n_stars = n_part - n_gas
+        df = pd.DataFrame.from_dict({
+            "r"   :rng.exponential(5.0, n_part),
+            "M"   :rng.uniform(1.e5, 1.e6, n_part),
+            "v"   :rng.uniform(10.0, 300.0, n_part),
+            "type":np.append(np.full(n_gas, "gas"),
+                             np.full(n_stars, "star"))})
+        if sort_radius:
+            df = halo_store.sort_by_radius(df)
+        filei = "Illustris-1_z=0.0_subhalo{}.pickle.gz".format(id)
+        df.to_pickle(os.path.join(save_loc, filei))
+        file_list.append(filei)
+        r_min.append(df["r"].min())
+        r_max.append(df["r"].max())
+    list_file_loc = os.path.join(save_loc, "subhalo_list.npz")
+    if sort_radius is None:
+        np.savez_compressed(list_file_loc, file_list)
+    else:
+        np.savez_compressed(list_file_loc, file_list, r_min=r_min,
+                            r_max=r_max, sorted=sort_radius)
+    return list_file_loc
+
+
+def _ref_halo(list_file_loc, id):
+    """Read a single synthetic subhalo written by :function:`_write_test_halos`
+    """
+    return pd.read_pickle(os.path.join(
+        os.path.dirname(list_file_loc),
+        "Illustris-1_z=0.0_subhalo{}.pickle.gz".format(id)))
+
+
+def _ref_gobs(df, r_low, r_upp):
+    """Brute force observed acceleration, averaging :math:`v^2 / r` over the
+    particles in each bin
+    """
+    r = df["r"].values
+    v = df["v"].values
+    gobs = np.full(len(r_low), np.nan)
+    for i, (rli, rui) in enumerate(zip(r_low, r_upp)):
+        in_bin = (r >= rli) & (r < rui)
+        if in_bin.any():
+            gobs[i] = np.mean(v[in_bin]**2 / r[in_bin])
+    return gobs
+
+
+def _ref_gbar(df, r_low, r_upp):
+    """Brute force baryonic acceleration, using the mass enclosed within the
+    lower edge of each bin and averaging :math:`1 / r^2` over the bin
+    """
+    r = df["r"].values
+    m = df["M"].values
+    gbar = np.full(len(r_low), np.nan)
+    for i, (rli, rui) in enumerate(zip(r_low, r_upp)):
+        in_bin = (r >= rli) & (r < rui)
+        if in_bin.any():
+            gbar[i] = np.mean(calc_accel.grav_constant * m[r < rli].sum() /
+                              r[in_bin]**2)
+    return gbar
+
+
+def test_calc_gbar(tmpdir):
+    """Test :function:`calculate.calc_accel.calc_gbar` against a brute force
+    calculation, including bins beyond the extent of the particles
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    r = np.append(test_r, [1000.0])
+    gbar = calc_accel.calc_gbar(r, test_delta_r, list_file)
+    np.testing.assert_array_equal(gbar.columns, test_ids)
+    np.testing.assert_array_equal(gbar.index, r)
+    for id in test_ids:
+        gbar_exp = _ref_gbar(_ref_halo(list_file, id), r - 0.5 * test_delta_r,
+                             r + 0.5 * test_delta_r)
+        np.testing.assert_allclose(gbar[id].values.astype(float), gbar_exp,
+                                   rtol=1.e-10)
+    assert np.isnan(gbar.loc[1000.0]).all()
+
+
+def test_calc_gobs_profile(tmpdir):
+    """Test :function:`calculate.calc_accel.calc_gobs_profile` against a
+    brute force calculation with variable bin widths, for a subset of halos
+    requested out of order
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    bin_edges = np.array([0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 500.0, 1000.0])
+    ids = [12, 3]
+    gobs = calc_accel.calc_gobs_profile(bin_edges, list_file, ids)
+    assert (gobs.dtypes == np.float64).all()
+    np.testing.assert_array_equal(gobs.columns, ids)
+    np.testing.assert_allclose(gobs.index,
+                               0.5 * (bin_edges[:-1] + bin_edges[1:]))
+    for id in ids:
+        gobs_exp = _ref_gobs(_ref_halo(list_file, id), bin_edges[:-1],
+                             bin_edges[1:])
+        np.testing.assert_allclose(gobs[id].values, gobs_exp, rtol=1.e-10)
+    assert np.isnan(gobs.iloc[-1]).all()
+
+
+def test_calc_gobs_profile_bad_edges(tmpdir):
+    """Test that :function:`calculate.calc_accel.calc_gobs_profile` rejects
+    bin edges that are not strictly increasing
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    with np.testing.assert_raises_regex(ValueError,
+                                        "Bin edges must be strictly "
+                                        "increasing"):
+        calc_accel.calc_gobs_profile([1.0, 3.0, 2.0], list_file)
+
+
+def test_calc_gobs(tmpdir):
+    """Test :function:`calculate.calc_accel.calc_gobs` against a brute force
+    calculation with overlapping bins of variable width
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    delta_r = np.linspace(1.0, 4.0, test_r.size)
+    gobs = calc_accel.calc_gobs(test_r, delta_r, list_file)
+    for id in test_ids:
+        gobs_exp = _ref_gobs(_ref_halo(list_file, id), test_r - 0.5 * delta_r,
+                             test_r + 0.5 * delta_r)
+        np.testing.assert_allclose(gobs[id].values.astype(float), gobs_exp,
+                                   rtol=1.e-10)
+
+
+def test_calc_as_array(tmpdir):
+    """Test that the accelerations are returned as floats, either in a
+    DataFrame or as the raw array with the radii and IDs
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    for func in [calc_accel.calc_gobs, calc_accel.calc_gbar]:
+        accel = func(test_r, test_delta_r, list_file, use_profiles=False)
+        assert (accel.dtypes == np.float64).all()
+        values, r, ids = func(test_r, test_delta_r, list_file,
+                              use_profiles=False, as_array=True)
+        assert values.dtype == np.float64
+        assert values.shape == (test_r.size, len(test_ids))
+        np.testing.assert_array_equal(r, test_r)
+        np.testing.assert_array_equal(ids, test_ids)
+        np.testing.assert_array_equal(values, accel.values)
+    values, r, ids = calc_accel.calc_gobs_profile(test_r, list_file,
+                                                  as_array=True)
+    np.testing.assert_array_equal(r, 0.5 * (test_r[1:] + test_r[:-1]))
+    assert values.shape == (r.size, len(test_ids))
+
+
+def test_calc_rar(tmpdir):
+    """Test that :function:`calculate.calc_accel.calc_rar` matches
+    :function:`calculate.calc_accel.calc_gobs` and
+    :function:`calculate.calc_accel.calc_gbar`
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    rar = calc_accel.calc_rar(test_r, test_delta_r, list_file)
+    gobs = calc_accel.calc_gobs(test_r, test_delta_r, list_file)
+    gbar = calc_accel.calc_gbar(test_r, test_delta_r, list_file)
+    np.testing.assert_array_equal(rar.columns, ["ID", "r", "gobs", "gbar"])
+    assert len(rar) == len(test_ids) * test_r.size
+    for id, rar_id in rar.groupby("ID"):
+        np.testing.assert_array_equal(rar_id["r"].values, test_r)
+        np.testing.assert_array_equal(rar_id["gobs"].values,
+                                      gobs[id].values.astype(float))
+        np.testing.assert_array_equal(rar_id["gbar"].values,
+                                      gbar[id].values.astype(float))
+
+
+def test_halo_cache(tmpdir):
+    """Test that the halo table cache is used by the calc functions, is
+    bounded by its byte limit, and notices rewritten files
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    halo_cache.clear_halo_cache()
+    try:
+        calc_accel.calc_gobs(test_r, test_delta_r, list_file)
+        calc_accel.calc_gbar(test_r, test_delta_r, list_file)
+        stats = halo_cache.halo_cache_stats()
+        assert stats["misses"] == len(test_ids)
+        assert stats["hits"] == len(test_ids)
+        assert stats["tables"] == len(test_ids)
+        one_table = stats["bytes"] // len(test_ids)
+
+        halo_cache.set_halo_cache_size(one_table)
+        stats = halo_cache.halo_cache_stats()
+        assert stats["tables"] == 1
+        assert stats["bytes"] <= one_table
+
+        # Rewriting a file with a new modification time must miss the cache
+        path = os.path.join(str(tmpdir),
+                            "Illustris-1_z=0.0_subhalo{}.pickle.gz".format(
+                                test_ids[-1]))
+        df = halo_cache.load_halo(path)
+        df.iloc[:10].to_pickle(path)
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        assert len(halo_cache.load_halo(path)) == 10
+    finally:
+        halo_cache.set_halo_cache_size(halo_cache.default_cache_bytes)
+        halo_cache.clear_halo_cache()
+
+
+def test_calc_sorted(tmpdir):
+    """Test that the calc functions give the same results for halos saved
+    sorted by radius, both as files and in a sorted consolidated store
+    """
+    list_file = _write_test_halos(str(tmpdir.mkdir("unsorted")))
+    sorted_file = _write_test_halos(str(tmpdir.mkdir("sorted")),
+                                    sort_radius=True)
+    store_loc = halo_store.convert_to_store(
+        list_file, os.path.join(str(tmpdir), "subhalo_store"),
+        sort_radius=True)
+    r = np.concatenate([[0.01], test_r, [1000.0]])
+    rar_exp = calc_accel.calc_rar(r, test_delta_r, list_file)
+    for loc in [sorted_file, store_loc]:
+        rar_obs = calc_accel.calc_rar(r, test_delta_r, loc)
+        pd.testing.assert_frame_equal(rar_obs, rar_exp, rtol=1.e-10)
+        pd.testing.assert_frame_equal(
+            calc_accel.calc_gobs_profile(r, loc),
+            calc_accel.calc_gobs_profile(r, list_file), rtol=1.e-10)
+
+
+def test_calc_part_types(tmpdir):
+    """Test that selecting particle types gives the same results as
+    calculating for only the particles of those types, for halos saved both
+    as files and in a sorted consolidated store
+    """
+    list_file = _write_test_halos(str(tmpdir.mkdir("files")))
+    store_loc = halo_store.convert_to_store(
+        list_file, os.path.join(str(tmpdir), "subhalo_store"),
+        sort_radius=True)
+    r_low = test_r - 0.5 * test_delta_r
+    r_upp = test_r + 0.5 * test_delta_r
+    for loc in [list_file, store_loc]:
+        for part_type in ["gas", "star"]:
+            rar = calc_accel.calc_rar(test_r, test_delta_r, loc,
+                                      part_types=part_type)
+            gobs = calc_accel.calc_gobs(test_r, test_delta_r, loc,
+                                        part_types=[part_type])
+            for id in test_ids:
+                df = _ref_halo(list_file, id)
+                df = df[df["type"] == part_type]
+                rar_h = rar[rar["ID"] == id]
+                np.testing.assert_allclose(rar_h["gobs"],
+                                           _ref_gobs(df, r_low, r_upp),
+                                           rtol=1.e-10)
+                np.testing.assert_allclose(rar_h["gbar"],
+                                           _ref_gbar(df, r_low, r_upp),
+                                           rtol=1.e-10)
+                np.testing.assert_array_equal(gobs[id], rar_h["gobs"])
+        pd.testing.assert_frame_equal(
+            calc_accel.calc_gbar(test_r, test_delta_r, loc,
+                                 part_types=["star", "gas"]),
+            calc_accel.calc_gbar(test_r, test_delta_r, loc))
+    with np.testing.assert_raises_regex(ValueError,
+                                        "Unknown particle type: stars"):
+        calc_accel.calc_gobs(test_r, test_delta_r, list_file,
+                             part_types="stars")
+
+
+def test_calc_outside_extent(tmpdir):
+    """Test that bins outside of the radial extent of every halo are NaN
+    without reading any halos
+    """
+    list_file = _write_test_halos(str(tmpdir), sort_radius=False)
+    halo_cache.clear_halo_cache()
+    gbar = calc_accel.calc_gbar([1000.0, 2000.0], test_delta_r, list_file)
+    assert np.isnan(gbar.values.astype(float)).all()
+    assert halo_cache.halo_cache_stats()["misses"] == 0
+
+
+def test_calc_parallel(tmpdir):
+    """Test that spreading the halos over processes, or over a given
+    executor, gives exactly the serial results in the requested order
+    """
+    list_file = _write_test_halos(str(tmpdir), ids=[3, 7, 12, 15, 20])
+    store_loc = halo_store.convert_to_store(
+        list_file, os.path.join(str(tmpdir), "subhalo_store"))
+    ids = [15, 3, 20, 7]
+    bin_edges = np.concatenate([[0.01], test_r, [1000.0]])
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        for loc in [list_file, store_loc]:
+            for calc in [calc_accel.calc_gobs, calc_accel.calc_gbar,
+                         calc_accel.calc_rar]:
+                exp = calc(test_r, test_delta_r, loc, ids)
+                pd.testing.assert_frame_equal(
+                    calc(test_r, test_delta_r, loc, ids, n_jobs=2), exp)
+                pd.testing.assert_frame_equal(
+                    calc(test_r, test_delta_r, loc, ids, executor=executor),
+                    exp)
+            exp = calc_accel.calc_gobs_profile(bin_edges, loc, ids)
+            pd.testing.assert_frame_equal(
+                calc_accel.calc_gobs_profile(bin_edges, loc, ids, n_jobs=-1),
+                exp)
+    with np.testing.assert_raises_regex(ValueError,
+                                        "n_jobs must be at least 1"):
+        calc_accel.calc_gobs(test_r, test_delta_r, list_file, n_jobs=0)
+
+
+def test_calc_from_profiles(tmpdir):
+    """Test that bins aligned with a saved profile grid are calculated from
+    the profiles without reading any halos, with the same results as from
+    the particles, and that other bins still use the particles
+    """
+    list_file = _write_test_halos(str(tmpdir), sort_radius=False)
+    profiles_loc = halo_profiles.profiles_loc(list_file)
+    for (name, grid) in halo_profiles.default_profile_grids.items():
+        with halo_profiles.ProfileStore(os.path.join(profiles_loc, name),
+                                        mode="a", grid=grid) as store:
+            for id in test_ids:
+                store.append(id, halo_profiles.compute_profile(
+                    _ref_halo(list_file, id), store.edges, chunk_size=300))
+    ids = [12, 3]
+    log_edges = 10**np.arange(-1.0, 1.5, 0.1)
+    bins = [(test_r, 0.2 * np.arange(1, test_r.size + 1)),
+            (0.5 * (log_edges[1:] + log_edges[:-1]), np.diff(log_edges))]
+    for (r, delta_r) in bins:
+        r_low = r - 0.5 * delta_r
+        r_upp = r + 0.5 * delta_r
+        halo_cache.clear_halo_cache()
+        rar = calc_accel.calc_rar(r, delta_r, list_file, ids)
+        gobs = calc_accel.calc_gobs(r, delta_r, list_file, ids)
+        gbar = calc_accel.calc_gbar(r, delta_r, list_file, ids)
+        assert halo_cache.halo_cache_stats()["misses"] == 0
+        pd.testing.assert_frame_equal(
+            rar, calc_accel.calc_rar(r, delta_r, list_file, ids,
+                                     use_profiles=False), rtol=1.e-10)
+        for id in ids:
+            df = _ref_halo(list_file, id)
+            np.testing.assert_allclose(gobs[id].values.astype(float),
+                                       _ref_gobs(df, r_low, r_upp),
+                                       rtol=1.e-10)
+            np.testing.assert_allclose(gbar[id].values.astype(float),
+                                       _ref_gbar(df, r_low, r_upp),
+                                       rtol=1.e-10)
+    edges = np.arange(0.5, 30.0, 2.5)
+    pd.testing.assert_frame_equal(
+        calc_accel.calc_gobs_profile(edges, list_file),
+        calc_accel.calc_gobs_profile(edges, list_file, use_profiles=False),
+        rtol=1.e-10)
+    assert halo_cache.halo_cache_stats()["misses"] == len(test_ids)
+    # Bins off the grid are calculated from the particles
+    halo_cache.clear_halo_cache()
+    calc_accel.calc_gobs(test_r + 0.05, test_delta_r, list_file)
+    assert halo_cache.halo_cache_stats()["misses"] == len(test_ids)
@@ -2,12 +2,21 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 from future.utils import iteritems
 import numpy as np
+import io
 import os
 import re
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import h5py
+import threading
+from future.moves.http.server import BaseHTTPRequestHandler, HTTPServer
+from future.moves.urllib.parse import parse_qsl, urlencode, urlparse
 import pandas as pd
-from mond_project.data_utils import data_read_utils
+from mond_project.benchmarks import mock_api
+from mond_project.calculate import calc_accel
+from mond_project.data_utils import (data_read_utils, halo_profiles,
+                                     halo_store, response_cache)
 from . import create_test_data
 
 test_base_url = "http://www.illustris-project.org/api/"
@@ -171,3 +180,723 @@ def test_save_halos():
                                   obj="Column names from snapshot number query")
     pd.testing.assert_frame_equal(df_sn_obs, df_sn_exp,
                                   obj="DataFrame from snapshot number query")
+
+
+class _FakeAPI(object):
+    """A stand-in for :function:`data_utils.data_read_utils.get` that serves
+    a small synthetic snapshot without network access, writing cutouts to
+    :param:`cutout_dir`. Responses are delayed by a random amount so that
+    concurrent requests complete out of order
+    """
+    base = "http://www.illustris-project.org/api/"
+
+    def __init__(self, cutout_dir, n_subs=12, seed=0, snapnums=(135,)):
+        self.cutout_dir = cutout_dir
+        self.n_subs = n_subs
+        self.seed = seed
+        self.snapnums = list(snapnums)
+        self.snap = self.snap_url(135)
+        self.n_requests = 0
+
+    def snap_url(self, snapnum):
+        return "{}Illustris-1/snapshots/{}/".format(self.base, snapnum)
+
+    def sub(self, i, snapnum=135):
+        rng = np.random.RandomState(self.seed + i)
+        sub = dict(("{}_{}".format(kind, ax), rng.uniform(0, 100)) for kind in
+                   ["pos", "vel"] for ax in "xyz")
+        sub.update(id=i, mass_stars=float(i % 3 != 0),
+                   mass_gas=float(i % 4 != 1),
+                   cutouts={"subhalo":"{}subhalos/{}/cutout.hdf5".format(
+                       self.snap_url(snapnum), i)})
+        return sub
+
+    def cutout(self, i, save_dir=None, in_memory=False):
+        rng = np.random.RandomState(self.seed + 1000 + i)
+        if in_memory is True:
+            fname = io.BytesIO()
+        else:
+            fname = os.path.join(save_dir or self.cutout_dir,
+                                 "cutout_{}.hdf5".format(i))
+        with h5py.File(fname, "w") as f:
+            for part, n_part in [("PartType0", 50 + i), ("PartType4", 80 - i)]:
+                f.create_dataset(part + "/Coordinates",
+                                 data=rng.uniform(0, 100, (n_part, 3)))
+                f.create_dataset(part + "/Velocities",
+                                 data=rng.uniform(-200, 200, (n_part, 3)))
+                f.create_dataset(part + "/Masses",
+                                 data=rng.uniform(1.e-5, 1.e-4, n_part))
+            f.create_dataset("PartType1/Coordinates",
+                             data=rng.uniform(0, 100, (30, 3)))
+            f.create_dataset("PartType1/Velocities",
+                             data=rng.uniform(-200, 200, (30, 3)))
+            f.create_group("Header").attrs["MassTable"] = [0, 4.e-4, 0, 0, 0,
+                                                           0]
+        if in_memory is True:
+            fname.seek(0)
+        return fname
+
+    def listing(self, params, snapnum=135):
+        offset = int(params.pop("offset", 0))
+        limit = int(params.pop("limit", 100))
+        params.pop("order_by", None)
+        ids = [i for i in range(self.n_subs) if
+               data_read_utils._is_selected(self.sub(i), dict(
+                   (key, float(val)) for (key, val) in params.items()))]
+        page = {"count":len(ids), "next":None, "results":[
+            {"id":i, "url":"{}subhalos/{}/".format(self.snap_url(snapnum), i)}
+            for i in ids[offset:offset + limit]]}
+        if offset + limit < len(ids):
+            page["next"] = "{}subhalos/?{}".format(
+                self.snap_url(snapnum), urlencode(dict(
+                    params, offset=offset + limit, limit=limit)))
+        return page
+
+    def __call__(self, path, params=None, save_dir=None, in_memory=False):
+        time.sleep(np.random.uniform(0, 0.002))
+        self.n_requests += 1
+        url = urlparse(path)
+        if url.query:
+            path = path.split("?", 1)[0]
+            params = dict(parse_qsl(url.query), **(params or {}))
+        if path == self.base:
+            return {"simulations":[{"name":"Illustris-1",
+                                    "url":self.base + "Illustris-1/"}]}
+        if path == self.base + "Illustris-1/":
+            return {"snapshots":self.base + "Illustris-1/snapshots/"}
+        if path == self.base + "Illustris-1/snapshots/":
+            return [{"number":n, "url":self.snap_url(n)} for n in
+                    self.snapnums]
+        snaps = re.escape(self.base + "Illustris-1/snapshots/")
+        match = re.match(snaps + r"(?:(\d+)|z=([\d.]+))/$", path)
+        if match is not None:
+            if match.group(2) is None:
+                snapnum = int(match.group(1))
+            else:
+                snapnum = 135 - int(round(10 * float(match.group(2))))
+            if snapnum in self.snapnums:
+                return {"redshift":(135 - snapnum) / 10.0,
+                        "subhalos":self.snap_url(snapnum) + "subhalos/",
+                        "num_groups_subfind":self.n_subs}
+        match = re.match(snaps + r"(\d+)/subhalos/((\d+)(/cutout\.hdf5)?)?$",
+                         path)
+        if match is None or int(match.group(1)) not in self.snapnums:
+            raise requests.exceptions.HTTPError("404 Client Error: NOT FOUND "
+                                                "for url: " + path)
+        snapnum = int(match.group(1))
+        if match.group(2) is None:
+            return self.listing(dict(params or {}), snapnum)
+        if match.group(4):
+            return self.cutout(int(match.group(3)), save_dir, in_memory)
+        return self.sub(int(match.group(3)), snapnum)
+
+
+def test_save_halos_concurrent(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.save_halos` saves the
+    same subhalos in the same order with several workers and a rate limit as
+    with a single worker, using a fake API
+    """
+    monkeypatch.setattr(data_read_utils, "get", _FakeAPI(str(tmpdir)))
+    serial_dir = str(tmpdir.mkdir("serial"))
+    list_exp = data_read_utils.save_halos(1, serial_dir, snapnum=135)
+    files_exp = np.load(list_exp)["arr_0"]
+    np.testing.assert_array_equal(
+        files_exp, ["Illustris-1_snapnum=135_subhalo{}.pickle.gz".format(i) for
+                    i in [2, 4, 7, 8, 10, 11]])
+    parallel_dir = str(tmpdir.mkdir("parallel"))
+    list_obs = data_read_utils.save_halos(1, parallel_dir, snapnum=135,
+                                          n_workers=4, max_rate=1000)
+    files_obs = np.load(list_obs)["arr_0"]
+    np.testing.assert_array_equal(files_obs, files_exp)
+    for filei in files_exp:
+        pd.testing.assert_frame_equal(
+            pd.read_pickle(os.path.join(parallel_dir, filei)),
+            pd.read_pickle(os.path.join(serial_dir, filei)))
+    assert not [f for f in os.listdir(str(tmpdir)) if f.endswith(".hdf5")]
+    assert not [f for f in os.listdir(parallel_dir) if f.startswith(".scratch")]
+    memory_dir = str(tmpdir.mkdir("memory"))
+    list_obs = data_read_utils.save_halos(1, memory_dir, snapnum=135,
+                                          in_memory_bytes=True)
+    np.testing.assert_array_equal(np.load(list_obs)["arr_0"], files_exp)
+
+
+class _FlakyHandler(BaseHTTPRequestHandler):
+    """Request handler for a local stand-in server, which fails the first
+    ``n_fail`` requests to '/flaky' with a 503 status and a 'Retry-After'
+    header before returning JSON, and returns 404 for any other path
+    """
+    n_fail = 2
+    n_seen = 0
+
+    def do_GET(self):
+        if self.path != "/flaky":
+            self.send_error(404, "NOT FOUND")
+            return
+        type(self).n_seen += 1
+        if type(self).n_seen <= self.n_fail:
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_get_retry():
+    """Test that :function:`data_utils.data_read_utils.get` retries transient
+    errors from a local server, does not retry a 404, and records timing
+    statistics for the host
+    """
+    server = HTTPServer(("127.0.0.1", 0), _FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    host = "127.0.0.1:{}".format(server.server_address[1])
+    try:
+        data_read_utils.configure_session(retries=3, backoff_factor=0)
+        data_read_utils.reset_request_stats()
+        r = data_read_utils.get("http://{}/flaky".format(host))
+        assert r == {"ok":True}
+        assert _FlakyHandler.n_seen == 3
+        with np.testing.assert_raises_regex(requests.exceptions.HTTPError,
+                                            "404 Client Error"):
+            data_read_utils.get("http://{}/missing".format(host))
+        stats = data_read_utils.request_stats()[host]
+        assert stats["requests"] == 2
+        assert stats["errors"] == 1
+        assert stats["retries"] == 2
+        assert stats["max_time"] >= stats["mean_time"] > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        data_read_utils.configure_session(retries=5, backoff_factor=0.5)
+
+
+class _ETagHandler(BaseHTTPRequestHandler):
+    """Request handler for a local stand-in server, which returns a JSON
+    document with an 'ETag' header and answers a matching 'If-None-Match'
+    with 304 Not Modified
+    """
+    n_seen = 0
+    n_not_modified = 0
+
+    def do_GET(self):
+        type(self).n_seen += 1
+        if self.headers.get("If-None-Match") == '"v1"':
+            type(self).n_not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = '{{"path": "{}"}}'.format(self.path).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_get_cache(tmpdir):
+    """Test the persistent response cache of
+    :function:`data_utils.data_read_utils.get`, including revalidation,
+    offline mode, and eviction
+    """
+    server = HTTPServer(("127.0.0.1", 0), _ETagHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    cache_loc = os.path.join(str(tmpdir), "cache", "responses.sqlite")
+    try:
+        cache = data_read_utils.configure_cache(cache_loc)
+        r = data_read_utils.get(url + "doc", {"b":2, "a":1})
+        assert r == {"path":"/doc?b=2&a=1"}
+        # Cached documents need no request, whatever the parameter order
+        assert data_read_utils.get(url + "doc", {"a":1, "b":2}) == r
+        assert _ETagHandler.n_seen == 1
+        # Revalidation gets a 304 and serves the cached document
+        data_read_utils.configure_cache(cache_loc, revalidate=True)
+        assert data_read_utils.get(url + "doc", {"a":1, "b":2}) == r
+        assert _ETagHandler.n_not_modified == 1
+        # Offline mode fails on a miss without making a request
+        data_read_utils.configure_cache(cache_loc, offline=True)
+        assert data_read_utils.get(url + "doc", {"a":1, "b":2}) == r
+        with np.testing.assert_raises_regex(IOError, "Offline mode"):
+            data_read_utils.get(url + "other")
+        assert _ETagHandler.n_seen == 2
+        # The cache persists, and is limited in size
+        data_read_utils.configure_cache(None)
+        cache = data_read_utils.configure_cache(cache_loc, max_bytes=30)
+        assert cache.stats()["responses"] == 1
+        data_read_utils.get(url + "other")
+        stats = cache.stats()
+        assert stats["responses"] == 1
+        assert stats["bytes"] <= 30
+        # The size kept up to date counts replaced responses once
+        data_read_utils.configure_cache(None)
+        cache = response_cache.ResponseCache(os.path.join(
+            str(tmpdir), "sized.sqlite"), max_bytes=40)
+        try:
+            cache.put("a", b"a" * 10)
+            cache.put("b", b"b" * 15)
+            cache.put("a", b"a" * 20)
+            assert len(cache) == 2 and cache.stats()["bytes"] == 35
+            cache.put("c", b"c" * 10)
+            assert cache.get("b") is None and cache.get("a") is not None
+            assert cache.stats()["bytes"] == 30
+        finally:
+            cache.close()
+    finally:
+        data_read_utils.configure_cache(None)
+        server.shutdown()
+        server.server_close()
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    """Request handler for a local stand-in server, which returns binary
+    data as an attachment
+    """
+    body = bytes(bytearray(range(256))) * 4000
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Disposition",
+                         "attachment; filename=cutout_5.hdf5")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_get_stream(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.get` streams binary
+    data to the requested directory without leaving temporary files, or
+    keeps it in memory when asked
+    """
+    server = HTTPServer(("127.0.0.1", 0), _FileHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/cutout".format(server.server_address[1])
+    monkeypatch.setattr(data_read_utils, "download_chunk_size", 1000)
+    try:
+        fname = data_read_utils.get(url, save_dir=str(tmpdir))
+        np.testing.assert_string_equal(
+            fname, os.path.join(str(tmpdir), "cutout_5.hdf5"))
+        with open(fname, "rb") as f:
+            assert f.read() == _FileHandler.body
+        assert os.listdir(str(tmpdir)) == ["cutout_5.hdf5"]
+        # Concurrent downloads of the same file to their own names
+        names = ["cutout_5_{}.hdf5".format(i) for i in range(4)]
+        with ThreadPoolExecutor(4) as executor:
+            fnames = list(executor.map(lambda name: data_read_utils.get(
+                url, save_dir=str(tmpdir), filename=name), names))
+        assert fnames == [os.path.join(str(tmpdir), name) for name in names]
+        assert sorted(os.listdir(str(tmpdir))) == ["cutout_5.hdf5"] + names
+        for fname in fnames:
+            with open(fname, "rb") as f:
+                assert f.read() == _FileHandler.body
+        data = data_read_utils.get(url, in_memory=True)
+        assert data.read() == _FileHandler.body
+        # Too large to keep in memory
+        fname = data_read_utils.get(url, save_dir=str(tmpdir), in_memory=1000)
+        assert os.path.isfile(fname)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_save_halos_selection(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.save_halos` selects
+    subhalos with filtered, paginated listings and only fetches the
+    documents of selected subhalos
+    """
+    fake_api = _FakeAPI(str(tmpdir), n_subs=30)
+    monkeypatch.setattr(data_read_utils, "get", fake_api)
+    list_file = data_read_utils.save_halos(
+        1, str(tmpdir), snapnum=135, page_limit=4,
+        selection={"mass_stars__gt":0, "mass_gas__gt":0, "pos_x__lt":50})
+    ids_exp = [i for i in range(30) if i % 3 != 0 and i % 4 != 1 and
+               fake_api.sub(i)["pos_x"] < 50]
+    np.testing.assert_array_equal(
+        calc_accel._get_subhalo_ids(np.load(list_file)["arr_0"]), ids_exp)
+    # 4 for the simulation and snapshot, then the pages, documents and cutouts
+    n_pages = -(-len(ids_exp) // 4)
+    assert fake_api.n_requests == 4 + n_pages + 2 * len(ids_exp)
+    with np.testing.assert_raises_regex(ValueError,
+                                        "Invalid selection filter: "
+                                        "mass__in"):
+        data_read_utils.save_halos(1, str(tmpdir), snapnum=135,
+                                   selection={"mass__in":[1, 2]})
+
+
+def test_save_halos_resume(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.save_halos` records
+    each subhalo in the ingest manifest, and that a rerun after a failure or
+    with a larger :param:`max_halos` only fetches the missing subhalos of
+    the same snapshot
+    """
+    fake_api = _FakeAPI(str(tmpdir), n_subs=20)
+    cutout = fake_api.cutout
+
+    def failing_cutout(i, *args):
+        if i == 7:
+            raise requests.exceptions.HTTPError("503 Server Error")
+        return cutout(i, *args)
+
+    monkeypatch.setattr(fake_api, "cutout", failing_cutout)
+    monkeypatch.setattr(data_read_utils, "get", fake_api)
+    save_dir = str(tmpdir.mkdir("resume"))
+    with np.testing.assert_raises_regex(requests.exceptions.HTTPError,
+                                        "503 Server Error"):
+        data_read_utils.save_halos(1, save_dir, snapnum=135, max_halos=5)
+    manifest = data_read_utils._read_manifest(
+        os.path.join(save_dir, data_read_utils.manifest_name))
+    assert sorted(manifest) == [2, 4]
+    assert manifest[2]["n_gas"] == 52 and manifest[2]["n_star"] == 78
+
+    monkeypatch.setattr(fake_api, "cutout", cutout)
+    fake_api.n_requests = 0
+    list_file = data_read_utils.save_halos(1, save_dir, snapnum=135,
+                                           max_halos=5)
+    ids = calc_accel._get_subhalo_ids(np.load(list_file)["arr_0"])
+    np.testing.assert_array_equal(ids, [2, 4, 7, 8, 10])
+    # Only 3 documents and cutouts are fetched again
+    assert fake_api.n_requests == 4 + 1 + 2 * 3
+
+    list_file = data_read_utils.save_halos(1, save_dir, snapnum=135,
+                                           max_halos=None)
+    fresh_dir = str(tmpdir.mkdir("fresh"))
+    list_exp = data_read_utils.save_halos(1, fresh_dir, snapnum=135,
+                                          max_halos=None)
+    np.testing.assert_array_equal(np.load(list_file)["arr_0"],
+                                  np.load(list_exp)["arr_0"])
+    np.testing.assert_array_equal(np.load(list_file)["r_max"],
+                                  np.load(list_exp)["r_max"])
+
+    # Subhalo files saved with other options are fetched again, while a
+    # store saved with other options is refused
+    fake_api.n_requests = 0
+    list_file = data_read_utils.save_halos(1, save_dir, snapnum=135,
+                                           max_halos=3, sort_radius=True)
+    assert fake_api.n_requests == 4 + 1 + 2 * 3
+    assert bool(np.load(list_file)["sorted"])
+    for filei in np.load(list_file)["arr_0"]:
+        assert "M_enc" in pd.read_pickle(os.path.join(save_dir, filei))
+
+    # Another snapshot saved in the same directory fetches its own subhalos,
+    # and leaves those of the first snapshot in place
+    fake_api.snapnums.append(125)
+    fake_api.n_requests = 0
+    list_file = data_read_utils.save_halos(1, save_dir, snapnum=125,
+                                           max_halos=3)
+    assert fake_api.n_requests == 4 + 1 + 2 * 3
+    np.testing.assert_array_equal(np.load(list_file)["arr_0"], [
+        "Illustris-1_snapnum=125_subhalo{}.pickle.gz".format(i) for i in
+        [2, 4, 7]])
+    fake_api.n_requests = 0
+    list_file = data_read_utils.save_halos(1, save_dir, snapnum=135,
+                                           max_halos=3, sort_radius=True)
+    assert fake_api.n_requests == 4 + 1
+    np.testing.assert_array_equal(np.load(list_file)["arr_0"], [
+        "Illustris-1_snapnum=135_subhalo{}.pickle.gz".format(i) for i in
+        [2, 4, 7]])
+    store_loc = data_read_utils.save_halos(1, save_dir, snapnum=135,
+                                           max_halos=2, store=True)
+    assert halo_store.HaloStore(store_loc).attrs["options"] == {
+        "sort_radius":False, "part_types":["gas", "star"], "float32":False}
+    with np.testing.assert_raises_regex(ValueError, "other options"):
+        data_read_utils.save_halos(1, save_dir, snapnum=135, max_halos=2,
+                                   store=True, float32=True)
+
+    # Each snapshot has a store of its own, which is refused for others
+    fake_api.n_requests = 0
+    other_loc = data_read_utils.save_halos(1, save_dir, snapnum=125,
+                                           max_halos=2, store=True)
+    assert fake_api.n_requests == 4 + 1 + 2 * 2
+    assert os.path.basename(other_loc) == (
+        "subhalo_store_Illustris-1_snapnum=125")
+    assert halo_store.HaloStore(other_loc).attrs["snapshot"] == "snapnum=125"
+    assert halo_store.HaloStore(store_loc).attrs["snapshot"] == "snapnum=135"
+    fake_api.snapnums.append(120)
+    os.rename(other_loc, os.path.join(
+        save_dir, "subhalo_store_Illustris-1_snapnum=120"))
+    with np.testing.assert_raises_regex(ValueError, "another snapshot"):
+        data_read_utils.save_halos(1, save_dir, snapnum=120, max_halos=2,
+                                   store=True)
+
+
+def _ref_particles(group, sub, a, name):
+    """The original transform of :function:`data_utils.data_read_utils.
+    save_halos`, done separately for each axis
+    """
+    h = data_read_utils.hubble_param
+    dx = np.asarray(group["Coordinates"][:, 0] - sub["pos_x"], dtype=float)
+    dy = np.asarray(group["Coordinates"][:, 1] - sub["pos_y"], dtype=float)
+    dz = np.asarray(group["Coordinates"][:, 2] - sub["pos_z"], dtype=float)
+    vx = np.asarray(group["Velocities"][:, 0] * np.sqrt(a) - sub["vel_x"],
+                    dtype=float)
+    vy = np.asarray(group["Velocities"][:, 1] * np.sqrt(a) - sub["vel_y"],
+                    dtype=float)
+    vz = np.asarray(group["Velocities"][:, 2] * np.sqrt(a) - sub["vel_z"],
+                    dtype=float)
+    m = np.asarray(group["Masses"], dtype=float)
+    m *= (10**10 / h)
+    return {"r":np.sqrt(dx**2 + dy**2 + dz**2) * a / h, "M":m,
+            "v":np.sqrt(vx**2 + vy**2 + vz**2),
+            "type":np.full(m.size, name)}
+
+
+def test_particle_table(tmpdir, monkeypatch):
+    """Test that the particle transform of
+    :function:`data_utils.data_read_utils.save_halos` matches the original
+    per-axis calculation exactly for single and double precision cutouts,
+    and saves dark matter and single precision output when asked
+    """
+    fake_api = _FakeAPI(str(tmpdir))
+    sub = fake_api.sub(5)
+    a = 0.8
+    with h5py.File(fake_api.cutout(5, in_memory=True), "r") as f:
+        data = data_read_utils._particle_table(f, sub, a)
+        ref = [_ref_particles(f["PartType0"], sub, a, "gas"),
+               _ref_particles(f["PartType4"], sub, a, "star")]
+        for col in ["r", "M", "v", "type"]:
+            np.testing.assert_array_equal(data[col], np.append(
+                ref[0][col], ref[1][col]))
+        single = io.BytesIO()
+        with h5py.File(single, "w") as f32:
+            for name in ["Coordinates", "Velocities", "Masses"]:
+                f32.create_dataset("PartType0/" + name, data=f["PartType0"][
+                    name][:].astype(np.float32))
+        with h5py.File(single, "r") as f32:
+            data = data_read_utils._particle_table(f32, sub, a, ["gas"])
+            ref = _ref_particles(f32["PartType0"], sub, a, "gas")
+            for col in ["r", "M", "v", "type"]:
+                np.testing.assert_array_equal(data[col], ref[col])
+
+    monkeypatch.setattr(data_read_utils, "get", fake_api)
+    list_file = data_read_utils.save_halos(
+        1, str(tmpdir), snapnum=135, max_halos=2,
+        part_types=["gas", "dm", "star"], float32=True)
+    file_list = np.load(list_file)["arr_0"]
+    df = pd.read_pickle(os.path.join(str(tmpdir), file_list[0]))
+    assert (df[["r", "M", "v"]].dtypes == np.float32).all()
+    assert isinstance(df["type"].dtype, pd.CategoricalDtype)
+    np.testing.assert_array_equal(df["type"].values[50:54],
+                                  ["gas", "gas", "dm", "dm"])
+    np.testing.assert_allclose(df["M"].values[df["type"].values == "dm"],
+                               4.e6 / data_read_utils.hubble_param, rtol=1.e-6)
+    manifest = data_read_utils._read_manifest(
+        os.path.join(str(tmpdir), data_read_utils.manifest_name))
+    assert (manifest[2]["n_gas"], manifest[2]["n_dm"],
+            manifest[2]["n_star"]) == (52, 30, 78)
+    with np.testing.assert_raises_regex(ValueError,
+                                        "Unknown particle type: bh"):
+        data_read_utils.save_halos(1, str(tmpdir), snapnum=135,
+                                   part_types=["gas", "bh"])
+
+
+def test_save_halos_chunked(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.save_halos` saves the
+    same particles and manifest records to a store when reading cutouts in
+    small chunks as when reading them whole
+    """
+    monkeypatch.setattr(data_read_utils, "get", _FakeAPI(str(tmpdir)))
+    part_types = ["gas", "dm", "star"]
+    stores = {}
+    manifests = {}
+    for chunk_size in [None, 7]:
+        save_dir = str(tmpdir.mkdir("chunk_{}".format(chunk_size)))
+        stores[chunk_size] = data_read_utils.save_halos(
+            1, save_dir, snapnum=135, store=True, n_workers=3,
+            part_types=part_types, float32=True, chunk_size=chunk_size)
+        manifests[chunk_size] = data_read_utils._read_manifest(
+            os.path.join(save_dir, data_read_utils.manifest_name))
+    store_exp = halo_store.HaloStore(stores[None])
+    store_obs = halo_store.HaloStore(stores[7])
+    np.testing.assert_array_equal(store_obs.ids, store_exp.ids)
+    np.testing.assert_array_equal(store_obs.offsets, store_exp.offsets)
+    for i in store_exp.ids:
+        for (col, arr) in store_exp.read(i).items():
+            np.testing.assert_array_equal(store_obs.read(i)[col], arr)
+    assert manifests[7] == manifests[None]
+    # Single precision columns are stored compactly, as recorded in the
+    # metadata of the store
+    for col in ["r", "M", "v"]:
+        assert store_exp.columns[col] == np.float32
+        assert os.path.getsize(os.path.join(stores[None], col + ".bin")) == (
+            4 * store_exp.offsets[-1])
+    assert (store_exp.read_table(store_exp.ids[0])[["r", "M", "v"]].dtypes ==
+            np.float32).all()
+    with np.testing.assert_raises_regex(ValueError,
+                                        "chunk_size can only be used with "
+                                        "store=True"):
+        data_read_utils.save_halos(1, str(tmpdir), snapnum=135,
+                                   chunk_size=7)
+
+
+def test_save_halos_batch(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.save_halos_batch`
+    saves each snapshot to its own directory with the same results as
+    :function:`data_utils.data_read_utils.save_halos`, and skips completed
+    snapshots when run again
+    """
+    fake_api = _FakeAPI(str(tmpdir), snapnums=[133, 134, 135])
+    monkeypatch.setattr(data_read_utils, "get", fake_api)
+    batch_dir = str(tmpdir.mkdir("batch"))
+    list_files = data_read_utils.save_halos_batch(
+        1, batch_dir, snapnum=[135, 133], n_workers=3, max_rate=1000,
+        max_halos=4)
+    assert list(list_files) == [135, 133]
+    for snapnum in [135, 133]:
+        assert list_files[snapnum] == os.path.join(
+            batch_dir, "Illustris-1_snapnum={}".format(snapnum),
+            "subhalo_list.npz")
+        single_dir = str(tmpdir.mkdir("single_{}".format(snapnum)))
+        list_exp = data_read_utils.save_halos(1, single_dir, snapnum=snapnum,
+                                              max_halos=4)
+        files_exp = np.load(list_exp)["arr_0"]
+        np.testing.assert_array_equal(np.load(list_files[snapnum])["arr_0"],
+                                      files_exp)
+        for filei in files_exp:
+            pd.testing.assert_frame_equal(
+                pd.read_pickle(os.path.join(
+                    os.path.dirname(list_files[snapnum]), filei)),
+                pd.read_pickle(os.path.join(single_dir, filei)))
+    # Running again only looks up the simulation and its snapshot list
+    fake_api.n_requests = 0
+    assert data_read_utils.save_halos_batch(
+        1, batch_dir, snapnum=[133, 135], max_halos=4) == dict(
+        (snapnum, list_files[snapnum]) for snapnum in [133, 135])
+    assert fake_api.n_requests == 3
+    # Saving more halos resumes from the manifest of each snapshot
+    data_read_utils.save_halos_batch(1, batch_dir, z=[0.0, 0.2], max_halos=5)
+    assert len(np.load(os.path.join(batch_dir, "Illustris-1_z=0.2",
+                                    "subhalo_list.npz"))["arr_0"]) == 5
+    with np.testing.assert_raises_regex(ValueError,
+                                        "Invalid snapshot number for "
+                                        "simulation Illustris-1: 136"):
+        data_read_utils.save_halos_batch(1, batch_dir, snapnum=[135, 136])
+
+
+def test_save_halos_profiles(tmpdir, monkeypatch):
+    """Test that :function:`data_utils.data_read_utils.save_halos` saves a
+    profile of each subhalo on the base grids, including subhalos saved
+    before profiles were asked for, and that the calc functions use them.
+    Each snapshot saved in a directory has profiles of its own
+    """
+    monkeypatch.setattr(data_read_utils, "get", _FakeAPI(
+        str(tmpdir), snapnums=(135, 125)))
+    save_dir = str(tmpdir.mkdir("files"))
+    data_read_utils.save_halos(1, save_dir, snapnum=135, max_halos=3)
+    list_file = data_read_utils.save_halos(1, save_dir, snapnum=135,
+                                           max_halos=5, profiles=True)
+    file_list = np.load(list_file)["arr_0"]
+    ids = calc_accel._get_subhalo_ids(file_list)
+    stores = halo_profiles.open_profiles(list_file)
+    assert sorted(stores) == sorted(halo_profiles.default_profile_grids)
+    for store in stores.values():
+        np.testing.assert_array_equal(store.ids, ids)
+        assert np.int64(ids[0]) in store and -1 not in store
+        with np.testing.assert_raises_regex(KeyError, "not found"):
+            store.read([ids[0], -1])
+        profiles = store.read(ids[::-1])
+        for (j, filei) in enumerate(file_list[::-1]):
+            profile = halo_profiles.compute_profile(
+                pd.read_pickle(os.path.join(save_dir, filei)), store.edges)
+            for (col, arr) in profile.items():
+                np.testing.assert_array_equal(profiles[col][j], arr)
+    r = np.arange(10.0, 150.0, 10.0)
+    pd.testing.assert_frame_equal(
+        calc_accel.calc_rar(r, 10.0, list_file),
+        calc_accel.calc_rar(r, 10.0, list_file, use_profiles=False),
+        rtol=1.e-10)
+
+    store_dir = str(tmpdir.mkdir("store"))
+    store_loc = data_read_utils.save_halos(1, store_dir, snapnum=135,
+                                           max_halos=5, store=True,
+                                           chunk_size=7, profiles=True)
+    assert halo_profiles.profiles_loc(store_loc) == os.path.join(
+        store_dir, "subhalo_profiles_Illustris-1_snapnum=135")
+    pd.testing.assert_frame_equal(
+        calc_accel.calc_rar(r, 10.0, store_loc),
+        calc_accel.calc_rar(r, 10.0, list_file), rtol=1.e-10)
+
+    # Another snapshot saved in the same directory gets profiles of its own
+    other_file = data_read_utils.save_halos(1, save_dir, snapnum=125,
+                                            max_halos=2, profiles=True)
+    assert halo_profiles.profiles_loc(other_file) == os.path.join(
+        save_dir, "subhalo_profiles_Illustris-1_snapnum=125")
+    for (name, store) in halo_profiles.open_profiles(other_file).items():
+        np.testing.assert_array_equal(store.ids, ids[:2])
+        assert len(halo_profiles.ProfileStore(os.path.join(
+            save_dir, "subhalo_profiles_Illustris-1_snapnum=135",
+            name))) == 5
+
+
+def test_settings(tmpdir, monkeypatch):
+    """Test that the API key and Hubble parameter of
+    :mod:`data_utils.data_read_utils` are read on first use, from the
+    environment if set and otherwise from the config file
+    """
+    config_loc = os.path.join(str(tmpdir), "config.ini")
+    with open(config_loc, "w") as f:
+        f.write("ILL_KEY = abc\nILL_h = 0.5\n")
+    monkeypatch.setenv("MOND_CONFIG", config_loc)
+    monkeypatch.delenv("ILL_KEY", raising=False)
+    monkeypatch.delenv("ILL_H", raising=False)
+    try:
+        data_read_utils.reset_settings()
+        assert data_read_utils.get_api_key() == "abc"
+        assert data_read_utils.hubble_param == 0.5
+        # Settings are kept once read
+        monkeypatch.setenv("ILL_H", "0.7")
+        assert data_read_utils.get_hubble_param() == 0.5
+        data_read_utils.reset_settings()
+        assert data_read_utils.get_hubble_param() == 0.7
+        monkeypatch.setenv("ILL_KEY", "def")
+        assert data_read_utils.api_key == "def"
+        # Without a config file, only settings in the environment can be used
+        data_read_utils.reset_settings()
+        monkeypatch.setenv("MOND_CONFIG", os.path.join(str(tmpdir), "none"))
+        assert data_read_utils.get_api_key() == "def"
+        monkeypatch.delenv("ILL_H")
+        with np.testing.assert_raises_regex(IOError, "ILL_H"):
+            data_read_utils.get_hubble_param()
+        # Without an API key, only requests to the Illustris API fail, and
+        # cached responses are served without one
+        monkeypatch.delenv("ILL_KEY")
+        data_read_utils.reset_settings()
+        with np.testing.assert_raises_regex(IOError, "ILL_KEY"):
+            data_read_utils.get("")
+        cache_loc = os.path.join(str(tmpdir), "responses.sqlite")
+        with mock_api.MockIllustrisAPI(n_subhalos=2) as api:
+            try:
+                data_read_utils.configure_api(api.base_url)
+                data_read_utils.configure_cache(cache_loc)
+                r = data_read_utils.get("Illustris-1/")
+                data_read_utils.configure_api()
+                data_read_utils.configure_cache(cache_loc, offline=True)
+                assert data_read_utils.get(api.base_url + "Illustris-1/") == r
+            finally:
+                data_read_utils.configure_api()
+                data_read_utils.configure_cache(None)
+        assert api.stats()["total"]["requests"] == 1
+    finally:
+        monkeypatch.undo()
+        data_read_utils.reset_settings()
+    assert data_read_utils.get_hubble_param() == 0.704
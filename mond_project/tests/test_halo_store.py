@@ -0,0 +1,117 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import os
+import pandas as pd
+from mond_project.calculate import calc_accel
+from mond_project.data_utils import halo_store
+from .test_calc_accel import (_ref_halo, _write_test_halos, test_delta_r,
+                              test_ids, test_r)
+
+
+def test_convert_to_store(tmpdir):
+    """Test that converting saved subhalo files to a consolidated store keeps
+    every subhalo's particles, and that converting again adds nothing
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    store_loc = os.path.join(str(tmpdir), "subhalo_store")
+    halo_store.convert_to_store(list_file, store_loc)
+    halo_store.convert_to_store(list_file, store_loc)
+    store = halo_store.HaloStore(store_loc)
+    np.testing.assert_array_equal(store.ids, test_ids)
+    for id in test_ids:
+        df_exp = _ref_halo(list_file, id)
+        df_obs = store.read_table(id)
+        for col in ["r", "M", "v"]:
+            np.testing.assert_array_equal(df_obs[col].values,
+                                          df_exp[col].values)
+        np.testing.assert_array_equal(df_obs["type"].values.astype(str),
+                                      df_exp["type"].values.astype(str))
+    data = store.read(test_ids[1], ["r"])
+    assert list(data) == ["r"]
+    assert isinstance(data["r"], np.memmap)
+
+
+def test_store_partial_append(tmpdir):
+    """Test that particles written after the last complete subhalo are
+    dropped when a store is reopened for appending
+    """
+    store_loc = os.path.join(str(tmpdir), "subhalo_store")
+    data = {"r":np.arange(1.0, 4.0), "M":np.ones(3), "v":np.ones(3),
+            "type":["gas", "star", "star"]}
+    with halo_store.HaloStore(store_loc, mode="a") as store:
+        store.append(5, data)
+    with open(os.path.join(store_loc, "r.bin"), "ab") as f:
+        f.write(np.zeros(7).tobytes())
+    with halo_store.HaloStore(store_loc, mode="a") as store:
+        store.append(6, data)
+        np.testing.assert_array_equal(store.read(6)["r"], data["r"])
+        np.testing.assert_array_equal(store.read(5)["type"], [0, 4, 4])
+    # The whole index is kept in one file, replaced at once
+    with np.load(os.path.join(store_loc, halo_store.index_name)) as index:
+        assert sorted(index.files) == ["ids", "offsets", "r_max", "r_min"]
+        np.testing.assert_array_equal(index["ids"], [5, 6])
+        np.testing.assert_array_equal(index["offsets"], [0, 3, 6])
+    with np.testing.assert_raises_regex(ValueError,
+                                        "Unknown particle type: dust"):
+        halo_store.encode_types(["gas", "dust"])
+
+
+def test_store_append_chunks(tmpdir):
+    """Test that a subhalo added in chunks matches one added at once, and
+    that a failure part way through leaves the store unchanged
+    """
+    store_loc = os.path.join(str(tmpdir), "subhalo_store")
+    rng = np.random.RandomState(0)
+    data = {"r":rng.uniform(0, 10, 25), "M":rng.uniform(0, 1, 25),
+            "v":rng.uniform(0, 100, 25), "type":np.repeat([0, 4], [10, 15])}
+
+    def chunks(fail=False):
+        for start in range(0, 25, 7):
+            if fail and start > 10:
+                raise IOError("Lost the cutout")
+            yield dict((col, arr[start:start + 7]) for (col, arr) in
+                       data.items())
+
+    with halo_store.HaloStore(store_loc, mode="a") as store:
+        store.append(1, data)
+        with np.testing.assert_raises_regex(IOError, "Lost the cutout"):
+            store.append_chunks(2, chunks(fail=True))
+        assert 2 not in store
+        assert os.path.getsize(os.path.join(store_loc, "r.bin")) == 25 * 8
+        store.append_chunks(2, chunks())
+        for col in data:
+            np.testing.assert_array_equal(store.read(2)[col],
+                                          store.read(1)[col])
+        np.testing.assert_array_equal([store.r_min, store.r_max],
+                                      [[data["r"].min()] * 2,
+                                       [data["r"].max()] * 2])
+    sorted_loc = os.path.join(str(tmpdir), "sorted_store")
+    with halo_store.HaloStore(sorted_loc, mode="a", sort_radius=True) as store:
+        with np.testing.assert_raises_regex(ValueError,
+                                            "Particles can't be added in "
+                                            "chunks to a sorted store"):
+            store.append_chunks(1, chunks())
+    # Subhalos are found by ID however the ID is given, also after reopening
+    with halo_store.HaloStore(store_loc) as store:
+        assert np.int64(2) in store and 3 not in store
+        np.testing.assert_array_equal(store.read(np.int64(2))["r"], data["r"])
+        with np.testing.assert_raises_regex(KeyError, "Subhalo 3 not found"):
+            store.read(3)
+
+
+def test_calc_from_store(tmpdir):
+    """Test that the calc functions give the same results when reading from
+    a consolidated store as from the list file
+    """
+    list_file = _write_test_halos(str(tmpdir))
+    store_loc = halo_store.convert_to_store(
+        list_file, os.path.join(str(tmpdir), "subhalo_store"))
+    ids = [7, 3]
+    for calc in [calc_accel.calc_gobs, calc_accel.calc_gbar]:
+        pd.testing.assert_frame_equal(
+            calc(test_r, test_delta_r, store_loc, ids),
+            calc(test_r, test_delta_r, list_file, ids))
+    pd.testing.assert_frame_equal(
+        calc_accel.calc_rar(test_r, test_delta_r, store_loc),
+        calc_accel.calc_rar(test_r, test_delta_r, list_file))
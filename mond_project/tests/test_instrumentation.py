@@ -0,0 +1,124 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from mond_project.benchmarks import mock_api, synthetic
+from mond_project.calculate import calc_accel
+from mond_project.data_utils import data_read_utils, instrumentation
+
+
+def test_timed_stages():
+    """Test that stages are only timed when instrumentation is enabled, and
+    that time spent in a stage inside another is only counted once
+    """
+    instrumentation.reset_instrumentation()
+    with instrumentation.timed("outer") as timer:
+        timer.nbytes += 10
+    assert instrumentation.stage_stats() == {}
+    try:
+        instrumentation.configure_instrumentation()
+        with instrumentation.timed("outer") as timer:
+            timer.nbytes += 10
+            time.sleep(0.02)
+            with instrumentation.timed("inner"):
+                time.sleep(0.05)
+        stats = instrumentation.stage_stats()
+        assert stats["outer"]["count"] == 1 and stats["inner"]["count"] == 1
+        assert stats["outer"]["bytes"] == 10
+        assert 0.02 <= stats["outer"]["total_time"] < 0.05
+        assert stats["inner"]["total_time"] >= 0.05
+        # Stages of a halo are added to its record until it is finished
+        record = instrumentation.new_record("test", 3)
+        with instrumentation.activate(record):
+            with instrumentation.timed("inner"):
+                pass
+            instrumentation.note(n_part=5)
+        assert instrumentation.stage_stats()["inner"]["count"] == 1
+        instrumentation.finish_record(record, status="done")
+        assert instrumentation.stage_stats()["inner"]["count"] == 2
+        records = instrumentation.halo_records()
+        assert records.loc[0, "task"] == "test" and records.loc[0, "id"] == 3
+        assert records.loc[0, "n_part"] == 5
+        assert records.loc[0, "status"] == "done"
+        assert records.loc[0, "elapsed"] >= records.loc[0, "inner_time"]
+    finally:
+        instrumentation.configure_instrumentation(False)
+        instrumentation.reset_instrumentation()
+
+
+def test_calc_instrumentation(tmpdir, capsys):
+    """Test that the calc functions report progress without printing, and
+    record the loading and binning of each halo in this process or others
+    """
+    list_file = synthetic.write_synthetic_halos(str(tmpdir), 4, 300, seed=2)
+    r = np.arange(2.0, 30.0, 4.0)
+    expected = calc_accel.calc_rar(r, 2.0, list_file)
+    assert capsys.readouterr().out == ""
+    calls = []
+    records_loc = os.path.join(str(tmpdir), "records.jsonl")
+    try:
+        instrumentation.configure_instrumentation(
+            progress=lambda *args: calls.append(args),
+            records_loc=records_loc)
+        for n_jobs in [1, 2]:
+            pd.testing.assert_frame_equal(
+                calc_accel.calc_rar(r, 2.0, list_file, n_jobs=n_jobs),
+                expected)
+        records = instrumentation.halo_records()
+        stats = instrumentation.stage_stats()
+        output = os.path.join(str(tmpdir), "output.jsonl")
+        instrumentation.write_records(output)
+    finally:
+        instrumentation.configure_instrumentation(False)
+        instrumentation.reset_instrumentation()
+    assert [call[1:] for call in calls[:4]] == [(1, 4, 0), (2, 4, 1),
+                                                (3, 4, 2), (4, 4, 3)]
+    assert set(call[0] for call in calls) == {"calc_rar"}
+    assert len(records) == 8
+    assert (records["task"] == "calc_rar").all()
+    assert list(records["id"]) == [0, 1, 2, 3] * 2
+    assert (records["n_part"] == 300).all()
+    assert (records["load_time"] > 0).all() and (records["bin_time"] > 0).all()
+    assert stats["load"]["count"] == 8 and stats["bin"]["count"] == 8
+    with open(records_loc) as f:
+        written = [json.loads(line) for line in f]
+    with open(output) as f:
+        assert [json.loads(line) for line in f] == written
+    assert [record["id"] for record in written] == list(records["id"])
+
+
+def test_ingest_instrumentation(tmpdir):
+    """Test that the ingest records the fetch, download, read, transform, and
+    write of each subhalo, with the bytes downloaded and particle counts
+    """
+    calls = []
+    with mock_api.MockIllustrisAPI(n_subhalos=5, n_part=200) as api:
+        try:
+            data_read_utils.configure_api(api.base_url)
+            instrumentation.configure_instrumentation(
+                progress=lambda *args: calls.append(args))
+            data_read_utils.save_halos(1, str(tmpdir), z=0, max_halos=3,
+                                       n_workers=2, profiles=True)
+            records = instrumentation.halo_records()
+            stats = instrumentation.stage_stats()
+            bytes_sent = api.stats()["cutout"]["bytes"]
+        finally:
+            data_read_utils.configure_api()
+            instrumentation.configure_instrumentation(False)
+            instrumentation.reset_instrumentation()
+    assert calls == [("ingest", 1, 3, 0), ("ingest", 2, 3, 1),
+                     ("ingest", 3, 3, 2)]
+    assert list(records["id"]) == [0, 1, 2]
+    assert (records["status"] == "done").all()
+    assert (records["n_gas"] == 100).all() and (records["n_star"] == 100).all()
+    for stage in ["fetch", "download", "read", "transform", "write",
+                  "profile"]:
+        assert (records["{}_time".format(stage)] > 0).all()
+        assert stats[stage]["count"] >= 3
+    assert records["download_bytes"].sum() == bytes_sent
+    assert stats["download"]["bytes"] == bytes_sent
+    # Subhalo and snapshot documents are fetched outside of any subhalo
+    assert stats["fetch"]["count"] > 3
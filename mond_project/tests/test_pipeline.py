@@ -0,0 +1,149 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from mond_project import pipeline
+from mond_project.benchmarks import mock_api
+from mond_project.calculate import calc_accel, stacking
+from mond_project.data_utils import data_read_utils
+
+
+def _cutouts(api):
+    return api.stats().get("cutout", {}).get("requests", 0)
+
+
+def _ran(summaries):
+    return [stage for stage in pipeline.stage_names if
+            summaries[stage]["ran"]]
+
+
+def test_pipeline_caching(tmpdir):
+    """Test that the pipeline only reruns stages whose inputs changed, that
+    new bins don't repeat the ingest, that more halos only ingest and
+    calculate the new ones, and that fewer halos only use the first ones
+    """
+    config = {"ingest":{"max_halos":4},
+              "bins":{"r_min":1.0, "r_max":30.0, "n_bins":6},
+              "run":{"output_dir":str(tmpdir), "n_workers":2}}
+    with mock_api.MockIllustrisAPI(n_subhalos=12, n_part=200) as api:
+        try:
+            data_read_utils.configure_api(api.base_url)
+            first = pipeline.run_pipeline(config)
+            n_cutouts = _cutouts(api)
+            assert _ran(first) == ["ingest", "profiles", "stack"]
+            assert n_cutouts == 4
+            assert first["profiles"]["n_computed"] == 4
+            # Nothing changed, so nothing is run or downloaded
+            again = pipeline.run_pipeline(config)
+            assert _ran(again) == []
+            assert again["stack"]["result"] == first["stack"]["result"]
+            # New bins only rerun the profiles and stacking
+            config["bins"]["n_bins"] = 3
+            rebinned = pipeline.run_pipeline(config)
+            assert _ran(rebinned) == ["profiles", "stack"]
+            assert rebinned["profiles"]["n_computed"] == 4
+            assert rebinned["profiles"]["dir"] != first["profiles"]["dir"]
+            # More halos only download and calculate the new ones
+            config["bins"]["n_bins"] = 6
+            config["ingest"]["max_halos"] = 6
+            more = pipeline.run_pipeline(config)
+            assert _ran(more) == ["ingest", "profiles", "stack"]
+            assert _cutouts(api) == n_cutouts + 2
+            assert more["ingest"]["dir"] == first["ingest"]["dir"]
+            assert more["profiles"]["dir"] == first["profiles"]["dir"]
+            assert more["profiles"]["n_computed"] == 2
+            assert more["stack"]["dir"] != first["stack"]["dir"]
+            # Forcing the stacking doesn't recalculate the profiles
+            restacked = pipeline.run_pipeline(config, rerun="stack")
+            assert _ran(restacked) == ["stack"]
+        finally:
+            data_read_utils.configure_api()
+    # The outputs are the same as calculating everything directly
+    bin_edges = np.linspace(1.0, 30.0, 7)
+    r = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+    rar = calc_accel.calc_rar(r, np.diff(bin_edges), more["ingest"]["result"])
+    assert rar["ID"].nunique() == 6
+    with np.load(more["profiles"]["result"]) as saved:
+        np.testing.assert_array_equal(saved["ids"], rar["ID"].unique())
+        np.testing.assert_allclose(saved["gobs"], rar.pivot(
+            index="r", columns="ID", values="gobs").values, rtol=1.e-10)
+        np.testing.assert_allclose(saved["gbar"], rar.pivot(
+            index="r", columns="ID", values="gbar").values, rtol=1.e-10)
+    expected = stacking.stack_rar(rar)
+    expected.columns = ["{}_{}".format(*column) for column in expected.columns]
+    stack = pd.read_csv(more["stack"]["result"], index_col="r")
+    np.testing.assert_allclose(stack.index.values, expected.index.values)
+    np.testing.assert_allclose(stack.values, expected.values, rtol=1.e-10)
+    # Fewer halos only use the first ones, without downloading any
+    config["ingest"]["max_halos"] = 3
+    with mock_api.MockIllustrisAPI(n_subhalos=12, n_part=200) as api:
+        try:
+            data_read_utils.configure_api(api.base_url)
+            fewer = pipeline.run_pipeline(config)
+        finally:
+            data_read_utils.configure_api()
+        assert _cutouts(api) == 0
+    assert _ran(fewer) == ["ingest", "stack"]
+    assert fewer["ingest"]["dir"] == first["ingest"]["dir"]
+    assert fewer["profiles"]["n_computed"] == 0
+    assert fewer["stack"]["dir"] not in (first["stack"]["dir"],
+                                         more["stack"]["dir"])
+    with np.load(fewer["profiles"]["result"]) as saved:
+        np.testing.assert_array_equal(saved["ids"], rar["ID"].unique()[:3])
+    stack = pd.read_csv(fewer["stack"]["result"], index_col="r")
+    assert stack["gobs_count"].max() == 3
+
+
+def test_pipeline_config(tmpdir, capsys):
+    """Test reading the pipeline configuration from an INI file, and running
+    the pipeline from the command line with a memory budget smaller than a
+    single halo
+    """
+    config_loc = os.path.join(str(tmpdir), "pipeline.ini")
+    with open(config_loc, "w") as f:
+        f.write("[ingest]\nsnapnum = 135\nmax_halos = 3\nstore = false\n"
+                "part_types = gas, star\n[[selection]]\nmass_stars__gt = 0\n"
+                "[bins]\nedges = 1, 2, 4, 8, 16\n[stack]\npercentiles = 5, "
+                "50, 95\n[run]\nmemory_budget = 1.5 KiB\nn_jobs = none\n")
+    config = pipeline.load_pipeline_config(config_loc)
+    assert config["ingest"]["z"] is None and config["ingest"]["snapnum"] == 135
+    assert config["ingest"]["max_halos"] == 3
+    assert config["ingest"]["store"] is False
+    assert config["ingest"]["sort_radius"] is True
+    assert config["ingest"]["selection"] == {"mass_stars__gt":0}
+    assert config["bins"]["edges"] == [1.0, 2.0, 4.0, 8.0, 16.0]
+    assert config["stack"]["percentiles"] == [5.0, 50.0, 95.0]
+    assert config["run"]["memory_budget"] == 1536
+    assert config["run"]["n_jobs"] is None
+    assert pipeline.load_pipeline_config(config) == config
+    with pytest.raises(ValueError):
+        pipeline.load_pipeline_config({"bins":{"n_bin":3}})
+    with pytest.raises(ValueError):
+        pipeline.load_pipeline_config({"bins":{"edges":[2, 1]}})
+    with pytest.raises(IOError):
+        pipeline.load_pipeline_config(os.path.join(str(tmpdir), "none.ini"))
+    output_dir = os.path.join(str(tmpdir), "output")
+    with mock_api.MockIllustrisAPI(n_subhalos=5, n_part=100) as api:
+        try:
+            data_read_utils.configure_api(api.base_url)
+            assert pipeline.main([config_loc, "--output-dir", output_dir,
+                                  "--n-jobs", "2"]) == 0
+            out = capsys.readouterr().out.splitlines()
+            assert pipeline.main([config_loc, "--output-dir", output_dir,
+                                  "--progress"]) == 0
+            captured = capsys.readouterr()
+        finally:
+            data_read_utils.configure_api()
+    assert [line.split()[:2] for line in out] == [
+        ["ingest", "ran"], ["profiles", "ran"], ["stack", "ran"]]
+    assert [line.split()[:2] for line in captured.out.splitlines()] == [
+        ["ingest", "cached"], ["profiles", "cached"], ["stack", "cached"]]
+    assert captured.err == ""
+    stack = pd.read_csv(out[-1].split()[-1], index_col="r")
+    assert list(stack.columns[:7]) == [
+        "gobs_count", "gobs_mean", "gobs_std", "gobs_median", "gobs_p5",
+        "gobs_p50", "gobs_p95"]
+    assert (stack["gobs_count"] <= 3).all()
+    np.testing.assert_allclose(stack.index.values, [1.5, 3.0, 6.0, 12.0])
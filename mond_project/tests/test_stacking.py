@@ -0,0 +1,80 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pandas as pd
+import pytest
+from mond_project.calculate import stacking
+
+test_r = np.arange(1.0, 11.0)
+
+
+def _test_accels(n_halos=50, seed=0):
+    """Make random accelerations for :param:`n_halos` halos with one row per
+    radius in :data:`test_r`, with some halos missing from each bin and no
+    halos at all in the last bin
+    """
+    rng = np.random.RandomState(seed)
+    values = rng.lognormal(-20.0, 1.0, (test_r.size, n_halos))
+    values[rng.rand(*values.shape) < 0.2] = np.nan
+    values[-1] = np.nan
+    return pd.DataFrame(values, index=test_r, columns=np.arange(n_halos))
+
+
+def test_stack_halos():
+    accels = _test_accels()
+    stack = stacking.stack_halos(accels, percentiles=(16, 84))
+    assert list(stack.columns) == ["count", "mean", "std", "median", "p16",
+                                   "p84"]
+    np.testing.assert_array_equal(stack.index.values, test_r)
+    for r in test_r[:-1]:
+        row = accels.loc[r].values
+        row = row[~np.isnan(row)]
+        assert stack.at[r, "count"] == row.size
+        np.testing.assert_allclose(stack.at[r, "mean"], np.mean(row))
+        np.testing.assert_allclose(stack.at[r, "std"], np.std(row, ddof=1))
+        np.testing.assert_allclose(stack.at[r, "median"], np.median(row))
+        np.testing.assert_allclose(stack.at[r, "p16"],
+                                   np.percentile(row, 16))
+    assert stack.at[test_r[-1], "count"] == 0
+    assert stack.loc[test_r[-1]].drop("count").isnull().all()
+
+    rar = accels.stack().rename_axis(["r", "ID"]).reset_index(name="gobs")
+    rar["gbar"] = 2 * rar["gobs"]
+    rar_stack = stacking.stack_rar(rar)
+    pd.testing.assert_frame_equal(rar_stack["gobs"], stack,
+                                  check_dtype=False)
+    np.testing.assert_allclose(rar_stack["gbar"]["mean"],
+                               2 * stack["mean"])
+
+
+def test_stack_accumulator():
+    accels = _test_accels()
+    stack = stacking.stack_halos(accels)
+    acc = stacking.StackAccumulator(test_r)
+    for i in range(0, 30, 7):
+        acc.add(accels.iloc[:, i:min(i + 7, 30)])
+    other = stacking.StackAccumulator(test_r)
+    for i in range(30, accels.shape[1]):
+        other.add(accels.iloc[:, i].values)
+    acc.merge(other)
+    result = acc.result()
+    np.testing.assert_array_equal(result["count"], stack["count"])
+    np.testing.assert_allclose(result["mean"], stack["mean"], rtol=1e-12)
+    np.testing.assert_allclose(result["std"], stack["std"], rtol=1e-10)
+    np.testing.assert_allclose(result["min"], accels.min(axis=1))
+    np.testing.assert_allclose(result["max"], accels.max(axis=1))
+
+
+def test_stack_accumulator_index():
+    """Test that the rows of a DataFrame are matched to the bins by radius,
+    and that other radii are refused
+    """
+    accels = _test_accels(n_halos=5)
+    acc = stacking.StackAccumulator(test_r)
+    acc.add(accels.iloc[::-1])
+    np.testing.assert_allclose(acc.result()["mean"],
+                               stacking.stack_halos(accels)["mean"])
+    with pytest.raises(ValueError):
+        acc.add(accels.set_index(test_r + 0.5))
+    with pytest.raises(ValueError):
+        acc.add(accels.iloc[1:])